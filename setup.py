@@ -16,10 +16,17 @@ setup(
         "requests>=2,<3",
         "python-dateutil>=2,<3"
     ],
+    extras_require = {
+        "s3": ["boto3"]
+    },
     entry_points = {
         "console_scripts": [
             "w1logger = w1datalogger.logger:main",
-            "w1rollup = w1data.commands:rollup_command"
+            "w1sim = w1datalogger.simulator:main",
+            "w1rollup = w1data.commands:rollup_command",
+            "w1compact = w1data.commands:compact_command",
+            "w1query = w1data.commands:query_command",
+            "w1export = w1data.commands:export_command"
         ]
     }
 )
@@ -1,6 +1,19 @@
-import unittest, os, glob
+import unittest, os, glob, tempfile, json, io, threading, sched, time
+from unittest import mock
 from os.path import join
-from w1data.rollup import do_rollup
+from w1data.rollup import do_rollup, RollupMonthlyCollection
+from w1data.metadata import MetadataStore
+from w1data import columnar, pyramid, export
+from w1data.query import RollupReader
+from w1data.observations import Observations
+from w1data.common import isotime_ns, iter_json_array
+from w1data.w1datapoint_linux_w1therm import W1Datapoint_Linux_w1therm
+from w1datalogger.outbox import Outbox
+from w1datalogger.logger import W1Logger, Config
+from w1datalogger import sysstatus
+from w1datalogger.simulator import SimulatedBus, RecordingEndpoint
+
+t_dir = join(os.path.dirname(__file__), 't')
 
 class FakeArgs:
     @classmethod
@@ -29,7 +42,7 @@ class TestCases(unittest.TestCase):
             pass
         with os.scandir(self.output) as s:
             for entry in s:
-                if entry.is_dir:
+                if entry.is_dir():
                     for fn in glob.glob(join(self.output, entry.name, '*')):
                         os.unlink(fn)
                     os.rmdir(join(self.output, entry.name))
@@ -56,6 +69,997 @@ class TestCases(unittest.TestCase):
         self.assertEqual(do_rollup(self.output, join(self.t, 'one_observation')), None)
         self.assertTrue(self._output_files_exist())
 
+    def test_one_observation_batch(self):
+        batches = list(Observations(join(self.t, 'one_observation')).generate_all_batches())
+        self.assertEqual(len(batches), 1)
+        batch = batches[0]
+        self.assertEqual(list(batch.values), [20.0625])
+        self.assertEqual(list(batch.crc_ok), [1])
+        self.assertEqual(batch.time_ns[0], 1580679901918000000)
+        self.assertEqual(batch.sensor_keys[batch.sensor_ids[0]], '28-011912588b87/w1_slave')
+        self.assertEqual(batch.sensor_measurements(), {batch.sensor_ids[0]: 'office_air_temperature'})
+
+def write_raw_tree(raw, files=40, start=1580679900, step=86400 * 2):
+    """An endpoint dir of raw files, one scan of two sensors each, spanning months."""
+    import datetime
+    from w1datalogger.simulator import w1_slave_text
+    endpoint = join(raw, 'observername')
+    os.makedirs(endpoint)
+    with open(join(t_dir, 'one_observation', 'observername', 'METADATA.json')) as f:
+        metadata = json.load(f)
+    metadata['collector']['sensors']['28-0119125800aa/w1_slave'] = {"name": "office_water_temperature"}
+    with open(join(endpoint, 'METADATA.json'), 'w') as f:
+        json.dump(metadata, f)
+    filenames = []
+    for n in range(files):
+        t = datetime.datetime.fromtimestamp(start + n * step, datetime.timezone.utc)
+        iso = t.isoformat(timespec='milliseconds')
+        scan = {"scan_start": iso, "datapoints": [
+            {"isotime": iso, "key": "28-011912588b87/w1_slave", "value": w1_slave_text(15 + n / 16)},
+            {"isotime": iso, "key": "28-0119125800aa/w1_slave", "value": w1_slave_text(40 - n / 16)}],
+            "scan_end": iso, "recording_event": "event-{}".format(n)}
+        filename = join(endpoint, "{};event-{}.json".format(t.isoformat(timespec='seconds'), n))
+        with open(filename, 'w') as f:
+            json.dump([scan], f)
+        filenames.append(filename)
+    return filenames
+
+def read_tree(top, journal=True):
+    contents = {}
+    for dirpath, _, filenames in os.walk(top):
+        for filename in filenames:
+            if not journal and filename.startswith('INGEST_JOURNAL.'):
+                continue
+            with open(join(dirpath, filename), 'rb') as f:
+                contents[os.path.relpath(join(dirpath, filename), top)] = f.read()
+    return contents
+
+class RollupTestCase(unittest.TestCase):
+    """Each test gets a temporary dir, self.tmp, holding self.raw (not made
+    yet; write_raw_tree() makes it) and an empty self.rollups."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.raw, self.rollups = join(self.tmp, 'raw'), join(self.tmp, 'rollups')
+        os.makedirs(self.rollups)
+
+    def roll_up_raw_tree(self, **kwargs):
+        """write_raw_tree(self.raw, **kwargs), rolled up into self.rollups.
+        Returns the raw filenames."""
+        filenames = write_raw_tree(self.raw, **kwargs)
+        do_rollup(self.rollups, self.raw)
+        return filenames
+
+class TestParallelRollup(unittest.TestCase):
+    def test_jobs_match_serial(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            raw = join(tmp, 'raw')
+            write_raw_tree(raw, files=600, step=4 * 3600)  # > 1 chunk of files
+            os.makedirs(join(tmp, 'serial'))
+            os.makedirs(join(tmp, 'parallel'))
+            do_rollup(join(tmp, 'serial'), raw)
+            do_rollup(join(tmp, 'parallel'), raw, jobs=3)
+            serial = read_tree(join(tmp, 'serial'), journal=False)
+            # 2 measurements x 4 months x .json/.data/.bin/3 tiers, the shared
+            # metadata and the catalog
+            self.assertEqual(len(serial), 2 * 4 * 6 + 2)
+            parallel = read_tree(join(tmp, 'parallel'), journal=False)
+            self.assertEqual(serial, parallel)
+
+class TestFlushErrors(RollupTestCase):
+    def test_failed_month_reported_and_not_journaled(self):
+        from w1data import rollup
+        rewrite = rollup.RollupMonthly.rewrite
+        def failing_rewrite(monthly):
+            if monthly.filename.startswith('2020-03-office_water'):
+                raise OSError("disk full")
+            rewrite(monthly)
+        write_raw_tree(self.raw)
+        with mock.patch.object(rollup.RollupMonthly, 'rewrite', failing_rewrite), \
+             self.assertLogs('w1data.rollup', 'ERROR'):
+            report = io.StringIO()
+            self.assertEqual(do_rollup(self.rollups, self.raw, report=report), 74)
+        flushed, failed = report.getvalue().splitlines()
+        self.assertTrue(flushed.startswith("Flushed "))
+        self.assertIn("2020-02-office_water_temperature", flushed)
+        self.assertEqual(failed, "Failed to flush 1 months: 2020-03-office_water_temperature")
+        written = read_tree(self.rollups)
+        self.assertIn('office_water_temperature/2020-02-office_water_temperature.json', written)
+        self.assertNotIn('office_water_temperature/2020-03-office_water_temperature.json', written)
+        self.assertNotIn('INGEST_JOURNAL.log', written)
+
+    def test_failed_eviction_reported_and_retried(self):
+        from w1data import rollup
+        rewrite = rollup.RollupMonthly.rewrite
+        failures = {'2020-02-office_water': 1, '2020-03-office_water': 100}
+        def failing_rewrite(monthly):
+            for prefix, left in failures.items():
+                if monthly.filename.startswith(prefix) and left:
+                    failures[prefix] -= 1
+                    raise OSError("disk full")
+            rewrite(monthly)
+        write_raw_tree(self.raw)
+        with mock.patch.object(rollup.RollupMonthly, 'rewrite', failing_rewrite), \
+             self.assertLogs('w1data.rollup', 'ERROR'):
+            report = io.StringIO()
+            self.assertEqual(do_rollup(self.rollups, self.raw, max_months=1, report=report), 74)
+        flushed, failed = report.getvalue().splitlines()
+        self.assertEqual(failures['2020-02-office_water'], 0)
+        # 2020-02 water failed when evicted and was written by the final flush
+        self.assertEqual(flushed, "Flushed 5 months: " + ", ".join(
+            "2020-0{}-office_{}_temperature".format(month, sensor)
+            for month, sensor in ((2, 'air'), (2, 'water'), (3, 'air'), (4, 'air'), (4, 'water'))))
+        self.assertEqual(failed, "Failed to flush 1 months: 2020-03-office_water_temperature")
+        written = read_tree(self.rollups)
+        self.assertIn('office_water_temperature/2020-02-office_water_temperature.json', written)
+        self.assertNotIn('office_water_temperature/2020-03-office_water_temperature.json', written)
+
+class TestBoundedRollup(unittest.TestCase):
+    def test_evicting_matches_unbounded(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            raw = join(tmp, 'raw')
+            write_raw_tree(raw, files=200, step=12 * 3600)
+            os.makedirs(join(tmp, 'unbounded'))
+            os.makedirs(join(tmp, 'bounded'))
+            do_rollup(join(tmp, 'unbounded'), raw)
+            bounded = RollupMonthlyCollection(join(tmp, 'bounded'), max_months=1)
+            for batch in Observations(raw).generate_all_batches(batch_size=7):
+                bounded.save_batch(batch)
+                self.assertLessEqual(len(bounded.resident), 1)
+            bounded.flush()
+            self.assertGreater(bounded.evictions, 0)
+            expected = read_tree(join(tmp, 'unbounded'), journal=False)
+            self.assertEqual(read_tree(join(tmp, 'bounded')), expected)
+
+    def test_files_read_in_time_order(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            raw = join(tmp, 'raw')
+            write_raw_tree(raw, files=200, step=12 * 3600)  # 2 measurements x Feb - May 2020
+            os.makedirs(join(tmp, 'rollups'))
+            bounded = RollupMonthlyCollection(join(tmp, 'rollups'), max_months=2)
+            for batch in Observations(raw).generate_all_batches(batch_size=7):
+                bounded.save_batch(batch)
+            bounded.flush()
+            self.assertEqual(bounded.evictions, 2 * 4 - 2)  # each month evicted once, when done
+
+class TestIncrementalRollup(RollupTestCase):
+    def test_late_data_merges_into_old_month(self):
+        from w1datalogger.simulator import w1_slave_text
+        self.roll_up_raw_tree()  # Feb - Apr 2020
+        feb = join(self.rollups, 'office_air_temperature', '2020-02-office_air_temperature.json')
+        mar = join(self.rollups, 'office_air_temperature', '2020-03-office_air_temperature.json')
+        with open(feb) as f:
+            feb_rows = json.load(f)['rows']
+        os.utime(mar, ns=(0, 0))
+
+        # Buffered scan from February, uploaded in May
+        late = {"scan_start": "2020-02-10T00:00:00.000+00:00", "datapoints": [
+            {"isotime": "2020-02-10T00:00:00.000+00:00", "key": "28-011912588b87/w1_slave",
+             "value": w1_slave_text(1.5)}]}
+        with open(join(self.raw, 'observername', '2020-05-01T00:00:00+00:00;late.json'), 'w') as f:
+            json.dump([late], f)
+        do_rollup(self.rollups, self.raw)
+
+        with open(feb) as f:
+            rows = json.load(f)['rows']
+        self.assertEqual(len(rows), len(feb_rows) + 1)
+        self.assertIn(["2020-02-10T00:00:00+00:00", 1.5], rows)
+        self.assertEqual(os.stat(mar).st_mtime_ns, 0)  # untouched
+
+    def test_same_time_from_another_event_is_one_row(self):
+        filenames = self.roll_up_raw_tree(files=3)
+        # The same scan posted again, as a new event, in this run and the last
+        with open(filenames[1]) as f:
+            scans = json.load(f)
+        for event in ("retry-1", "retry-2"):
+            scans[0]["recording_event"] = event
+            with open(filenames[1].replace("event-1", event), "w") as f:
+                json.dump(scans, f)
+        do_rollup(self.rollups, self.raw)
+        times, _ = RollupReader(self.rollups).rows('office_air_temperature')
+        self.assertEqual(len(times), 3)
+
+    def test_unread_file_ingested_next_time(self):
+        from w1data import observations
+        filenames = write_raw_tree(self.raw)
+        real_open = open
+        def failing_open(filename, *args):
+            if filename == filenames[3]:
+                raise OSError("I/O error")
+            return real_open(filename, *args)
+        with mock.patch.object(observations, 'open', failing_open, create=True), \
+             self.assertLogs('w1data.observations', 'ERROR'):
+            do_rollup(self.rollups, self.raw)
+        self.assertEqual(len(RollupReader(self.rollups).rows('office_air_temperature')[0]), 39)
+        do_rollup(self.rollups, self.raw)
+        self.assertEqual(len(RollupReader(self.rollups).rows('office_air_temperature')[0]), 40)
+
+    def test_journal_appends_then_compacts(self):
+        from w1data.journal import IngestJournal
+        filenames = write_raw_tree(self.raw, files=6)
+        journal = IngestJournal(self.rollups, self.raw)
+        for filename in filenames[:2]:
+            self.assertTrue(journal.is_new(filename))
+            journal.ingested(filename)
+        self.assertTrue(journal.is_new(filenames[2]))  # listed, never read
+        journal.commit()
+        with open(join(self.rollups, 'INGEST_JOURNAL.log'), 'a') as f:
+            f.write('["torn", [1')  # a commit that died part way
+
+        journal = IngestJournal(self.rollups, self.raw)
+        self.assertEqual([journal.is_new(f) for f in filenames[:3]], [False, False, True])
+        with mock.patch.object(IngestJournal, 'compact_lines', 3):
+            for filename in filenames[2:]:
+                journal.is_new(filename)
+                journal.ingested(filename)
+            journal.commit()
+        self.assertFalse(os.path.exists(join(self.rollups, 'INGEST_JOURNAL.log')))
+        journal = IngestJournal(self.rollups, self.raw)
+        self.assertEqual(sorted(journal.files), sorted(os.path.relpath(f, self.raw) for f in filenames))
+
+class TestWatch(RollupTestCase):
+    def wait_for(self, filename, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not os.path.exists(filename):
+            self.assertLess(time.monotonic(), deadline, "no {}".format(filename))
+            time.sleep(0.05)
+
+    def test_new_raw_file_is_rolled_up(self):
+        from w1data.watch import RollupWatcher
+        from w1datalogger.simulator import w1_slave_text
+        write_raw_tree(self.raw)  # Feb - Apr 2020
+        watcher = RollupWatcher(self.rollups, self.raw, debounce=0.1)
+        thread = threading.Thread(target=watcher.run)
+        thread.start()
+        try:
+            measurement = join(self.rollups, 'office_air_temperature')
+            self.wait_for(join(measurement, '2020-04-office_air_temperature.json'))
+            mar = join(measurement, '2020-03-office_air_temperature.json')
+            os.utime(mar, ns=(0, 0))
+
+            scan = {"scan_start": "2020-06-01T00:00:00.000+00:00", "datapoints": [
+                {"isotime": "2020-06-01T00:00:00.000+00:00", "key": "28-011912588b87/w1_slave",
+                 "value": w1_slave_text(2.5)}]}
+            with open(join(self.raw, 'observername', '.upload'), 'w') as f:
+                json.dump([scan], f)
+            os.rename(join(self.raw, 'observername', '.upload'),
+                      join(self.raw, 'observername', '2020-06-01T00:00:00+00:00;new.json'))
+            self.wait_for(join(measurement, '2020-06-office_air_temperature.json'))
+        finally:
+            watcher.stop()
+            thread.join()
+            watcher.close()
+        with open(join(measurement, '2020-06-office_air_temperature.json')) as f:
+            self.assertEqual(json.load(f)['rows'], [["2020-06-01T00:00:00+00:00", 2.5]])
+        self.assertEqual(os.stat(mar).st_mtime_ns, 0)  # untouched
+        self.assertGreaterEqual(watcher.ingests, 2)
+        self.assertEqual(watcher.collection.max_months, RollupWatcher.default_max_months)
+
+    def test_ingests_during_steady_arrivals(self):
+        import select
+        from w1data import watch
+        write_raw_tree(self.raw, files=0)
+        endpoint = join(self.raw, 'observername')
+        watcher = watch.RollupWatcher(self.rollups, self.raw, debounce=0.05)
+
+        # An event is always waiting, as in a long backfill
+        class BusyInotify:
+            fd = -1
+            def add_watch(self, dirname, mask):
+                pass
+            def read(self):
+                yield endpoint, "2020-06-01T00:00:00+00:00;e{}.json".format(time.monotonic_ns()), watch.IN_MOVED_TO
+            def close(self):
+                pass
+        real_select = select.select
+        def busy_select(rlist, wlist, xlist, timeout=None):
+            stopping, _, _ = real_select([watcher._stop_r], [], [], 0)
+            time.sleep(0.001)
+            return stopping or [BusyInotify.fd], [], []
+
+        with mock.patch.object(watch, 'Inotify', BusyInotify), \
+             mock.patch.object(watch.select, 'select', busy_select):
+            thread = threading.Thread(target=watcher.run)
+            thread.start()
+            try:
+                deadline = time.monotonic() + 5
+                while watcher.ingests < 3:
+                    self.assertLess(time.monotonic(), deadline, "nothing ingested while events arrive")
+                    time.sleep(0.01)
+            finally:
+                watcher.stop()
+                thread.join()
+                watcher.close()
+
+    def test_bad_file_skipped_and_not_journaled(self):
+        from w1data.watch import RollupWatcher
+        write_raw_tree(self.raw)
+        endpoint = join(self.raw, 'observername')
+        bad = join(endpoint, '2020-03-05T00:00:00+00:00;bad.json')
+        with open(bad, 'w') as f:
+            json.dump([{"datapoints": [{"isotime": "2020-03-05T00:00:00Z", "value": "no key"}]}], f)
+        watcher = RollupWatcher(self.rollups, self.raw)
+        watcher.pending[endpoint] = None
+        with self.assertLogs('w1data.watch', 'ERROR'):
+            watcher.ingest()
+        watcher.close()
+        self.assertEqual(len(RollupReader(self.rollups).rows('office_air_temperature')[0]), 40)
+        journaled = watcher.journal.files
+        self.assertEqual(len(journaled), 40)
+        self.assertNotIn(os.path.relpath(bad, self.raw), journaled)
+
+class TestCatalog(RollupTestCase):
+    def test_startup_from_catalog(self):
+        from w1data import rollup
+        self.roll_up_raw_tree()
+        with open(join(self.rollups, 'CATALOG.json')) as f:
+            months = json.load(f)['months']
+        self.assertEqual(len(months), 2 * 3)
+        feb = months['office_air_temperature/2020-02-office_air_temperature.json']
+        self.assertEqual((feb['rows'], feb['first'], feb['last']),
+                         (14, "2020-02-02T21:45:00+00:00", "2020-02-28T21:45:00+00:00"))
+
+        with mock.patch.object(rollup.os, 'scandir', side_effect=AssertionError("scanned")):
+            collection = RollupMonthlyCollection(self.rollups)
+        self.assertEqual(collection.collection, {})
+
+        # Readers list months from the catalog
+        from w1data import query
+        with mock.patch.object(query.os, 'listdir', side_effect=AssertionError("listed")), \
+             mock.patch.object(query.os, 'scandir', side_effect=AssertionError("scanned")):
+            reader = RollupReader(self.rollups)
+            self.assertEqual(reader.measurements(), ['office_air_temperature', 'office_water_temperature'])
+            self.assertEqual(reader.months('office_air_temperature', isotime_ns("2020-03-10T00:00:00Z")),
+                             [(2020, 3), (2020, 4)])
+
+        os.unlink(join(self.rollups, 'CATALOG.json'))
+        do_rollup(self.rollups, self.raw, rescan=True)
+        with open(join(self.rollups, 'CATALOG.json')) as f:
+            self.assertEqual(json.load(f)['months'], months)
+
+    def test_writers_merge_entries(self):
+        first, second = RollupMonthlyCollection(self.rollups), RollupMonthlyCollection(self.rollups)
+        for collection, month in ((first, 2), (second, 3)):
+            collection.get_monthly((2020, month, 'office_air_temperature')).add_row(
+                isotime_ns("2020-0{}-10T00:00:00Z".format(month)), "e", 1.5, {})
+        first.flush()
+        second.flush()
+        self.assertEqual(RollupReader(self.rollups).months('office_air_temperature'), [(2020, 2), (2020, 3)])
+
+class TestRollupWrite(RollupTestCase):
+    def test_failed_rewrite_keeps_old_rollup(self):
+        from w1data import rollup
+        self.roll_up_raw_tree()
+        measurement_dir = join(self.rollups, 'office_air_temperature')
+        before = read_tree(measurement_dir)
+
+        month = RollupMonthlyCollection(self.rollups).get_monthly((2020, 2, 'office_air_temperature'))
+        month.add_row(isotime_ns("2020-02-10T00:00:00Z"), "late", 1.5, {})
+        isoformat = rollup.ns_isoformat
+        calls = []
+        def failing_isoformat(t):
+            calls.append(t)
+            if len(calls) > 5:
+                raise OSError("disk full")
+            return isoformat(t)
+        with mock.patch.object(rollup, 'ns_isoformat', failing_isoformat):
+            with self.assertLogs('w1data.rollup', 'ERROR'), self.assertRaises(OSError):
+                month.flush()
+        self.assertEqual(read_tree(measurement_dir), before)
+
+        # Retried, the new row is merged in order
+        month.flush()
+        with open(join(measurement_dir, month.filename)) as f:
+            times = [isotime_ns(t) for t, _ in json.load(f)['rows']]
+        self.assertIn(isotime_ns("2020-02-10T00:00:00Z"), times)
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(len(times), len(set(times)))
+
+    def test_files_readable_like_open(self):
+        import stat
+        from w1data import segments
+        umask = os.umask(0o022)
+        os.umask(umask)
+        write_raw_tree(self.raw)
+        segments.compact_dir(join(self.raw, 'observername'),
+                             time_from_filename=Observations.time_from_filename)
+        do_rollup(self.rollups, self.raw)
+        written = [join(dirpath, name) for top in (self.raw, self.rollups)
+                   for dirpath, _, names in os.walk(top) for name in names]
+        self.assertEqual({stat.S_IMODE(os.stat(f).st_mode) for f in written}, {0o666 & ~umask})
+
+class TestRollupMetadata(RollupTestCase):
+    def test_metadata_stored_once_by_id(self):
+        self.roll_up_raw_tree()
+        stored = os.listdir(join(self.rollups, 'METADATA'))
+        self.assertEqual(len(stored), 1)
+        feb = join(self.rollups, 'office_air_temperature', '2020-02-office_air_temperature.json')
+        with open(feb) as f:
+            blob = json.load(f)
+        self.assertEqual(blob['metadata'], [["2020-02-02T21:45:00+00:00", stored[0][:-5]]])
+
+        # A rollup with metadata inline is rewritten by id when it's touched
+        content = MetadataStore(self.rollups).load(stored[0][:-5]).content
+        blob['metadata'][0][1] = content
+        with open(feb, 'w') as f:
+            json.dump(blob, f)
+        late = RollupMonthlyCollection(self.rollups)
+        late.get_monthly((2020, 2, 'office_air_temperature')).add_row(
+            isotime_ns("2020-02-10T00:00:00Z"), "late", 1.5, content)
+        late.flush()
+        with open(feb) as f:
+            self.assertEqual(json.load(f)['metadata'], [["2020-02-02T21:45:00+00:00", stored[0][:-5]]])
+
+class TestColumnar(RollupTestCase):
+    def test_columns_match_json(self):
+        self.roll_up_raw_tree()
+        month = RollupMonthlyCollection(self.rollups).get_monthly((2020, 3, 'office_water_temperature'))
+        with open(join(self.rollups, 'office_water_temperature', month.filename)) as f:
+            rows = json.load(f)['rows']
+        with month.open_columns() as columns:
+            self.assertEqual(len(columns), len(rows))
+            self.assertEqual(list(columns.time_ns), [isotime_ns(t) for t, _ in rows])
+            self.assertEqual(list(columns.values), [v for _, v in rows])
+
+    def test_aggregate_tiers(self):
+        base = isotime_ns("2020-02-01T00:00:00Z")
+        minute = 60 * 10**9
+        times = [base + i * minute for i in range(150)]  # 00:00 - 02:29
+        values = [float(i) for i in range(150)]
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = join(tmp, '2020-02-m.json')
+            pyramid.write_month(filename, times, values)
+            with pyramid.open_month(filename, '1h') as hours:
+                self.assertEqual(list(hours.start_ns), [base, base + 60 * minute, base + 120 * minute])
+                self.assertEqual(list(hours.count), [60, 60, 30])
+                self.assertEqual(list(hours.min), [0.0, 60.0, 120.0])
+                self.assertEqual(list(hours.max), [59.0, 119.0, 149.0])
+                self.assertEqual(list(hours.mean), [29.5, 89.5, 134.5])
+            with pyramid.open_month(filename, '5m') as fives:
+                self.assertEqual(len(fives), 30)
+            with pyramid.open_month(filename, '1d') as days:
+                self.assertEqual((list(days.count), list(days.mean)), ([150], [74.5]))
+
+    def test_empty(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = join(tmp, 'empty.bin')
+            columnar.write_columns(filename, [], [])
+            with columnar.open_columns(filename) as columns:
+                self.assertEqual(list(columns.time_ns), [])
+
+class TestQuery(RollupTestCase):
+    def test_range_and_cache(self):
+        self.roll_up_raw_tree()  # a scan every 2 days from 2020-02-02T21:45
+        reader = RollupReader(self.rollups)
+        self.assertEqual(reader.measurements(), ['office_air_temperature', 'office_water_temperature'])
+        since, until = isotime_ns("2020-02-20T00:00:00Z"), isotime_ns("2020-03-10T00:00:00Z")
+        times, values = reader.rows('office_air_temperature', since, until)
+        self.assertEqual(len(times), 10)  # 02-20 .. 03-09
+        self.assertEqual(list(times), sorted(times))
+        self.assertTrue(since <= times[0] and times[-1] < until)
+        self.assertEqual((reader.hits, reader.misses), (0, 2))
+
+        reader.rows('office_air_temperature', since, until)
+        self.assertEqual((reader.hits, reader.misses), (2, 2))
+
+        # A rewritten month is read again
+        month = RollupMonthlyCollection(self.rollups).get_monthly((2020, 3, 'office_air_temperature'))
+        month.add_row(isotime_ns("2020-03-01T00:00:00Z"), "late", 1.5, {})
+        month.flush()
+        times, values = reader.rows('office_air_temperature', since, until)
+        self.assertEqual(len(times), 11)
+        self.assertIn(1.5, values)
+        self.assertEqual((reader.hits, reader.misses), (3, 3))
+
+        starts, counts, mins, maxes, means = reader.aggregates('office_air_temperature', '1d', since, until)
+        self.assertEqual(sum(counts), 11)
+
+    def test_stale_columns_not_used(self):
+        self.roll_up_raw_tree()
+        month = RollupMonthlyCollection(self.rollups).get_monthly((2020, 3, 'office_air_temperature'))
+        month.add_row(isotime_ns("2020-03-01T00:00:00Z"), "late", 1.5, {})
+        # The .bin couldn't be rewritten, so it's older than the .json
+        with mock.patch.object(columnar, 'write_columns', side_effect=OSError("disk full")), \
+             self.assertLogs('w1data.rollup', 'WARNING'):
+            month.flush()
+        json_filename = join(self.rollups, 'office_air_temperature', month.filename)
+        st = os.stat(json_filename)
+        os.utime(month.columns_filename, ns=(st.st_atime_ns, st.st_mtime_ns - 10**9))
+        times, values = RollupReader(self.rollups).month_rows('office_air_temperature', 2020, 3)
+        self.assertIn(1.5, values)
+        self.assertEqual(list(times), sorted(times))
+
+class TestExport(RollupTestCase):
+    def test_as_of(self):
+        values = export.as_of([5, 10, 15, 30], [0, 10, 20], [1.0, 2.0, 3.0], tolerance_ns=6)
+        self.assertEqual(list(values)[:3], [1.0, 2.0, 2.0])
+        self.assertNotEqual(values[3], values[3])  # 10 ns stale: NaN
+
+    def test_default_tolerance_is_a_week(self):
+        day = 86400 * 10**9
+        class Reader:
+            rows_by_measurement = {'a': [10 * day, 20 * day], 'b': [0, 15 * day]}
+            def rows(self, measurement, since=None, until=None):
+                times = [t for t in self.rows_by_measurement[measurement]
+                         if (since is None or t >= since) and (until is None or t < until)]
+                return times, [float(t // day) for t in times]
+        _, (a, b) = export.align(Reader(), ['a', 'b'])
+        self.assertNotEqual(b[0], b[0])  # 10 days stale: NaN
+        self.assertEqual(b[1], 15.0)
+
+    def test_grid_csv(self):
+        self.roll_up_raw_tree()  # both sensors every 2 days at 21:45
+        measurements = ['office_air_temperature', 'office_water_temperature']
+        day = 86400 * 10**9
+        time_ns, columns = export.align(
+            RollupReader(self.rollups), measurements, isotime_ns("2020-03-02T00:00:00Z"),
+            isotime_ns("2020-03-06T00:00:00Z"), grid_ns=day, tolerance_ns=day)
+        out = io.StringIO()
+        export.write_csv(out, measurements, time_ns, columns)
+        self.assertEqual(out.getvalue().splitlines(), [
+            "time,office_air_temperature,office_water_temperature",
+            "2020-03-02T00:00:00+00:00,15.875,39.125",
+            "2020-03-03T00:00:00+00:00,,",
+            "2020-03-04T00:00:00+00:00,15.9375,39.0625",
+            "2020-03-05T00:00:00+00:00,,"])
+
+class TestTimeRange(unittest.TestCase):
+    def test_filename_pruning(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            raw = join(tmp, 'raw')
+            write_raw_tree(raw)  # a file every 2 days from 2020-02-02T21:45
+            observations = Observations(raw)
+            march = (isotime_ns("2020-03-01T00:00:00Z"), isotime_ns("2020-04-01T00:00:00Z"))
+            names = observations.dir_files(join(raw, 'observername'), *march)
+            times = sorted(Observations.time_from_filename(n) for n in names)
+            self.assertEqual(len(names), 16)  # 03-01 .. 03-31, plus 04-01 within a day's slack
+            self.assertGreaterEqual(times[0], march[0])
+            self.assertLess(times[-1], march[1] + Observations.default_slack_ns)
+            observed = list(observations.generate_all(*march))
+            self.assertEqual(len(observed), 2 * 16)
+
+class TestObjectStore(unittest.TestCase):
+    def test_s3_matches_local(self):
+        from w1data.objectstore import LocalObjectStore, CachingObjectStore
+        with tempfile.TemporaryDirectory() as tmp:
+            bucket = join(tmp, 'buckets', 'observations')
+            write_raw_tree(bucket)
+            os.makedirs(join(tmp, 'local'))
+            os.makedirs(join(tmp, 's3'))
+            do_rollup(join(tmp, 'local'), bucket)
+            store = CachingObjectStore(LocalObjectStore(join(tmp, 'buckets', 'observations')), join(tmp, 'cache'))
+            do_rollup(join(tmp, 's3'), 's3://observations', store=store)
+            local, s3 = read_tree(join(tmp, 'local'), journal=False), read_tree(join(tmp, 's3'), journal=False)
+            self.assertEqual(local, s3)
+            self.assertEqual(len(os.listdir(join(tmp, 'cache', 'observername'))), 40)
+
+            # March only, plus a file not named by time. Listing starts a
+            # day (the slack) before March, not at the first key
+            with open(join(bucket, 'observername', 'manual.json'), 'w') as f:
+                f.write('[]')
+            observations = Observations('s3://observations', store=store)
+            with mock.patch.object(store.store, 'list', wraps=store.store.list) as listing:
+                march = observations.dir_files('s3://observations/observername',
+                                               isotime_ns("2020-03-01T00:00:00Z"), isotime_ns("2020-04-01T00:00:00Z"))
+            listing.assert_called_once_with('observername/', 'observername/2020-02-29T00:00:00')
+            self.assertEqual(len(march), 17)
+            self.assertTrue(march[0].startswith('s3://observations/observername/2020-03-'))
+            self.assertEqual(march[-1], 's3://observations/observername/manual.json')
+
+    def test_fetch_error_skips_file_until_next_run(self):
+        from w1data.objectstore import LocalObjectStore
+        with tempfile.TemporaryDirectory() as tmp:
+            bucket, rollups = join(tmp, 'observations'), join(tmp, 'rollups')
+            filenames = write_raw_tree(bucket)
+            os.makedirs(rollups)
+            store = LocalObjectStore(bucket)
+            get = store.get
+            def failing_get(key):
+                if key == os.path.relpath(filenames[3], bucket):
+                    raise ConnectionError("endpoint unreachable")
+                return get(key)
+            with mock.patch.object(store, 'get', failing_get), \
+                 self.assertLogs('w1data.objectstore', 'ERROR'):
+                do_rollup(rollups, 's3://observations', store=store)
+            self.assertEqual(len(RollupReader(rollups).rows('office_air_temperature')[0]), 39)
+            do_rollup(rollups, 's3://observations', store=store)
+            self.assertEqual(len(RollupReader(rollups).rows('office_air_temperature')[0]), 40)
+
+class TestSegments(RollupTestCase):
+    def test_compacted_rollup_matches_loose(self):
+        from w1data import segments
+        for compress in (False, True):
+            with tempfile.TemporaryDirectory() as tmp:
+                raw = join(tmp, 'raw')
+                write_raw_tree(raw)
+                os.makedirs(join(tmp, 'loose'))
+                os.makedirs(join(tmp, 'packed'))
+                do_rollup(join(tmp, 'loose'), raw)
+
+                endpoint = join(raw, 'observername')
+                packed = segments.compact_dir(endpoint, "month", compress)
+                self.assertEqual(packed, 40)
+                self.assertEqual(sorted(f for f in os.listdir(endpoint) if not f.endswith('.idx')),
+                                 ['METADATA.json'] + ['SEGMENT-2020-0{}.jsonl{}'.format(m, '.gz' if compress else '')
+                                                      for m in (2, 3, 4)])
+                do_rollup(join(tmp, 'packed'), raw)
+                loose, packed = read_tree(join(tmp, 'loose'), journal=False), read_tree(join(tmp, 'packed'), journal=False)
+                self.assertEqual(loose, packed)
+
+    def test_rollup_during_append_sees_packed_files_later(self):
+        from w1data import segments
+        write_raw_tree(self.raw)
+        endpoint = join(self.raw, 'observername')
+        segments.compact_dir(endpoint, time_from_filename=Observations.time_from_filename)
+        do_rollup(self.rollups, self.raw)
+        for filename in write_raw_tree(join(self.tmp, 'more'), files=45)[-5:]:
+            os.rename(filename, join(endpoint, os.path.basename(filename)))
+
+        # A rollup reads the endpoint dir after the new files' data is
+        # appended but before the index that commits it is written, and
+        # (being slower) after the loose copies are gone
+        write_index = segments._write_index
+        def racing_write_index(segment_filename, index):
+            hidden = join(self.tmp, 'more', 'observername')
+            loose = [f for f in os.listdir(endpoint) if f.startswith('2020-')]
+            for name in loose:
+                os.rename(join(endpoint, name), join(hidden, name))
+            do_rollup(self.rollups, self.raw)
+            for name in loose:
+                os.rename(join(hidden, name), join(endpoint, name))
+            write_index(segment_filename, index)
+        with mock.patch.object(segments, '_write_index', racing_write_index):
+            segments.compact_dir(endpoint, time_from_filename=Observations.time_from_filename)
+        do_rollup(self.rollups, self.raw)
+        self.assertEqual(len(RollupReader(self.rollups).rows('office_air_temperature')[0]), 45)
+
+    def test_appended_segment_read_from_where_it_left_off(self):
+        from w1data import segments
+        read_segment = segments.read_segment
+        for compress in (False, True):
+            raw, rollups = join(self.tmp, str(compress), 'raw'), join(self.tmp, str(compress), 'rollups')
+            os.makedirs(rollups)
+            write_raw_tree(raw)
+            endpoint = join(raw, 'observername')
+            segments.compact_dir(endpoint, compress=compress)
+            do_rollup(rollups, raw)
+            for filename in write_raw_tree(join(self.tmp, str(compress), 'more'), files=45)[-5:]:
+                os.rename(filename, join(endpoint, os.path.basename(filename)))
+            segments.compact_dir(endpoint, compress=compress)
+
+            parsed = list()
+            def counting_read_segment(segment_filename, start=0):
+                for name, blob in read_segment(segment_filename, start):
+                    parsed.append(name)
+                    yield name, blob
+            with mock.patch.object(segments, 'read_segment', counting_read_segment):
+                do_rollup(rollups, raw)
+            self.assertEqual(len(parsed), 5)
+            self.assertEqual(len(RollupReader(rollups).rows('office_air_temperature')[0]), 45)
+
+            # Not at a packed file's start: the whole segment is read
+            april = join(endpoint, 'SEGMENT-2020-04.jsonl' + ('.gz' if compress else ''))
+            with self.assertLogs('w1data.segments', 'WARNING'):
+                self.assertEqual(len(list(read_segment(april, 7))), len(segments.read_index(april)["files"]))
+
+class TestIsotime(unittest.TestCase):
+    def test_isotime_ns(self):
+        self.assertEqual(isotime_ns("2020-02-05T05:35:02.233+00:00"), 1580880902233000000)
+        self.assertEqual(isotime_ns("2020-02-05T05:35:02Z"), 1580880902000000000)
+        # Not the fast path: offset other than UTC
+        self.assertEqual(isotime_ns("2020-02-04T21:35:02.233-08:00"), 1580880902233000000)
+        # Past ns, truncated, still an int
+        self.assertEqual(isotime_ns("2020-02-05T05:35:02.1234567899Z"), 1580880902123456789)
+        for garbage in ("2020-02-05T25:35:02Z", "2020-02-05T05:99:02Z", "2020-02-05T05:35:02.-5Z",
+                        "2020-02-05T05:35:02.5xZ"):
+            with self.assertRaises(ValueError):
+                isotime_ns(garbage)
+
+class TestStreamingJson(unittest.TestCase):
+    def test_chunk_boundaries(self):
+        doc = [{"datapoints": [{"key": "a", "value": "x,]"}]}, 1.5, -2e10, "s", []]
+        for chunk_size in (1, 2, 5, 4096):
+            self.assertEqual(list(iter_json_array(io.StringIO(json.dumps(doc)), chunk_size)), doc)
+        self.assertEqual(list(iter_json_array(io.StringIO(' {"k": 1}'))), [{"k": 1}])
+
+    def test_truncated_file_keeps_complete_scans(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = join(tmp, "2020-02-05T05:35:02Z;e.json")
+            with open(filename, "w") as f:
+                f.write('[{"datapoints": []}, {"datapoints": []}, {"datap')
+            (name, scans), = Observations(tmp).read_files([filename])
+            with self.assertLogs('w1data.observations', 'ERROR'):
+                self.assertEqual(list(scans), [{"datapoints": []}] * 2)
+
+    def test_process_w1logger_file(self):
+        with open(join(t_dir, 'one_observation', 'observername', 'METADATA.json')) as f:
+            metadata = json.load(f)
+        value = "41 01 4b 46 7f ff 0c 10 ff : crc=ff YES\n41 01 4b 46 7f ff 0c 10 ff t=20062\n"
+        doc = [{"uptime": "1 day"},
+               {"scan_start": "2020-02-05T05:35:02Z", "recording_event": "e1", "datapoints": [
+                   {"key": "28-011912588b87/w1_slave", "value": value}]},
+               {"datapoints": [{"isotime": "2020-02-05T05:36:02Z", "key": "28-011912588b87/w1_slave",
+                                "value": value}]}]
+        observations = Observations(t_dir)
+        observations.process_w1logger_file(io.StringIO(json.dumps(doc)), metadata)
+        first, second = observations.observations['28-011912588b87/w1_slave']
+        self.assertEqual((first.uuid, first.datapoint.value), ("e1", 20.0625))
+        self.assertEqual(first.year_month_measurement(), (2020, 2, 'office_air_temperature'))
+        self.assertEqual(second.time_key, isotime_ns("2020-02-05T05:36:02Z") / 1e9)
+        self.assertIsInstance(second.uuid, str)
+
+class TestW1therm(RollupTestCase):
+    good = "41 01 4b 46 7f ff 0c 10 ff : crc=ff YES\n41 01 4b 46 7f ff 0c 10 ff t=20062\n"
+    no_t = "03 01 4b 46 7f ff 0c 10 30 : crc=30 YES\n"
+    bad_crc = "45 01 4b 46 7f ff 0c 10 ff : crc=ff YES\n45 01 4b 46 7f ff 0c 10 ff t=20312\n"
+
+    def test_decode_batch(self):
+        temps, crc_ok = W1Datapoint_Linux_w1therm.decode_batch([self.good, self.no_t, self.bad_crc])
+        self.assertEqual(list(temps), [20.0625, 16.1875, 20.3125])
+        self.assertEqual(list(crc_ok), [1, 1, 0])
+
+    def test_decode_batch_malformed(self):
+        temps, crc_ok = W1Datapoint_Linux_w1therm.decode_batch([self.good, "garbage"])
+        self.assertEqual(temps[0], 20.0625)
+        self.assertNotEqual(temps[1], temps[1])  # NaN
+        self.assertEqual(list(crc_ok), [1, 0])
+
+    def test_datapoint_without_t_line(self):
+        self.assertEqual(W1Datapoint_Linux_w1therm(self.no_t).value, 16.1875)
+
+    def test_corrupt_scratchpad_not_rolled_up(self):
+        write_raw_tree(self.raw, files=0)
+        scans = [{"datapoints": [{"isotime": isotime, "key": "28-011912588b87/w1_slave", "value": value}]}
+                 for isotime, value in (("2020-02-05T05:35:02Z", self.good),
+                                        ("2020-02-05T05:36:02Z", self.bad_crc))]
+        with open(join(self.raw, 'observername', '2020-02-05T05:36:02Z;e.json'), 'w') as f:
+            json.dump(scans, f)
+        do_rollup(self.rollups, self.raw)
+        times, values = RollupReader(self.rollups).rows('office_air_temperature')
+        self.assertEqual((list(times), list(values)), ([isotime_ns("2020-02-05T05:35:02Z")], [20.0625]))
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.outbox = Outbox(self.tmp.name, batch_size=2)
+        for i in range(5):
+            self.outbox.append({"scan_start": "2020-02-02T21:45:0{}.000+00:00".format(i)})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_drain_batches(self):
+        batches = []
+        self.assertEqual(self.outbox.drain(batches.append), 5)
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+        self.assertEqual(batches[0][0]["scan_start"], "2020-02-02T21:45:00.000+00:00")
+        self.assertEqual(self.outbox.pending(), [])
+
+    def test_failed_post_keeps_spool(self):
+        def post(batch):
+            raise IOError("uplink down")
+        self.assertEqual(self.outbox.drain(post), 0)
+        self.assertEqual(len(self.outbox.pending()), 5)
+
+class TestW1LoggerRead(unittest.TestCase):
+    value = "41 01 4b 46 7f ff 0c 10 ff : crc=ff YES\n41 01 4b 46 7f ff 0c 10 ff t=20062\n"
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.sysfs = join(self.tmp.name, 'sys')
+        self.devices = join(self.sysfs, 'bus/w1/devices')
+        self.drivers = join(self.sysfs, 'bus/w1/drivers/w1_slave_driver')
+        os.makedirs(self.drivers)
+        for n in range(3):
+            device = '28-00000000000{}'.format(n)
+            os.makedirs(join(self.devices, device))
+            with open(join(self.devices, device, 'w1_slave'), 'w') as f:
+                f.write(self.value)
+            os.symlink(join(self.devices, device), join(self.drivers, device))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def w1logger(self, **config):
+        config_filename = join(self.tmp.name, 'datalogger.json')
+        config.update({"Post": "http://localhost/", "Spool": join(self.tmp.name, 'spool'),
+                       "SysfsRoot": self.sysfs})
+        with open(config_filename, 'w') as f:
+            json.dump(config, f)
+        return W1Logger(Config(config_filename))
+
+    def test_serial_read(self):
+        w1logger = self.w1logger()
+        datapoints = w1logger.ReadDatapoints(w1logger.W1Datapoints())
+        self.assertEqual([d['key'] for d in datapoints],
+                         ['28-00000000000{}/w1_slave'.format(n) for n in range(3)])
+        self.assertEqual(datapoints[0]['value'], self.value)
+
+    def test_hung_device_skipped(self):
+        hung = join(self.devices, '28-000000000001', 'w1_slave')
+        os.unlink(hung)
+        os.mkfifo(hung)  # open() blocks forever: no writer
+        w1logger = self.w1logger(ReadConcurrency=2, ReadTimeout=0.2)
+        datapoints = w1logger.ReadDatapoints(w1logger.W1Datapoints())
+        self.assertEqual([d['key'] for d in datapoints],
+                         ['28-000000000000/w1_slave', '28-000000000002/w1_slave'])
+
+        # Still hung next scan: skipped, not given another thread
+        threads = threading.active_count()
+        with self.assertLogs('w1datalogger.logger', 'WARNING') as logs:
+            datapoints = w1logger.ReadDatapoints(w1logger.W1Datapoints())
+        self.assertEqual(len(datapoints), 2)
+        self.assertEqual(threading.active_count(), threads)
+        self.assertIn("still stuck", logs.output[0])
+
+    def test_undecodable_device_skipped(self):
+        with open(join(self.devices, '28-000000000001', 'w1_slave'), 'wb') as f:
+            f.write(b"\xff\xfe\n")
+        w1logger = self.w1logger(ReadConcurrency=2)  # no ReadTimeout: waits on every read
+        with self.assertLogs('w1datalogger.logger', 'WARNING'):
+            datapoints = w1logger.ReadDatapoints(w1logger.W1Datapoints())
+        self.assertEqual([d['key'] for d in datapoints],
+                         ['28-000000000000/w1_slave', '28-000000000002/w1_slave'])
+
+    def test_bulk_convert(self):
+        w1logger = self.w1logger(BulkRead=True, Resolution=10)
+        self.assertEqual(w1logger.BulkConvert(), 0)  # no therm_bulk_read: per-device path
+        master = join(self.devices, 'w1_bus_master1')
+        os.makedirs(master)
+        with open(join(master, 'therm_bulk_read'), 'w') as f:
+            f.write("-1\n")
+        with open(join(self.devices, '28-000000000000', 'resolution'), 'w') as f:
+            f.write("12\n")
+        w1logger.SetResolution(10)
+
+        # The kernel's attribute: written "trigger", then reads -1 while
+        # converting and 1 once results are waiting to be read
+        trigger = join(master, 'therm_bulk_read')
+        states, reads = ["-1\n", "1\n"], []
+        real_open = open
+        def fake_open(filename, mode="r"):
+            if filename == trigger and mode == "r":
+                reads.append(states[min(len(reads), len(states) - 1)])
+                return io.StringIO(reads[-1])
+            return real_open(filename, mode)
+        with mock.patch('w1datalogger.logger.open', fake_open, create=True), \
+             self.assertNoLogs('w1datalogger.logger', level='WARNING'):
+            self.assertEqual(w1logger.BulkConvert(), 1)
+        self.assertEqual(reads, states)  # polled through the conversion, stopped on 1
+        with open(trigger) as f:
+            self.assertEqual(f.read(), "trigger\n")
+        with open(join(self.devices, '28-000000000000', 'resolution')) as f:
+            self.assertEqual(f.read(), "10\n")
+
+class TestDaemonSchedule(unittest.TestCase):
+    class Stop(Exception):
+        pass
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.now = 0.0
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def sleep(self, seconds):
+        self.now += seconds
+        if self.now > 60:
+            raise self.Stop()
+
+    def run_schedule(self, **config):
+        config_filename = join(self.tmp.name, 'datalogger.json')
+        config.update({"Post": "http://localhost/", "Spool": join(self.tmp.name, 'spool')})
+        with open(config_filename, 'w') as f:
+            json.dump(config, f)
+        w1logger = W1Logger(Config(config_filename))
+        runs = {"LogW1": [], "LogStatus": [], "Flush": []}
+        def action(name, stall=0):
+            def run():
+                runs[name].append(self.now)
+                if len(runs[name]) == 2:
+                    self.now += stall
+            run.__name__ = name
+            return run
+        w1logger.LogW1 = action("LogW1", stall=35)
+        w1logger.LogStatus = action("LogStatus")
+        w1logger.Flush = action("Flush")
+        scheduler = sched.scheduler(lambda: self.now, self.sleep)
+        w1logger.Schedule(scheduler)
+        with self.assertRaises(self.Stop):
+            scheduler.run()
+        return w1logger, runs
+
+    def test_overrun_skips_missed_ticks(self):
+        w1logger, runs = self.run_schedule(W1Interval=10, StatusInterval=30, FlushInterval=20)
+        self.assertEqual(runs["LogW1"], [0, 10, 45, 50, 60])
+        self.assertEqual(runs["LogStatus"], [0, 45, 60])
+        self.assertFalse(w1logger.flush_on_post)
+
+    def test_zero_flush_interval_flushes_on_post(self):
+        w1logger, runs = self.run_schedule(W1Interval=10, StatusInterval=0, FlushInterval=0)
+        self.assertEqual(runs["LogStatus"], [])
+        self.assertEqual(runs["Flush"], [])
+        self.assertTrue(w1logger.flush_on_post)
+
+    def test_flush_with_spool_locked_elsewhere(self):
+        import fcntl
+        config_filename = join(self.tmp.name, 'datalogger.json')
+        with open(config_filename, 'w') as f:
+            json.dump({"Post": "http://localhost/", "Spool": join(self.tmp.name, 'spool')}, f)
+        w1logger = W1Logger(Config(config_filename))
+        with open(join(self.tmp.name, 'spool', w1logger.outbox.lock_filename), 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            with self.assertLogs('w1datalogger', 'DEBUG') as logs:
+                self.assertIsNone(w1logger.Flush())
+        self.assertNotIn("Sent", " ".join(logs.output))
+
+class TestSimulator(unittest.TestCase):
+    def test_concurrent_scan_posts(self):
+        with tempfile.TemporaryDirectory() as tmp, \
+             SimulatedBus(join(tmp, 'sys'), devices=4, latency=0.3, hung=1, seed=1), \
+             RecordingEndpoint() as endpoint:
+            config_filename = join(tmp, 'datalogger.json')
+            with open(config_filename, 'w') as f:
+                json.dump({"Post": endpoint.url, "Spool": join(tmp, 'spool'), "SysfsRoot": join(tmp, 'sys'),
+                           "ReadConcurrency": 4, "ReadTimeout": 0.6}, f)
+            w1logger = W1Logger(Config(config_filename))
+            w1logger.LogW1()
+            self.assertEqual(len(endpoint.posts), 1)
+            scan = endpoint.posts[0][0]
+            self.assertEqual(len(scan['datapoints']), 3)
+            self.assertIn(' YES\n', scan['datapoints'][0]['value'])
+
+    def test_bulk_read(self):
+        with tempfile.TemporaryDirectory() as tmp, \
+             SimulatedBus(join(tmp, 'sys'), devices=4, latency=0.3, seed=1, bulk_read=True) as bus, \
+             RecordingEndpoint() as endpoint:
+            config_filename = join(tmp, 'datalogger.json')
+            with open(config_filename, 'w') as f:
+                json.dump({"Post": endpoint.url, "Spool": join(tmp, 'spool'), "SysfsRoot": join(tmp, 'sys'),
+                           "ReadConcurrency": 1, "BulkRead": True}, f)
+            w1logger = W1Logger(Config(config_filename))
+            started = time.monotonic()
+            w1logger.LogW1()
+            self.assertLess(time.monotonic() - started, 4 * 0.3)  # one conversion, not one per device
+            self.assertEqual(bus.bulk_conversions, 1)
+            scan = endpoint.posts[0][0]
+            self.assertEqual(len(scan['datapoints']), 4)
+            self.assertTrue(all(' YES\n' in d['value'] for d in scan['datapoints']))
+
+    def test_w1_slave_text(self):
+        from w1datalogger.simulator import w1_slave_text
+        self.assertEqual(w1_slave_text(21.9375),
+                         "5f 01 4b 46 7f ff 0c 10 12 : crc=12 YES\n5f 01 4b 46 7f ff 0c 10 12 t=21937\n")
+        self.assertTrue(w1_slave_text(-10.0625).endswith(" t=-10062\n"))
+        # A corrupt read: crc= is computed from the bytes read, t= decoded from them
+        corrupt = w1_slave_text(21.9375, corrupt=True)
+        first, second = corrupt.splitlines()
+        self.assertTrue(first.startswith("5b 01 4b 46 7f ff 0c 10 12 : crc="))
+        self.assertTrue(first.endswith(" NO"))
+        self.assertNotIn("crc=12", first)
+        self.assertTrue(second.endswith(" t=21687"))
+
+class TestSysStatus(unittest.TestCase):
+    def test_proc_fields(self):
+        with tempfile.TemporaryDirectory() as proc:
+            with open(join(proc, 'loadavg'), 'w') as f:
+                f.write("0.05 0.10 0.04 2/71 4004\n")
+            with open(join(proc, 'meminfo'), 'w') as f:
+                f.write("MemTotal:        6158152 kB\nMemFree:         5084140 kB\nHugePages_Total:       0\n")
+            self.assertEqual(sysstatus.loadavg(proc),
+                             {"1m": 0.05, "5m": 0.10, "15m": 0.04, "running": 2, "threads": 71})
+            self.assertEqual(sysstatus.meminfo(proc),
+                             {"MemTotal": 6158152 * 1024, "MemFree": 5084140 * 1024})
+
+    @unittest.skipUnless(os.path.exists('/proc/net/dev'), "needs Linux /proc")
+    def test_status_is_numeric(self):
+        status = sysstatus.status()
+        self.assertIsInstance(status['uptime'], float)
+        self.assertIn('/', status['filesystems'])
+
 if os.environ.get('DEBUG', None) is not None:
     import logging
     logging.basicConfig(format="%(levelname)s:%(filename)s:%(lineno)d:%(message)s", level=logging.DEBUG)
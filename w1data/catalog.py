@@ -0,0 +1,113 @@
+"""catalog.py
+
+CATALOG.json in a rollup location lists every monthly rollup, so readers
+(see query.py) find the months of a measurement with one small read instead
+of listing every measurement dir:
+
+    {"months": {"<measurement>/<year-month-measurement>.json": {
+        "year": 2020, "month": 2, "measurement": "office_air_temperature",
+        "rows": row count, "first": first row isotime, "last": last row isotime,
+        "sha1": sha1 of the rows' time and value columns as in the .bin file,
+        "sizes": {sibling file suffix: bytes, ...}}}}
+
+The rollup writer notes an entry for each month it rewrites and, at the
+end of each flush, merges them into the file on disk and replaces it
+atomically. The merge happens under an flock on the rollup location, so
+writers running at once (w1rollup --watch and a cron run, say) add to each
+other's entries instead of the last one winning. A run that dies before
+then leaves the catalog behind the rollups, and readers miss the months it
+created until the next run that touches them; w1rollup --rescan rebuilds
+the catalog from the tree. A rollup location with no catalog is scanned
+the first time w1rollup runs on it.
+"""
+
+import os, json, sys, hashlib, array, fcntl
+
+from .common import replacing, ns_isoformat
+from . import columnar, pyramid
+
+import logging
+logger = logging.getLogger(__name__)
+
+class Catalog:
+    filename = "CATALOG.json"
+
+    def __init__(self, rollup_location):
+        self.rollup_location = rollup_location
+        self.path = os.path.join(rollup_location, self.filename)
+        self.months = dict()
+        self.updates = dict()  # key: entry, not yet saved
+        self.replace = False  # save updates as the whole catalog
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        """Read the catalog; False if there isn't one."""
+        try:
+            with open(self.path, 'r') as f:
+                self.months = json.load(f)["months"]
+        except FileNotFoundError:
+            return False
+        except (ValueError, KeyError):
+            logger.error("Broken catalog {}: {}; rebuild it with --rescan".format(self.path, sys.exc_info()[1]))
+            sys.exit(65)  # EX_DATAERR
+        return True
+
+    def save(self):
+        """Merge the updates into the catalog on disk."""
+        if not self.updates and not self.replace:
+            return
+        lock = os.open(self.rollup_location, os.O_RDONLY)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.replace or not self.load():
+                self.months = dict()
+            self.months.update(self.updates)
+            with replacing(self.path) as f:
+                json.dump({"months": self.months}, f, sort_keys=True)
+        finally:
+            os.close(lock)
+        self.updates = dict()
+        self.replace = False
+
+    def update(self, key, entry):
+        self.updates[key] = entry
+
+def month_key(measurement, filename):
+    return "{}/{}".format(measurement, filename)
+
+def month_entry(year, month, measurement, json_filename, time_ns, values):
+    """The catalog entry for a month whose files were just written from
+    time_ns and values (arrays or memoryviews, 'q' and 'd')."""
+    digest = hashlib.sha1()
+    for column, typecode in ((time_ns, 'q'), (values, 'd')):
+        if sys.byteorder != 'little':
+            column = array.array(typecode, column)
+            column.byteswap()
+        digest.update(column)
+    base = json_filename[:-len(".json")]
+    sizes = dict()
+    for suffix in [".json", ".data", ".bin"] + [".{}.bin".format(tier) for tier, _ in pyramid.tiers]:
+        try:
+            sizes[suffix] = os.stat(base + suffix).st_size
+        except FileNotFoundError:
+            pass
+    return {
+        "year": year, "month": month, "measurement": measurement,
+        "rows": len(time_ns),
+        "first": ns_isoformat(time_ns[0]) if len(time_ns) else None,
+        "last": ns_isoformat(time_ns[-1]) if len(time_ns) else None,
+        "sha1": digest.hexdigest(),
+        "sizes": sizes,
+    }
+
+def scan_entry(year, month, measurement, json_filename, read_rows):
+    """Catalog entry for an existing month, from its .bin if it has one, or
+    read_rows() -> (time_ns, values) otherwise."""
+    try:
+        with columnar.open_columns(json_filename[:-len(".json")] + ".bin") as c:
+            return month_entry(year, month, measurement, json_filename, c.time_ns, c.values)
+    except (FileNotFoundError, columnar.BadColumns):
+        time_ns, values = read_rows()
+        return month_entry(year, month, measurement, json_filename, time_ns, values)
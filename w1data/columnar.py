@@ -0,0 +1,118 @@
+"""columnar.py
+
+Binary monthly rollups, year-month-measurement.bin beside each .json, for
+consumers that would rather map a month than parse it:
+
+    16-byte header: magic b"W1RC", format version (uint16), reserved
+                    (uint16), row count n (uint64)
+    n int64 epoch nanoseconds, ascending
+    n float64 values
+
+All little-endian, and both columns are 8-byte aligned, so they can be used
+in place from a memory map. open_columns() does that with mmap and returns
+memoryview casts; with NumPy, numpy.frombuffer(columns.time_ns, '<i8')
+wraps the same pages without copying.
+
+Other tables (aggregate tiers, see pyramid.py) use the same layout with
+their own magic and columns: Table and write_table() are the general form.
+"""
+
+import os, sys, struct, mmap, array
+
+from .common import replacing
+
+import logging
+logger = logging.getLogger(__name__)
+
+header = struct.Struct('<4sHHQ')
+
+class BadColumns(ValueError):
+    pass
+
+def write_table(filename, magic, version, columns, flags=0):
+    """Write a header and then equal-length arrays (typecodes q and d),
+    atomically. flags goes in the header's reserved field."""
+    count = len(columns[0])
+    if any(len(column) != count for column in columns):
+        raise ValueError("columns of {} differ in length".format(filename))
+    with replacing(filename, 'wb') as f:
+        f.write(header.pack(magic, version, flags, count))
+        for column in columns:
+            if sys.byteorder != 'little':
+                column = array.array(column.typecode, column)
+                column.byteswap()
+            f.write(column.tobytes())
+
+class Table:
+    """A binary table opened for reading. Each of the class's fields is an
+    attribute holding a memoryview over the mapped file; they're valid until
+    close(), which a with statement does for you. An empty table has empty
+    views and no mapping.
+    """
+    magic = None
+    version = 1
+    fields = ()  # (name, typecode), each 8 bytes wide
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._mmap = None
+        with open(filename, 'rb') as f:
+            head = f.read(header.size)
+            if len(head) < header.size:
+                raise BadColumns("{} is truncated".format(filename))
+            file_magic, file_version, _, count = header.unpack(head)
+            if file_magic != self.magic or file_version != self.version:
+                raise BadColumns("{} isn't a version {} {}".format(filename, self.version, self.magic))
+            size = os.fstat(f.fileno()).st_size
+            if size < header.size + 8 * len(self.fields) * count:
+                raise BadColumns("{} is truncated".format(filename))
+            self._count = count
+            if count == 0:
+                for name, typecode in self.fields:
+                    setattr(self, name, memoryview(array.array(typecode)))
+                return
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        for n, (name, typecode) in enumerate(self.fields):
+            column = view[header.size + 8 * count * n:header.size + 8 * count * (n + 1)]
+            if sys.byteorder == 'little':
+                setattr(self, name, column.cast(typecode))
+            else:
+                # No zero-copy view of little-endian data here; swap a copy
+                swapped = array.array(typecode, column.tobytes())
+                swapped.byteswap()
+                setattr(self, name, memoryview(swapped))
+            column.release()
+        view.release()
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        for name, _ in self.fields:
+            getattr(self, name).release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Columns(Table):
+    """A binary monthly rollup: .time_ns ('q') and .values ('d')."""
+    magic = b"W1RC"
+    fields = (('time_ns', 'q'), ('values', 'd'))
+
+def write_columns(filename, time_ns, values):
+    """Write a binary rollup atomically. time_ns and values are equal-length
+    sequences (arrays are fastest), already sorted by time."""
+    if len(time_ns) != len(values):
+        raise ValueError("{} times but {} values".format(len(time_ns), len(values)))
+    write_table(filename, Columns.magic, Columns.version,
+                [array.array('q', time_ns), array.array('d', values)])
+
+def open_columns(filename):
+    return Columns(filename)
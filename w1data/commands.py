@@ -1,7 +1,7 @@
 #! /usr/bin/env python
 
-import argparse, configparser, sys, os
-from . import common, metadata, observations, rollup, w1datapoint
+import argparse, configparser, sys, os, datetime, signal
+from . import catalog, columnar, common, export, journal, metadata, objectstore, observations, pyramid, query, rollup, segments, w1datapoint, watch
 
 import logging
 logger = logging.getLogger(__name__)
@@ -74,6 +74,27 @@ def rollup_command():
     p = LocalArgumentParser()
     if applied_name != direct_name:
         p.add_argument('rollup_command')
+    p.add_argument('--jobs', '-j', type=int, default=1,
+                   help="parse raw files and write rollups in this many processes")
+    p.add_argument('--since', default=None,
+                   help="re-roll raw files uploaded from this UTC isotime (e.g. 2020-02)")
+    p.add_argument('--until', default=None,
+                   help="re-roll raw files uploaded before this UTC isotime, plus --slack")
+    p.add_argument('--slack', type=float, default=24.0,
+                   help="hours a scan may wait on its collector before upload (default 24)")
+    p.add_argument('--cache-location', default=os.path.expanduser("~/.cache/w1data"),
+                   help="local copies of objects fetched from an s3:// raw location")
+    p.add_argument('--max-months', type=int, default=None,
+                   help="hold at most this many months' rows in memory, flushing the least recently used"
+                   " (with --watch and no --memory-budget, default 12)")
+    p.add_argument('--memory-budget', type=float, default=None,
+                   help="hold about this many MB of rows in memory, flushing the least recently used")
+    p.add_argument('--rescan', action='store_true',
+                   help="rebuild the rollup catalog from the rollup directory tree")
+    p.add_argument('--watch', action='store_true',
+                   help="stay running, rolling up raw files as they arrive (local raw location only)")
+    p.add_argument('--debounce', type=float, default=2.0,
+                   help="with --watch, seconds to gather arriving files before rolling them up (default 2)")
     a = p.parse_args()
     do_debug(a)
 
@@ -81,9 +102,161 @@ def rollup_command():
         logger.error("Need dirs for raw and rollup data, see --help")
         sys.exit(64)  # EX_USAGE
 
+    if a.watch:
+        if common.location_is_s3(a.raw_location) or a.since is not None or a.until is not None:
+            logger.error("--watch needs a local raw location, and no --since or --until")
+            sys.exit(64)  # EX_USAGE
+        if a.rescan:
+            rollup.RollupMonthlyCollection(os.path.expanduser(a.rollup_location), rescan=True).flush()
+        watcher = watch.RollupWatcher(
+            os.path.expanduser(a.rollup_location),
+            os.path.expanduser(a.raw_location),
+            debounce=a.debounce,
+            jobs=a.jobs,
+            max_months=a.max_months,
+            max_bytes=None if a.memory_budget is None else int(a.memory_budget * 2**20))
+        handlers = {signum: signal.signal(signum, lambda signum, frame: watcher.stop())
+                    for signum in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            watcher.run()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            watcher.close()
+        return 0
+
+    store = None
+    s3 = common.location_is_s3(a.raw_location)
+    if s3:
+        store = objectstore.open_object_store(s3.group('bucket'), os.path.expanduser(a.cache_location))
+
     return rollup.do_rollup(
         os.path.expanduser(a.rollup_location),
-        os.path.expanduser(a.raw_location))
+        os.path.expanduser(a.raw_location),
+        store=store,
+        jobs=a.jobs,
+        since=None if a.since is None else common.isotime_ns(a.since),
+        until=None if a.until is None else common.isotime_ns(a.until),
+        slack_ns=int(a.slack * 3600 * 10**9),
+        max_months=a.max_months,
+        max_bytes=None if a.memory_budget is None else int(a.memory_budget * 2**20),
+        rescan=a.rescan,
+        report=sys.stdout)
+
+def compact_command():
+    """
+    Pack loose raw observation files into per-day or per-month segments
+    """
+    direct_name = "w1compact"
+    _, applied_name = os.path.split(sys.argv[0])
+    p = LocalArgumentParser()
+    if applied_name != direct_name:
+        p.add_argument('compact_command')
+    p.add_argument('--period', choices=('day', 'month'), default='month')
+    p.add_argument('--gzip', action='store_true', help="compress segments")
+    p.add_argument('--min-age', type=float, default=48.0,
+                   help="only pack files uploaded at least this many hours ago (default 48)")
+    a = p.parse_args()
+    do_debug(a)
+
+    if a.raw_location is None:
+        logger.error("Need a dir for raw data, see --help")
+        sys.exit(64)  # EX_USAGE
+    if common.location_is_s3(a.raw_location):
+        logger.error("Can only compact a local raw location")
+        sys.exit(64)  # EX_USAGE
+
+    raw = observations.Observations(os.path.expanduser(a.raw_location))
+    older_than = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=a.min_age)
+    for dirname in raw.endpoint_dirs():
+        n = segments.compact_dir(dirname, a.period, a.gzip, older_than, raw.time_from_filename)
+        logger.info("{}: packed {} files".format(dirname, n))
+    return 0
+
+def query_command():
+    """
+    Print rollup rows, or aggregate buckets, for measurements over a time range
+    """
+    direct_name = "w1query"
+    _, applied_name = os.path.split(sys.argv[0])
+    p = LocalArgumentParser()
+    if applied_name != direct_name:
+        p.add_argument('query_command')
+    p.add_argument('measurements', nargs='*', help="measurement names (default all)")
+    p.add_argument('--since', default=None, help="from this UTC isotime (e.g. 2020-02)")
+    p.add_argument('--until', default=None, help="up to this UTC isotime")
+    p.add_argument('--tier', choices=[tier for tier, _ in pyramid.tiers], default=None,
+                   help="aggregate buckets (count, min, max, mean) instead of rows")
+    a = p.parse_args()
+    do_debug(a)
+
+    if a.rollup_location is None:
+        logger.error("Need a dir for rollup data, see --help")
+        sys.exit(64)  # EX_USAGE
+
+    reader = query.RollupReader(os.path.expanduser(a.rollup_location))
+    since = None if a.since is None else common.isotime_ns(a.since)
+    until = None if a.until is None else common.isotime_ns(a.until)
+    out = sys.stdout
+    if a.tier is None:
+        out.write("measurement\ttime\tvalue\n")
+    else:
+        out.write("measurement\tstart\tcount\tmin\tmax\tmean\n")
+    for measurement in a.measurements or reader.measurements():
+        if a.tier is None:
+            for t, v in zip(*reader.rows(measurement, since, until)):
+                out.write("{}\t{}\t{}\n".format(measurement, common.ns_isoformat(t), v))
+        else:
+            for t, n, lo, hi, mean in zip(*reader.aggregates(measurement, a.tier, since, until)):
+                out.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(
+                    measurement, common.ns_isoformat(t), n, lo, hi, mean))
+    return 0
+
+def export_command():
+    """
+    Write several measurements as one time-aligned table
+    """
+    direct_name = "w1export"
+    _, applied_name = os.path.split(sys.argv[0])
+    p = LocalArgumentParser()
+    if applied_name != direct_name:
+        p.add_argument('export_command')
+    p.add_argument('measurements', nargs='+',
+                   help="measurement names; without --grid, rows are the first one's times")
+    p.add_argument('--since', default=None, help="from this UTC isotime (e.g. 2020-02)")
+    p.add_argument('--until', default=None, help="up to this UTC isotime")
+    p.add_argument('--grid', type=float, default=None, help="resample to a row every this many seconds")
+    p.add_argument('--tolerance', type=float, default=None,
+                   help="leave values older than this many seconds out (default 604800, a week)")
+    p.add_argument('--format', choices=('csv', 'gnuplot', 'binary'), default='csv')
+    p.add_argument('--output', '-o', default=None, help="file to write (default stdout)")
+    a = p.parse_args()
+    do_debug(a)
+
+    if a.rollup_location is None:
+        logger.error("Need a dir for rollup data, see --help")
+        sys.exit(64)  # EX_USAGE
+    if a.format == 'binary' and a.output is None:
+        logger.error("Binary export needs --output")
+        sys.exit(64)  # EX_USAGE
+
+    reader = query.RollupReader(os.path.expanduser(a.rollup_location))
+    time_ns, columns = export.align(
+        reader, a.measurements,
+        since=None if a.since is None else common.isotime_ns(a.since),
+        until=None if a.until is None else common.isotime_ns(a.until),
+        grid_ns=None if a.grid is None else int(a.grid * 10**9),
+        tolerance_ns=None if a.tolerance is None else int(a.tolerance * 10**9))
+    if a.format == 'binary':
+        export.write_binary(a.output, time_ns, columns)
+        return 0
+    write = export.write_csv if a.format == 'csv' else export.write_gnuplot
+    if a.output is None:
+        write(sys.stdout, a.measurements, time_ns, columns)
+    else:
+        with common.replacing(a.output) as f:
+            write(f, a.measurements, time_ns, columns)
+    return 0
 
 def testcli_command():
     """
@@ -107,16 +280,34 @@ def do_debug(a):
             modules = set(a.debug.split(','))
             if 'commands' in modules or 'all' in modules:
                 logger.setLevel(logging.DEBUG)
+            if 'catalog' in modules or 'all' in modules:
+                catalog.logger.setLevel(logging.DEBUG)
+            if 'columnar' in modules or 'all' in modules:
+                columnar.logger.setLevel(logging.DEBUG)
             if 'common' in modules or 'all' in modules:
                 common.logger.setLevel(logging.DEBUG)
+            if 'export' in modules or 'all' in modules:
+                export.logger.setLevel(logging.DEBUG)
+            if 'journal' in modules or 'all' in modules:
+                journal.logger.setLevel(logging.DEBUG)
             if 'metadata' in modules or 'all' in modules:
                 metadata.logger.setLevel(logging.DEBUG)
+            if 'objectstore' in modules or 'all' in modules:
+                objectstore.logger.setLevel(logging.DEBUG)
             if 'observations' in modules or 'all' in modules:
                 observations.logger.setLevel(logging.DEBUG)
+            if 'pyramid' in modules or 'all' in modules:
+                pyramid.logger.setLevel(logging.DEBUG)
+            if 'query' in modules or 'all' in modules:
+                query.logger.setLevel(logging.DEBUG)
             if 'rollup' in modules or 'all' in modules:
                 rollup.logger.setLevel(logging.DEBUG)
+            if 'segments' in modules or 'all' in modules:
+                segments.logger.setLevel(logging.DEBUG)
             if 'w1datapoint' in modules or 'all' in modules:
                 w1datapoint.logger.setLevel(logging.DEBUG)
+            if 'watch' in modules or 'all' in modules:
+                watch.logger.setLevel(logging.DEBUG)
         debug_done = True
 
 def main():
@@ -131,6 +322,15 @@ def main():
     if a.command == 'rollup':
         return rollup_command()
 
+    if a.command == 'compact':
+        return compact_command()
+
+    if a.command == 'export':
+        return export_command()
+
+    if a.command == 'query':
+        return query_command()
+
     if a.command == 'testcli':
         return testcli_command()
 
@@ -1,4 +1,5 @@
-import re, datetime
+import re, datetime, json, os, tempfile, contextlib
+import dateutil.parser
 import logging
 logger = logging.getLogger(__name__)
 
@@ -7,6 +8,158 @@ s3_re = re.compile(r'^s3:// (?P<bucket>[^/]+) /? (?P<key>.*?)$', re.X)
 def location_is_s3(location):
     return s3_re.match(location)
 
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+_file_mode = 0o666 & ~_umask()
+
+@contextlib.contextmanager
+def replacing(filename, mode='w'):
+    """Write filename atomically: yields a temporary file beside it, which is
+    fsynced and renamed over filename if the with block finishes, or removed
+    if it raises. Readers see the old content or the new, never part. The
+    file gets the permissions open() would have given it, not the private
+    ones of a temporary file, so other users can still read rollups."""
+    with tempfile.NamedTemporaryFile(mode, dir=os.path.dirname(filename),
+                                     prefix='.' + os.path.basename(filename), delete=False) as f:
+        try:
+            os.fchmod(f.fileno(), _file_mode)
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        except:
+            f.close()
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, filename)
+
 def datetime_isoformat(dt):
     return dt.replace(tzinfo=datetime.timezone.utc).isoformat()
 
+epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+one_microsecond = datetime.timedelta(microseconds=1)
+
+def datetime_ns(dt):
+    """Integer nanoseconds since the epoch. Naive datetimes are taken as UTC."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return (dt - epoch) // one_microsecond * 1000
+
+def ns_datetime(ns):
+    """UTC datetime for integer nanoseconds since the epoch."""
+    return epoch + datetime.timedelta(microseconds=ns // 1000)
+
+def ns_isoformat(ns):
+    return ns_datetime(ns).isoformat()
+
+
+_midnight_ns = {}
+
+def isotime_ns(s):
+    """Integer ns since the epoch for an isotime string. The formats w1logger
+    and the receiving API write ("2020-02-05T05:35:02.233+00:00", with or
+    without fraction, "+00:00" or "Z") are sliced apart directly, with the
+    start of each day memoized; anything else, or anything out of range, goes
+    through parse_isotime. Digits past nanoseconds are truncated.
+    """
+    n = len(s)
+    if n >= 20 and s[10] == 'T' and s[13] == ':' and s[16] == ':' and (
+            s.endswith('+00:00') or s[-1] == 'Z'):
+        end = n - 1 if s[-1] == 'Z' else n - 6
+        try:
+            day = _midnight_ns[s[:10]]
+        except KeyError:
+            try:
+                day = _midnight_ns[s[:10]] = datetime_ns(
+                    datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10])))
+            except ValueError:
+                day = None
+        hms = s[11:13], s[14:16], s[17:19]
+        fraction = s[20:end]
+        if day is not None and all(f.isdecimal() for f in hms) and (
+                end == 19 or (s[19] == '.' and fraction.isdecimal())):
+            hour, minute, second = (int(f) for f in hms)
+            if hour < 24 and minute < 60 and second < 60:
+                ns = day + ((hour * 60 + minute) * 60 + second) * 1000000000
+                if fraction:
+                    fraction = fraction[:9]
+                    ns += int(fraction) * 10 ** (9 - len(fraction))
+                return ns
+    return datetime_ns(parse_isotime(s))
+
+def parse_isotime(s):
+    """datetime for an isotime string: datetime.fromisoformat when it can,
+    dateutil's isoparse for everything else."""
+    try:
+        return datetime.datetime.fromisoformat(s)
+    except ValueError:
+        return dateutil.parser.isoparse(s)
+
+_json_decoder = json.JSONDecoder()
+_json_delimiter_re = re.compile(r'[ \t\r\n]*[,\]]')
+
+def iter_json_array(f, chunk_size=1 << 16):
+    """Yield the elements of the JSON array in text file f one at a time,
+    holding roughly one element plus one chunk in memory rather than the
+    whole document. A top-level object is yielded as the only element.
+    """
+    buf = ''
+    pos = 0
+    eof = False
+    want = chunk_size
+
+    def more():
+        nonlocal buf, pos, eof, want
+        data = f.read(want)
+        if not data:
+            eof = True
+        buf = buf[pos:] + data
+        pos = 0
+
+    def skip_space():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            more()
+
+    skip_space()
+    if pos >= len(buf):
+        return
+    if buf[pos] != '[':
+        yield json.loads(buf[pos:] + f.read())
+        return
+    pos += 1
+    first = True
+    while True:
+        skip_space()
+        if pos >= len(buf):
+            raise json.JSONDecodeError("Unterminated array", buf, pos)
+        if buf[pos] == ']':
+            return
+        if not first:
+            if buf[pos] != ',':
+                raise json.JSONDecodeError("Expecting ',' delimiter", buf, pos)
+            pos += 1
+            skip_space()
+        first = False
+        while True:
+            try:
+                element, end = _json_decoder.raw_decode(buf, pos)
+                # A number cut off by the chunk ("1." of "1.5") still decodes,
+                # so only trust an element once we can see what follows it.
+                if eof or _json_delimiter_re.match(buf, end):
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            # Element runs past what we've read; read bigger chunks until it fits
+            more()
+            want *= 2
+        want = chunk_size
+        pos = end
+        yield element
@@ -0,0 +1,88 @@
+"""export.py
+
+Several measurements lined up on one time axis, for analysis across sensors
+(supply minus return, say), rather than each stream on its own irregular
+timestamps.
+
+align() builds the table from the sorted rollup rows (see query.py) either
+as an as-of join, on the first measurement's own timestamps, or on a fixed
+grid. Either way each other column holds the latest value at or before the
+row's time, or NaN if there's none within the staleness tolerance (a week
+unless given). It's one merge pass per measurement.
+
+The table can be written as CSV, as a gnuplot data file or as a binary
+table (see columnar.py): magic b"W1RJ", with the number of value columns in
+the header's reserved field, then time_ns and one float64 column per
+measurement, in order.
+"""
+
+import array, csv, math
+
+from . import columnar
+from .common import ns_isoformat
+
+import logging
+logger = logging.getLogger(__name__)
+
+# How stale a value may be, when there's no tolerance to say; also how far
+# before since to look for values as of the first rows
+default_tolerance_ns = 7 * 86400 * 10**9
+
+binary_magic = b"W1RJ"
+binary_version = 1
+
+def as_of(base_times, times, values, tolerance_ns=None):
+    """For each of base_times (sorted), the last of values whose time is at
+    or before it and no more than tolerance_ns older, else NaN."""
+    result = array.array('d')
+    i, n = 0, len(times)
+    nan = float('nan')
+    for t in base_times:
+        while i < n and times[i] <= t:
+            i += 1
+        if i == 0 or (tolerance_ns is not None and t - times[i - 1] > tolerance_ns):
+            result.append(nan)
+        else:
+            result.append(values[i - 1])
+    return result
+
+def align(reader, measurements, since=None, until=None, grid_ns=None, tolerance_ns=None):
+    """(time_ns, [values per measurement]) arrays for measurements in
+    [since, until), read through a query.RollupReader. With grid_ns, rows
+    are every grid_ns from since (rounded up to the grid); otherwise they're
+    the first measurement's rows. Values are at most tolerance_ns (by
+    default default_tolerance_ns) older than their row, so the first rows'
+    can come from that far before since."""
+    if tolerance_ns is None:
+        tolerance_ns = default_tolerance_ns
+    lookback = None
+    if since is not None:
+        lookback = since - tolerance_ns
+    streams = [reader.rows(measurement, lookback, until) for measurement in measurements]
+    if grid_ns is None:
+        base_times = reader.rows(measurements[0], since, until)[0]
+    else:
+        if since is None:
+            since = min((times[0] for times, _ in streams if len(times)), default=0)
+        if until is None:
+            until = max((times[-1] + 1 for times, _ in streams if len(times)), default=since)
+        first = -(-since // grid_ns) * grid_ns
+        base_times = array.array('q', range(first, until, grid_ns))
+    columns = [as_of(base_times, times, values, tolerance_ns) for times, values in streams]
+    return base_times, columns
+
+def write_csv(f, measurements, time_ns, columns):
+    w = csv.writer(f)
+    w.writerow(["time"] + list(measurements))
+    for i, t in enumerate(time_ns):
+        w.writerow([ns_isoformat(t)] + ["" if math.isnan(c[i]) else c[i] for c in columns])
+
+def write_gnuplot(f, measurements, time_ns, columns):
+    f.write("time {}\n".format(" ".join('"{}"'.format(m.replace("_", " ")) for m in measurements)))
+    for i, t in enumerate(time_ns):
+        f.write("{} {}\n".format(t / 1e9, " ".join(str(c[i]) for c in columns)))
+
+def write_binary(filename, time_ns, columns):
+    columnar.write_table(filename, binary_magic, binary_version,
+                         [array.array('q', time_ns)] + [array.array('d', c) for c in columns],
+                         flags=len(columns))
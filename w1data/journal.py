@@ -0,0 +1,169 @@
+"""journal.py
+
+Record of which raw observation files have already been rolled up, so a
+w1rollup run only has to parse what arrived (or changed) since the last one.
+
+The journal maps each raw file's path, relative to the raw location, to the
+[size, mtime_ns] it had when it was ingested (a packed segment's are its
+index's, followed by the uncompressed size then committed, see
+segments.py). A file whose size or mtime differs is ingested
+again; a rollup month holds one row per time, so that's idempotent.
+
+It lives in the rollup location as INGEST_JOURNAL.json, a snapshot
+{"files": {path: stamp, ...}}, plus INGEST_JOURNAL.log, one [path, stamp]
+JSON line per file journaled since, later lines winning. A commit appends
+to the log, so it costs the files it records rather than the whole archive;
+once the log outgrows the snapshot they're folded into a new snapshot. A
+line torn by a crash is ignored, and its file ingested again.
+
+The journal is read when is_new() is first asked about a file, so a
+re-roll of a time range, which ingests files regardless, never reads it.
+
+Files accepted by is_new() or record() are journaled only once ingested()
+says they were read through, and only at commit(), which the caller makes
+after the rollups touched by those files are safely flushed. A run that
+dies part way through, or a file that couldn't be read, is ingested again
+next time, as is one the caller forget()s.
+"""
+
+import os, json, sys
+
+from . import segments
+from .common import replacing
+
+import logging
+logger = logging.getLogger(__name__)
+
+class IngestJournal:
+    filename = "INGEST_JOURNAL.json"
+    log_filename = "INGEST_JOURNAL.log"
+
+    # Don't bother folding the log into the snapshot until it's this long
+    compact_lines = 1000
+
+    def __init__(self, rollup_location, raw_location):
+        self.path = os.path.join(rollup_location, self.filename)
+        self.log_path = os.path.join(rollup_location, self.log_filename)
+        self.raw_location = raw_location
+        self._files = None
+        self.listed = dict()  # accepted, not yet read
+        self.pending = dict()  # read, not yet committed
+        self.log_lines = 0
+
+    @property
+    def files(self):
+        """{path: stamp} of every file journaled, read on first use."""
+        if self._files is None:
+            self._load()
+        return self._files
+
+    def _load(self):
+        self._files = dict()
+        try:
+            with open(self.path, 'r') as f:
+                self._files = json.load(f)["files"]
+        except FileNotFoundError:
+            logger.debug("No journal at {}, ingesting everything".format(self.path))
+        except (ValueError, KeyError):
+            logger.error("Broken journal {}: {}".format(self.path, sys.exc_info()[1]))
+            sys.exit(65)  # EX_DATAERR
+        try:
+            with open(self.log_path, 'r') as f:
+                for line in f:
+                    self.log_lines += 1
+                    try:
+                        key, stamp = json.loads(line)
+                    except ValueError:
+                        logger.debug("Skipping torn journal line {!r}".format(line))
+                        continue
+                    self._files[key] = stamp
+        except FileNotFoundError:
+            pass
+
+    def _key_stamp(self, abs_filename, stamp):
+        if stamp is None and segments.is_segment(abs_filename):
+            stamp = segments.segment_stamp(abs_filename)
+        elif stamp is None:
+            st = os.stat(abs_filename)
+            stamp = [st.st_size, st.st_mtime_ns]
+        return os.path.relpath(abs_filename, self.raw_location), list(stamp)
+
+    def is_new(self, abs_filename, stamp=None):
+        """True if abs_filename hasn't been ingested as it now stands. Usable as
+        an Observations file_filter. stamp is [size, mtime_ns] (or [size,
+        ETag] for object store files), looked up if not given."""
+        try:
+            key, stamp = self._key_stamp(abs_filename, stamp)
+        except OSError:
+            return False
+        if self.files.get(key) == stamp:
+            return False
+        self.listed[key] = stamp
+        return True
+
+    def record(self, abs_filename, stamp=None):
+        """Ingest abs_filename whether or not it's been seen, and remember it.
+        Usable as an Observations file_filter for re-rolling."""
+        try:
+            key, stamp = self._key_stamp(abs_filename, stamp)
+        except OSError:
+            return False
+        self.listed[key] = stamp
+        return True
+
+    def segment_start(self, abs_filename):
+        """Where to start reading a packed segment: the uncompressed size it
+        had when last ingested, or 0. Usable as an Observations
+        segment_start callback."""
+        key = os.path.relpath(abs_filename, self.raw_location)
+        stamp = self.files.get(key)
+        if stamp is None or len(stamp) < 3:
+            return 0  # never ingested, or journaled before sizes were
+        return stamp[2]
+
+    def ingested(self, abs_filename):
+        """Note that abs_filename, accepted by is_new() or record(), has been
+        read through. Usable as an Observations file_read callback."""
+        key = os.path.relpath(abs_filename, self.raw_location)
+        try:
+            self.pending[key] = self.listed.pop(key)
+        except KeyError:
+            pass
+
+    def forget(self, abs_filename):
+        """Don't journal abs_filename after all, though it was read: its rows
+        couldn't all be rolled up. It's ingested again next time."""
+        key = os.path.relpath(abs_filename, self.raw_location)
+        self.listed.pop(key, None)
+        self.pending.pop(key, None)
+
+    def commit(self):
+        """Remember the files read since the last commit."""
+        if not self.pending:
+            return
+        with open(self.log_path, 'a+b') as f:
+            lines = [json.dumps([key, stamp]) + "\n" for key, stamp in self.pending.items()]
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    lines.insert(0, "\n")  # leave a torn line on its own
+            f.write("".join(lines).encode())
+            f.flush()
+            os.fsync(f.fileno())
+        logger.debug("Journaled {} files".format(len(self.pending)))
+        if self._files is not None:
+            self._files.update(self.pending)
+            self.log_lines += len(self.pending)
+            if self.log_lines > max(self.compact_lines, len(self._files)):
+                self.compact()
+        self.pending = dict()
+
+    def compact(self):
+        """Fold the log into a new snapshot."""
+        with replacing(self.path) as f:
+            json.dump({"files": self.files}, f)
+        try:
+            os.unlink(self.log_path)
+        except FileNotFoundError:
+            pass
+        self.log_lines = 0
@@ -1,3 +1,19 @@
+"""metadata.py
+
+Endpoint metadata (merged METADATA.json content) is shared by every
+observation from a directory and repeated across many rollup months, so it
+is interned: Metadata instances are canonicalized once, named by a stable
+hash of their canonical JSON, and carry a precomputed sensor key to
+measurement name table.
+
+Rollups refer to metadata by that id. MetadataStore keeps one copy of each
+under <rollup location>/METADATA/<id>.json.
+"""
+
+import os, json, hashlib
+
+from .common import replacing
+
 import logging, sys
 logger = logging.getLogger(__name__)
 
@@ -5,3 +21,77 @@ def measurement_for_skey(sensor_key, metadata):
     # logger.debug("sensor_key:{} metadata:{}".format(sensor_key, metadata))
     return metadata['collector']['sensors'][sensor_key]['name']
 
+def canonical_json(content):
+    return json.dumps(content, sort_keys=True, separators=(',', ':'))
+
+class Metadata:
+    """Interned metadata. .content is the dict (don't modify it), .id the
+    sha1 of its canonical JSON and .measurements {sensor_key: measurement}.
+    """
+    __slots__ = ('id', 'content', 'measurements')
+
+    def __init__(self, content):
+        self.content = content
+        self.id = hashlib.sha1(canonical_json(content).encode()).hexdigest()
+        self.measurements = dict()
+        try:
+            sensors = content['collector']['sensors']
+        except (KeyError, TypeError):
+            sensors = {}
+        for sensor_key, sensor in sensors.items():
+            try:
+                self.measurements[sensor_key] = sensor['name']
+            except (KeyError, TypeError):
+                pass
+
+    def __repr__(self):
+        return "<Metadata {}>".format(self.id)
+
+    def measurement(self, sensor_key):
+        return self.measurements[sensor_key]
+
+_interned = dict()  # id: Metadata
+
+def intern_metadata(content):
+    """The Metadata instance for a dict, shared by every equal dict."""
+    if isinstance(content, Metadata):
+        return content
+    m = Metadata(content)
+    return _interned.setdefault(m.id, m)
+
+class MetadataStore:
+    """Deduplicated metadata for a rollup location, one file per id."""
+    dirname = "METADATA"
+
+    def __init__(self, rollup_location):
+        self.path = os.path.join(rollup_location, self.dirname)
+        self._known = None
+
+    def _filename(self, metadata_id):
+        return os.path.join(self.path, metadata_id + ".json")
+
+    def __contains__(self, metadata_id):
+        if self._known is None:
+            try:
+                self._known = {name[:-5] for name in os.listdir(self.path) if name.endswith('.json')}
+            except FileNotFoundError:
+                self._known = set()
+        return metadata_id in self._known
+
+    def save(self, metadata):
+        """Store a Metadata instance, if it isn't already. Atomic, so a
+        stored id is always readable."""
+        if metadata.id in self:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with replacing(self._filename(metadata.id)) as f:
+            f.write(canonical_json(metadata.content))
+        self._known.add(metadata.id)
+
+    def load(self, metadata_id):
+        """The Metadata instance stored under metadata_id."""
+        try:
+            with open(self._filename(metadata_id), 'r') as f:
+                return intern_metadata(json.load(f))
+        except FileNotFoundError:
+            raise KeyError(metadata_id)
@@ -0,0 +1,174 @@
+"""objectstore.py
+
+Raw observations straight from the S3 bucket the datalogger API writes to,
+s3://<bucket>/<endpoint UUID>/<UTC isotime>;<event id>.json.
+
+An object store here is anything with list_dirs(prefix), list(prefix,
+start_after) and get(key):
+
+S3ObjectStore talks to S3, or to any S3-compatible server (a local stand-in
+like minio, say) given endpoint_url or the W1_S3_ENDPOINT_URL environment
+variable. It needs boto3, which is only imported when one is created.
+
+LocalObjectStore treats a directory as the bucket, keys as relative paths. It
+stands in for S3 in tests and for copies of a bucket made with `aws s3 sync`.
+
+CachingObjectStore wraps either, keeping every fetched object under a local
+cache directory so it's fetched once. Raw objects are never rewritten, so a
+cached copy stays good; METADATA.json can change, so it isn't cached.
+
+get_many() fetches a list of keys from a pool of threads, in order.
+"""
+
+import os, os.path, sys, tempfile, collections
+import concurrent.futures
+
+import logging
+logger = logging.getLogger(__name__)
+
+class NoSuchKey(KeyError):
+    pass
+
+class LocalObjectStore:
+    def __init__(self, root):
+        self.root = root
+
+    def list_dirs(self, prefix):
+        """Names of the 'subdirectories' directly under prefix."""
+        names = list()
+        try:
+            with os.scandir(os.path.join(self.root, prefix)) as s:
+                for entry in s:
+                    if entry.is_dir():
+                        names.append(entry.name)
+        except FileNotFoundError:
+            pass
+        return sorted(names)
+
+    def list(self, prefix, start_after=None):
+        """Yield (key, size, version) for objects directly under prefix (which
+        ends in '/'), in key order, starting after key start_after."""
+        try:
+            with os.scandir(os.path.join(self.root, prefix)) as s:
+                entries = sorted((prefix + entry.name, entry) for entry in s if entry.is_file())
+        except FileNotFoundError:
+            return
+        for key, entry in entries:
+            if start_after is not None and key <= start_after:
+                continue
+            st = entry.stat()
+            yield key, st.st_size, str(st.st_mtime_ns)
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.root, key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise NoSuchKey(key)
+
+class S3ObjectStore:
+    def __init__(self, bucket, endpoint_url=None):
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url or os.environ.get('W1_S3_ENDPOINT_URL')
+        self._client = None
+
+    def __getstate__(self):
+        # boto3 clients don't pickle; process pool workers make their own
+        state = self.__dict__.copy()
+        state['_client'] = None
+        return state
+
+    @property
+    def client(self):
+        if self._client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise RuntimeError("S3 raw locations need boto3 (pip install w1-datalogger[s3])")
+            self._client = boto3.client('s3', endpoint_url=self.endpoint_url)
+        return self._client
+
+    def list_dirs(self, prefix):
+        names = list()
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+            for p in page.get('CommonPrefixes', []):
+                names.append(p['Prefix'][len(prefix):].rstrip('/'))
+        return names
+
+    def list(self, prefix, start_after=None):
+        kwargs = dict(Bucket=self.bucket, Prefix=prefix, Delimiter='/')
+        if start_after is not None:
+            kwargs['StartAfter'] = start_after
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**kwargs):
+            for o in page.get('Contents', []):
+                yield o['Key'], o['Size'], o['ETag']
+
+    def get(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        except self.client.exceptions.NoSuchKey:
+            raise NoSuchKey(key)
+
+class CachingObjectStore:
+    """Read-through cache of another store's objects under cache_dir."""
+    uncached = ('METADATA.json',)
+
+    def __init__(self, store, cache_dir):
+        self.store = store
+        self.cache_dir = cache_dir
+
+    def list_dirs(self, prefix):
+        return self.store.list_dirs(prefix)
+
+    def list(self, prefix, start_after=None):
+        return self.store.list(prefix, start_after)
+
+    def get(self, key):
+        if os.path.basename(key) in self.uncached:
+            return self.store.get(key)
+        cached = os.path.join(self.cache_dir, key)
+        try:
+            with open(cached, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        data = self.store.get(key)
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(cached), delete=False) as f:
+            f.write(data)
+        os.replace(f.name, cached)
+        return data
+
+def get_many(store, keys, jobs=16):
+    """Yield (key, bytes or None if missing or unfetchable) for each of
+    keys, in order, fetched by up to jobs threads with at most 2 * jobs
+    fetches in flight. A key that can't be fetched, or cached, is logged and
+    yields None, so the rest still arrive.
+    """
+    def get(key):
+        try:
+            return store.get(key)
+        except NoSuchKey:
+            logger.warning("{} vanished".format(key))
+        except Exception:
+            logger.error("Couldn't fetch {}: {}".format(key, sys.exc_info()[1]))
+        return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        in_flight = collections.deque()
+        for key in keys:
+            in_flight.append((key, executor.submit(get, key)))
+            if len(in_flight) >= 2 * jobs:
+                key, future = in_flight.popleft()
+                yield key, future.result()
+        while in_flight:
+            key, future = in_flight.popleft()
+            yield key, future.result()
+
+def open_object_store(bucket, cache_dir=None):
+    store = S3ObjectStore(bucket)
+    if cache_dir is not None:
+        store = CachingObjectStore(store, os.path.join(cache_dir, bucket))
+    return store
@@ -36,13 +36,13 @@ assumptions for performance) and lazily, driven by data consumers' demands. If
 nobody asks about the data, observations accumulate and rollups go untouched.
 """
 
-import sys, os, re, argparse, json, uuid
-from datetime import datetime
+import sys, os, re, argparse, json, uuid, array, io
 import dateutil.parser
 from dateutil import relativedelta
 from .w1datapoint import W1Datapoint
-from .common import location_is_s3
-from .metadata import measurement_for_skey
+from .common import location_is_s3, isotime_ns, parse_isotime, ns_isoformat, datetime_ns, iter_json_array
+from . import objectstore, segments
+from .metadata import intern_metadata
 
 import logging
 logger = logging.getLogger(__name__)
@@ -68,6 +68,7 @@ class Observation:
     timings, etc.).
     """
     _handlers = {}
+    _handler_cache = {}  # sensor_key: handler
 
     def __repr__(self):
         return "<Observation {} {} {}>".format(self.datetime.strftime("%FT%T"), self.sensor_key, self.datapoint.value)
@@ -79,16 +80,32 @@ class Observation:
         converted to a data value by a handler matching the sensor_key. uuid is
         just that, a uniquifier (it's an AWS Lambda event_id in all existing
         uses). metadata is the content of METADATA.json in the dir containing
-        the file that holds this Observation.
+        the file that holds this Observation, as a dict or already interned
+        (see metadata.py).
         """
-        self.datetime = dateutil.parser.isoparse(isotime_str)
+        self.datetime = parse_isotime(isotime_str)
         self.time_key = self.datetime.timestamp()
         self.sensor_key = sensor_key
         self.uuid = event_uuid
 
+        self.datapoint = self.handler_for(sensor_key)(value)
+        self.metadata = None if metadata is None else intern_metadata(metadata)
+
+    @classmethod
+    def handler_for(cls, sensor_key):
+        """The W1Datapoint subclass that decodes values for sensor_key. A
+        sensor_key always gets the same answer, so it's remembered."""
+        try:
+            return cls._handler_cache[sensor_key]
+        except KeyError:
+            handler = cls._handler_cache[sensor_key] = cls._find_handler(sensor_key)
+            return handler
+
+    @classmethod
+    def _find_handler(cls, sensor_key):
         # Determine what data handler should process value.
         handler_key = None
-        for _, handler in self._handlers.items():
+        for _, handler in cls._handlers.items():
             handler_key = handler.key_from_sensor_key(sensor_key)
             if handler_key:
                 break
@@ -99,17 +116,15 @@ class Observation:
             raise W1Datapoint.ItAintMe("sensor_key {} doesn't parse".format(sensor_key))
 
         try:
-            self.datapoint = self._handlers[handler_key](value)
+            return cls._handlers[handler_key]
         except KeyError:
             raise W1Datapoint.ItAintMe(
                 "recognized a handler key scheme but no handler for {}".format(sensor_key))
 
-        self.metadata = metadata
-
     def year_month_measurement(self):
         return (self.datetime.year,
                 self.datetime.month,
-                measurement_for_skey(self.sensor_key, self.metadata))
+                self.metadata.measurements[self.sensor_key])
 
     def __lt__(self, other):
         return self.time_key < other.time_key
@@ -117,6 +132,7 @@ class Observation:
     @classmethod
     def register_datapoint_handler(cls, w1_type_str, obsCls):
         cls._handlers[w1_type_str] = obsCls
+        cls._handler_cache.clear()
 
     @property
     def key(self):
@@ -125,7 +141,95 @@ class Observation:
         """
         return (self.datetime.utctimetuple(),
                 self.uuid,
-                self.metadata['collector']['sensors'][self.sensor_key]['name'])
+                self.metadata.measurements[self.sensor_key])
+
+class Interner:
+    """Small-integer ids for repeated strings: .id(s) assigns, [i] looks up."""
+    __slots__ = ('ids', 'values')
+
+    def __init__(self):
+        self.ids = dict()
+        self.values = list()
+
+    def id(self, value):
+        try:
+            return self.ids[value]
+        except KeyError:
+            i = self.ids[value] = len(self.values)
+            self.values.append(value)
+            return i
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+    def __len__(self):
+        return len(self.values)
+
+class ObservationBatch:
+    """Many observations from one endpoint directory, stored column-wise.
+
+    Row i is time_ns[i] (integer nanoseconds since the epoch, UTC),
+    sensor_keys[sensor_ids[i]], values[i], crc_ok[i] and events[event_ids[i]].
+    sensor_keys is shared by every batch from the same Observations, so its ids
+    are stable across a run; events is per batch. metadata is the interned,
+    merged METADATA.json for the directory, shared by all rows.
+
+    Raw value strings are only held until finish() decodes them, a handler
+    at a time (decode_batch if the handler has one).
+    """
+    default_size = 10000
+
+    __slots__ = ('time_ns', 'sensor_ids', 'values', 'crc_ok', 'event_ids',
+                 'sensor_keys', 'events', 'metadata', '_raw')
+
+    def __init__(self, sensor_keys, metadata):
+        self.time_ns = array.array('q')
+        self.sensor_ids = array.array('L')
+        self.values = array.array('d')
+        self.crc_ok = array.array('b')
+        self.event_ids = array.array('L')
+        self.sensor_keys = sensor_keys
+        self.events = Interner()
+        self.metadata = metadata
+        self._raw = list()
+
+    def __len__(self):
+        return len(self.time_ns)
+
+    def append(self, isotime, sensor_key, raw_value, event_id):
+        self.time_ns.append(isotime_ns(isotime))
+        self.sensor_ids.append(self.sensor_keys.id(sensor_key))
+        self.event_ids.append(self.events.id(event_id))
+        self._raw.append(raw_value)
+
+    def finish(self):
+        """Decode the raw values collected so far into .values and .crc_ok."""
+        by_handler = dict()
+        for i, sensor_id in enumerate(self.sensor_ids):
+            handler = Observation.handler_for(self.sensor_keys[sensor_id])
+            by_handler.setdefault(handler, []).append(i)
+        self.values = array.array('d', bytes(8 * len(self)))
+        self.crc_ok = array.array('b', bytes(len(self)))
+        for handler, indexes in by_handler.items():
+            raw = [self._raw[i] for i in indexes]
+            decode_batch = getattr(handler, 'decode_batch', None)
+            if decode_batch is not None:
+                values, crc_ok = decode_batch(raw)
+            else:
+                datapoints = [handler(r) for r in raw]
+                values = [d.value for d in datapoints]
+                crc_ok = [getattr(d, 'consistent', True) for d in datapoints]
+            for i, value, ok in zip(indexes, values, crc_ok):
+                self.values[i] = value
+                self.crc_ok[i] = ok
+        self._raw = None
+        return self
+
+    def sensor_measurements(self):
+        """Per sensor id, the measurement name from this batch's metadata."""
+        measurements = self.metadata.measurements
+        return {sensor_id: measurements[self.sensor_keys[sensor_id]]
+                for sensor_id in set(self.sensor_ids)}
 
 class Observations:
     w1s_re = re.compile(r'^28-(?P<ser>[a-zA-Z0-9])+/w1_slave$')
@@ -134,9 +238,46 @@ class Observations:
     class NotADataObservation(Exception):
         pass
 
-    def __init__(self, raw_location):
+    # Scans can sit in a collector's spool for a while before upload, so a raw
+    # file may hold observations from up to this long before its filename time.
+    default_slack_ns = 24 * 3600 * 10**9
+
+    def __init__(self, raw_location, file_filter=None, slack_ns=default_slack_ns, store=None, file_read=None,
+                 segment_start=None):
+        """file_filter, if given, is called with each raw file's absolute name
+        and a [size, version] stamp for it; files it returns false for are
+        skipped unopened. file_read, if given, is called with the absolute
+        name of each file (or segment) once all of it has been read and
+        parsed. segment_start, if given, is called with a segment's absolute
+        name and returns the uncompressed offset to read it from (see
+        segments.read_segment), so files packed in it before then are
+        skipped. slack_ns widens the since/until filename filter to cover
+        late uploads.
+
+        An s3://bucket/prefix raw_location is read through store (see
+        objectstore.py), by default a plain S3ObjectStore for the bucket.
+        "Filenames" are then s3://bucket/key URLs.
+        """
         self.observations = dict()
         self.raw_location = raw_location
+        self.file_filter = file_filter
+        self.file_read = file_read
+        self.segment_start = segment_start
+        self.slack_ns = slack_ns
+        self.sensor_keys = Interner()
+        s3 = location_is_s3(raw_location)
+        if s3 and store is None:
+            store = objectstore.open_object_store(s3.group('bucket'))
+        self.store = store
+
+    def _key(self, name):
+        """Object key for an s3://bucket/key name, as a 'directory' prefix
+        ending in '/' if it's not a file."""
+        return location_is_s3(name).group('key')
+
+    def _prefix(self, dirname):
+        key = self._key(dirname).rstrip('/')
+        return key + '/' if key else ''
 
     @classmethod
     def transform1(cls, obj):
@@ -179,8 +320,9 @@ class Observations:
                 raise RuntimeError('No fallback time found: {}'.format(repr(obj)))
         return fb
 
-    def process_observation(self, obj):
-        """OLD"""
+    def process_observation(self, obj, metadata=None):
+        """OLD: add obj's datapoints to self.observations, by sensor key, as
+        Observation instances carrying metadata."""
         if 'uptime' in obj:
             raise Observations.NotADataObservation()
         try:
@@ -188,27 +330,25 @@ class Observations:
         except KeyError:
             self.transform1(obj)
             dps = obj['datapoints']
-        fallback_time = None
         for p in dps:
             try:
                 isotime = p['isotime']
             except KeyError:
                 isotime = self.get_fallback_time(obj)
 
-            try:
-                uuid = p['recording_event']
-            except KeyError:
-                uuid = uuid.uuid4()
+            event_id = p.get('recording_event', obj.get('recording_event'))
+            if event_id is None:
+                event_id = str(uuid.uuid4())
 
             k = p['key']
             if k in self.observations:
                 self.observations[k].append(Observation(
-                    isotime, k, p['value'], uuid, self.current_metadata))
+                    isotime, k, p['value'], event_id, metadata))
             else:
                 self.observations[k] = [Observation(
-                    isotime, k, p['value'], uuid, self.current_metadata)]
+                    isotime, k, p['value'], event_id, metadata)]
 
-    def process_w1logger_json(self, blob):
+    def process_w1logger_json(self, blob, metadata=None):
         """Bring into the dataset one observation recorded by w1datalogger.w1logger (or
         a list of these, if we're processing a rollup):
 
@@ -256,38 +396,42 @@ class Observations:
         recording_event is the context.aws_request_id of this recording, so
         it's a uniquifier for recordings that happen through the same endpoint
         in the same second.
+
+        metadata is the METADATA.json content that applies to the recording.
         """
         if isinstance(blob, list):
             for elem in blob:
                 try:
-                    self.process_observation(elem)
+                    self.process_observation(elem, metadata)
                 except Observations.NotADataObservation:
                     pass  # TBD: process status info
         elif isinstance(blob, dict):
             try:
-                self.process_observation(elem)
+                self.process_observation(blob, metadata)
             except Observations.NotADataObservation:
                 pass  # TBD: process status info
         else:
             raise RuntimeError("Unrecognized JSON input (need object or array)")
 
-    def process_w1logger_file(self, infile):
+    def process_w1logger_file(self, infile, metadata=None):
         """Read in a single observation recording (which might have multiple
         observations in it, if the client cached some and reported them later;
         also note each observation includes datapoints for the entire 1-Wire
         bus), or a rollup file (simply a collection of observation recordings
         rewritten as a list).
         """
-        blob = json.load(infile)
-        return self.process_w1logger_json(blob)
+        for blob in iter_json_array(infile):
+            self.process_w1logger_json(blob, metadata)
 
     def metadata(self, abs_dirname):
         mf_name = os.path.join(abs_dirname, "METADATA.json")
         logger.debug("Processing {}".format(mf_name))
         try:
+            if self.store is not None:
+                return json.loads(self.store.get(self._prefix(abs_dirname) + "METADATA.json"))
             with open(mf_name, 'r') as mf:
                 return json.load(mf)
-        except IOError:
+        except (IOError, objectstore.NoSuchKey):
             logger.debug("No readable METADATA.json in dir {}".format(
                 self.raw_location))
         except json.decoder.JSONDecodeError:
@@ -295,73 +439,235 @@ class Observations:
             sys.exit(65)  # EX_DATAERR
         return {}
 
-    def generate_dir(self, dirname, metadata_base):
-        metadata = metadata_base.copy()
-        metadata.update(self.metadata(dirname))
-        logger.debug("dirname:{} metadata:{}".format(dirname, metadata))
-        with os.scandir(dirname) as s:
-            for entry in s:
-                if not entry.is_file():
-                    continue
-                if not entry.name[-5:] == '.json':
-                    continue
-                if entry.name == 'METADATA.json':
+    def dir_files(self, dirname, since=None, until=None):
+        """Absolute filenames of the raw observation files in an endpoint dir,
+        loose files and packed segments (see segments.py) alike.
+
+        since and until (epoch ns) keep only files that can hold observations
+        in [since, until), judging by the upload time in the filename alone:
+        from since up to until + slack_ns. Files whose names don't start with
+        a time are always kept, except that an object store is only listed
+        from the keys named for since, less slack_ns (see _dir_entries).
+        """
+        if since is not None or until is not None:
+            low = since
+            high = None if until is None else until + self.slack_ns
+        else:
+            low = high = None
+        filenames = list()
+        for name, stamp in self._dir_entries(dirname, low):
+            if segments.is_segment(name):
+                if low is not None or high is not None:
+                    begin, end = (datetime_ns(dt) for dt in segments.segment_period(name))
+                    if (low is not None and end <= low) or (high is not None and begin >= high):
+                        continue
+            elif not name[-5:] == '.json':
+                continue
+            elif os.path.basename(name) == 'METADATA.json':
+                continue
+            elif low is not None or high is not None:
+                t = self.time_from_filename(name)
+                if t is not None and ((low is not None and t < low) or
+                                      (high is not None and t >= high)):
                     continue
+            if self.file_filter is not None and not self.file_filter(name, stamp):
+                continue
+            filenames.append(name)
+        return filenames
+
+    def _dir_entries(self, dirname, since=None):
+        """(name, [size, version]) for the files in an endpoint dir, in name
+        order, which is upload time order for raw files.
+
+        An object store lists keys in that order already, so with since it
+        starts listing at the keys named for since less slack_ns (a margin
+        for names carrying a local UTC offset) rather than paging through the
+        endpoint's whole history. Keys not named by time but starting with a
+        digit can sort before that and be missed; segments and METADATA.json
+        start with letters, so they sort after every time and are listed."""
+        if self.store is not None:
+            prefix = self._prefix(dirname)
+            start_after = None if since is None else prefix + ns_isoformat(since - self.slack_ns)[:19]
+            for key, size, version in self.store.list(prefix, start_after):
+                yield os.path.join(dirname, key[len(prefix):]), [size, version]
+            return
+        with os.scandir(dirname) as s:
+            entries = sorted((entry for entry in s if entry.is_file()), key=lambda entry: entry.name)
+        for entry in entries:
+            name = os.path.join(dirname, entry.name)
+            if segments.is_segment(name):
+                yield name, segments.segment_stamp(name)
+                continue
+            st = entry.stat()
+            yield name, [st.st_size, st.st_mtime_ns]
+
+    @classmethod
+    def time_from_filename(cls, filename):
+        """Epoch ns from a raw filename's <UTC isotime> part, or None."""
+        isotime, sep, _ = os.path.basename(filename).partition(';')
+        if not sep:
+            return None
+        try:
+            return isotime_ns(isotime)
+        except ValueError:
+            return None
 
-                abs_filename = os.path.join(dirname, entry.name)
+    @classmethod
+    def event_from_filename(cls, abs_filename):
+        """Raw files are named <UTC isotime>;<event id>.json"""
+        _, _, event = os.path.basename(abs_filename)[:-5].partition(';')
+        return event or None
+
+    def read_files(self, filenames):
+        """Yield (filename, scans) for each of filenames, where scans iterates
+        over the file's parsed top-level elements as they're decoded, so a
+        file holding a long backlog of scans is never in memory all at once.
+        Object store files are fetched concurrently. A segment yields each raw
+        file packed in it, under that file's own name. Whatever of a file
+        can't be read or parsed is logged and skipped."""
+        if self.store is not None:
+            keys = {self._key(name): name for name in filenames}
+            for key, data in objectstore.get_many(self.store, list(keys)):
+                if data is None:
+                    continue
+                yield keys[key], self._stream_scans(keys[key], io.TextIOWrapper(io.BytesIO(data)))
+            return
+        for abs_filename in filenames:
+            if segments.is_segment(abs_filename):
+                dirname = os.path.dirname(abs_filename)
+                start = 0 if self.segment_start is None else self.segment_start(abs_filename) or 0
                 try:
-                    with open(abs_filename, 'r') as f:
-                        blob_list = json.load(f)
-                except:
-                    logger.exception()
+                    for name, blob_list in segments.read_segment(abs_filename, start):
+                        yield os.path.join(dirname, name), blob_list
+                except (IOError, ValueError, EOFError):
+                    logger.exception("Couldn't read segment {}".format(abs_filename))
                     continue
+                if self.file_read is not None:
+                    self.file_read(abs_filename)
+                continue
+            yield abs_filename, self._stream_scans(abs_filename)
 
-                for blob in blob_list:
-
-                    # w1datalogger includes some logger health info for us to ignore.
-                    if 'uptime' in blob:
-                        continue
+    def _stream_scans(self, name, f=None):
+        try:
+            if f is None:
+                f = open(name, 'r')
+            with f:
+                yield from iter_json_array(f)
+        except (IOError, ValueError):
+            logger.exception("Couldn't read {}".format(name))
+            return
+        if self.file_read is not None:
+            self.file_read(name)
+
+    def file_datapoints(self, abs_filename, blob_list):
+        """Yield (isotime, sensor_key, value, event_id) for each datapoint in one
+        raw observation file's parsed content."""
+        file_event = self.event_from_filename(abs_filename)
+
+        for blob in blob_list:
+
+            # w1datalogger includes some logger health info for us to ignore.
+            if 'uptime' in blob:
+                continue
 
-                    try:
-                        dps = blob['datapoints']
-                    except (KeyError, TypeError):
-                        self.transform1(blob)
-                        dps = blob['datapoints']
-                    fallback_time = None
-                    for p in dps:
-                        try:
-                            isotime = p['isotime']
-                        except KeyError:
-                            isotime = self.get_fallback_time(blob)
+            try:
+                dps = blob['datapoints']
+            except (KeyError, TypeError):
+                self.transform1(blob)
+                dps = blob['datapoints']
+            blob_event = blob.get('recording_event', file_event)
+            for p in dps:
+                try:
+                    isotime = p['isotime']
+                except KeyError:
+                    isotime = self.get_fallback_time(blob)
 
-                        try:
-                            p_uuid = p['recording_event']
-                        except KeyError:
-                            p_uuid = uuid.uuid4()
+                p_uuid = p.get('recording_event', blob_event)
+                if p_uuid is None:
+                    p_uuid = str(uuid.uuid4())
 
-                        k = p['key']
+                yield isotime, p['key'], p['value'], p_uuid
 
-                        yield Observation(isotime, k, p['value'], p_uuid, metadata)
+    def dir_metadata(self, dirname, metadata_base):
+        """The interned metadata for an endpoint dir: its METADATA.json
+        overlaid on metadata_base."""
+        metadata = metadata_base.copy()
+        metadata.update(self.metadata(dirname))
+        logger.debug("dirname:{} metadata:{}".format(dirname, metadata))
+        return intern_metadata(metadata)
+
+    def generate_dir(self, dirname, metadata_base, since=None, until=None):
+        metadata = self.dir_metadata(dirname, metadata_base)
+        for abs_filename, blob_list in self.read_files(self.dir_files(dirname, since, until)):
+            for isotime, k, value, p_uuid in self.file_datapoints(abs_filename, blob_list):
+                yield Observation(isotime, k, value, p_uuid, metadata)
+
+    def generate_dir_batches(self, dirname, metadata_base, batch_size=ObservationBatch.default_size,
+                             since=None, until=None):
+        """Like generate_dir, but yield ObservationBatch instances of up to
+        batch_size datapoints instead of one Observation per datapoint."""
+        metadata = self.dir_metadata(dirname, metadata_base)
+        yield from self.generate_files_batches(self.dir_files(dirname, since, until), metadata, batch_size)
+
+    def generate_files_batches(self, filenames, metadata, batch_size=ObservationBatch.default_size):
+        """ObservationBatch instances for the datapoints in a list of raw files
+        that share metadata."""
+        batch = ObservationBatch(self.sensor_keys, metadata)
+        for abs_filename, blob_list in self.read_files(filenames):
+            for isotime, k, value, p_uuid in self.file_datapoints(abs_filename, blob_list):
+                batch.append(isotime, k, value, p_uuid)
+                if len(batch) >= batch_size:
+                    yield batch.finish()
+                    batch = ObservationBatch(self.sensor_keys, metadata)
+        if len(batch):
+            yield batch.finish()
+
+    def endpoint_dirs(self):
+        logger.debug("raw_location:{}".format(self.raw_location))
+        if self.store is not None:
+            return [os.path.join(self.raw_location, name)
+                    for name in self.store.list_dirs(self._prefix(self.raw_location))]
 
+        dirnames = list()
+        with os.scandir(self.raw_location) as s:
+            for entry in s:
+                if entry.is_dir():
+                    dirnames.append(os.path.join(self.raw_location, entry.name))
+        return dirnames
 
-    def generate_all(self):
+    def generate_all(self, since=None, until=None):
         """Walk subdirs of self.raw_location, yielding Observation instances. Each
         subdir is an observer endpoint. Note METADATA.JSON files while walking;
         build a metadata object to be associated with each datapoint by
         overlaying subdir metadata onto parent-dir metadata. (Eventual rollups
         can coalesce these so they don't burn space, but that's not our problem
         here.)
+
+        since and until (epoch ns) prune raw files by filename; see dir_files.
+        Observations from the files that are read are all yielded, even ones
+        a little outside the range.
         """
         metadata_base = self.metadata(self.raw_location)
-        if location_is_s3(self.raw_location):
-            raise RuntimeError("not yet implemented")
+        for child_dirname in self.endpoint_dirs():
+            yield from self.generate_dir(child_dirname, metadata_base, since, until)
 
-        logger.debug("raw_location:{}".format(self.raw_location))
-        with os.scandir(self.raw_location) as s:
-            for entry in s:
-                if entry.is_dir():
-                    child_dirname = os.path.join(self.raw_location, entry.name)
-                    yield from self.generate_dir(child_dirname, metadata_base)
+    def generate_all_batches(self, batch_size=ObservationBatch.default_size, since=None, until=None):
+        """generate_all, yielding ObservationBatch instances."""
+        metadata_base = self.metadata(self.raw_location)
+        for child_dirname in self.endpoint_dirs():
+            yield from self.generate_dir_batches(child_dirname, metadata_base, batch_size, since, until)
+
+    def file_chunks(self, chunk_size=256, since=None, until=None):
+        """Split the raw files into independent units of work: yield (metadata,
+        filenames) with at most chunk_size files, never spanning endpoint
+        dirs, in the order generate_all_batches would read them.
+        """
+        metadata_base = self.metadata(self.raw_location)
+        for child_dirname in self.endpoint_dirs():
+            metadata = self.dir_metadata(child_dirname, metadata_base)
+            filenames = self.dir_files(child_dirname, since, until)
+            for i in range(0, len(filenames), chunk_size):
+                yield metadata, filenames[i:i + chunk_size]
 
 if __name__ == '__main__':
   if False:  # saving some old code here
@@ -386,5 +692,3 @@ if __name__ == '__main__':
         print("ncols:{} nrows:{}".format(ncols, nrows))
         rollup = numpy.empty([nrows, ncols], dtype=numpy.float64)
         print(rollup); sys.exit(0)
-
-    return 0
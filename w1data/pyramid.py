@@ -0,0 +1,98 @@
+"""pyramid.py
+
+Downsampled tiers of each monthly rollup, so a plot of a year reads a few
+thousand buckets instead of every row. Beside year-month-measurement.json,
+each rewrite leaves year-month-measurement.<tier>.bin for each of tiers:
+
+    5m, 1h, 1d: fixed-width UTC buckets of that many seconds
+
+Each is a binary table (see columnar.py) with columns start_ns (bucket start,
+epoch ns), count, min, max and mean, one row per bucket holding any rows.
+Months begin on a UTC midnight, so every bucket falls inside one month and a
+month's tiers are rebuilt from its own rows alone: rewriting a month costs
+one pass over its rows for the finest tier, and the coarser tiers are built
+from the one below.
+"""
+
+import array
+
+from . import columnar
+
+import logging
+logger = logging.getLogger(__name__)
+
+tiers = (("5m", 300), ("1h", 3600), ("1d", 86400))  # finest first
+
+class Aggregates(columnar.Table):
+    """One month's buckets at one tier."""
+    magic = b"W1RA"
+    fields = (('start_ns', 'q'), ('count', 'q'), ('min', 'd'), ('max', 'd'), ('mean', 'd'))
+
+def tier_seconds(tier):
+    return dict(tiers)[tier]
+
+def tier_filename(json_filename, tier):
+    """year-month-measurement.<tier>.bin beside a rollup's .json file."""
+    return "{}.{}.bin".format(json_filename[:-len(".json")], tier)
+
+def aggregate(time_ns, values, seconds):
+    """Bucket time-sorted rows: (start_ns, count, min, max, sum) arrays."""
+    width = seconds * 10**9
+    starts, counts = array.array('q'), array.array('q')
+    mins, maxes, sums = array.array('d'), array.array('d'), array.array('d')
+    current = None
+    for t, v in zip(time_ns, values):
+        start = t - t % width
+        if start != current:
+            current = start
+            starts.append(start)
+            counts.append(1)
+            mins.append(v)
+            maxes.append(v)
+            sums.append(v)
+        else:
+            counts[-1] += 1
+            if v < mins[-1]:
+                mins[-1] = v
+            elif v > maxes[-1]:
+                maxes[-1] = v
+            sums[-1] += v
+    return starts, counts, mins, maxes, sums
+
+def coarsen(buckets, seconds):
+    """Combine finer (start_ns, count, min, max, sum) buckets into wider ones."""
+    width = seconds * 10**9
+    starts, counts = array.array('q'), array.array('q')
+    mins, maxes, sums = array.array('d'), array.array('d'), array.array('d')
+    current = None
+    for t, n, lo, hi, total in zip(*buckets):
+        start = t - t % width
+        if start != current:
+            current = start
+            starts.append(start)
+            counts.append(n)
+            mins.append(lo)
+            maxes.append(hi)
+            sums.append(total)
+        else:
+            counts[-1] += n
+            mins[-1] = min(mins[-1], lo)
+            maxes[-1] = max(maxes[-1], hi)
+            sums[-1] += total
+    return starts, counts, mins, maxes, sums
+
+def write_month(json_filename, time_ns, values):
+    """Rebuild every tier file for one month from its sorted rows."""
+    buckets = None
+    for tier, seconds in tiers:
+        if buckets is None:
+            buckets = aggregate(time_ns, values, seconds)
+        else:
+            buckets = coarsen(buckets, seconds)
+        starts, counts, mins, maxes, sums = buckets
+        means = array.array('d', (total / n for total, n in zip(sums, counts)))
+        columnar.write_table(tier_filename(json_filename, tier), Aggregates.magic, Aggregates.version,
+                             [starts, counts, mins, maxes, means])
+
+def open_month(json_filename, tier):
+    return Aggregates(tier_filename(json_filename, tier))
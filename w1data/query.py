@@ -0,0 +1,203 @@
+"""query.py
+
+Reading rollups back out: rows (or aggregate buckets, see pyramid.py) for a
+measurement over a time range, gathered from the year-month-measurement
+files that cover it and clipped to the range.
+
+A RollupReader keeps the months it has decoded in a small LRU cache, keyed
+by file and checked against the file's mtime, size and inode (rewrites
+rename a new file into place) on every use, so a dashboard repeating the
+same queries only re-reads months w1rollup has rewritten since.
+
+Which months a measurement has comes from the rollup catalog (see
+catalog.py), re-read only when it's replaced, or from a listing of the
+measurement's dir in a rollup location that has no catalog yet.
+"""
+
+import os, json, array, bisect, collections, datetime
+
+from . import columnar, pyramid
+from .catalog import Catalog
+from .common import isotime_ns, datetime_ns
+from .metadata import MetadataStore
+from .rollup import RollupMonthly
+
+import logging
+logger = logging.getLogger(__name__)
+
+class RollupReader:
+    def __init__(self, rollup_location, cache_months=64):
+        self.rollup_location = rollup_location
+        self.cache_months = cache_months
+        self._cache = collections.OrderedDict()  # filename: ((inode, mtime_ns, size), columns)
+        self.hits = self.misses = 0
+        self._catalog = (None, None)  # (stamp, {measurement: [(year, month), ...]})
+
+    @staticmethod
+    def _stamp(st):
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _catalog_months(self):
+        """{measurement: [(year, month), ...]} from the catalog, or None if
+        there isn't one."""
+        catalog = Catalog(self.rollup_location)
+        try:
+            stamp = self._stamp(os.stat(catalog.path))
+        except FileNotFoundError:
+            return None
+        if self._catalog[0] != stamp:
+            catalog.load()
+            months = collections.defaultdict(list)
+            for entry in catalog.months.values():
+                months[entry["measurement"]].append((entry["year"], entry["month"]))
+            self._catalog = (stamp, months)
+        return self._catalog[1]
+
+    def measurements(self):
+        catalog = self._catalog_months()
+        if catalog is not None:
+            return sorted(catalog)
+        names = list()
+        with os.scandir(self.rollup_location) as s:
+            for entry in s:
+                if entry.is_dir() and entry.name != MetadataStore.dirname:
+                    names.append(entry.name)
+        return sorted(names)
+
+    def _listed_months(self, measurement):
+        try:
+            names = os.listdir(os.path.join(self.rollup_location, measurement))
+        except FileNotFoundError:
+            return
+        for name in names:
+            mo = RollupMonthly.name_re.fullmatch(name)
+            if mo is not None and mo.group('measurement') == measurement:
+                yield int(mo.group('year')), int(mo.group('month'))
+
+    def months(self, measurement, since=None, until=None):
+        """(year, month) of the rollup months for measurement that hold times
+        in [since, until) (epoch ns, either None for open-ended), in order."""
+        catalog = self._catalog_months()
+        if catalog is None:
+            listed = self._listed_months(measurement)
+        else:
+            listed = catalog.get(measurement, ())
+        found = list()
+        for year, month in listed:
+            begin = datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc)
+            end = begin + RollupMonthly.dend
+            if (since is not None and datetime_ns(end) <= since) or \
+               (until is not None and datetime_ns(begin) >= until):
+                continue
+            found.append((year, month))
+        return sorted(found)
+
+    def _filename(self, measurement, year, month):
+        return os.path.join(self.rollup_location, measurement,
+                            RollupMonthly.filename_format.format(year, month, measurement))
+
+    def _cached(self, filename, decode):
+        """decode(filename) through the cache."""
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            self._cache.pop(filename, None)
+            return None
+        stamp = self._stamp(st)
+        try:
+            cached_stamp, columns = self._cache[filename]
+            if cached_stamp == stamp:
+                self._cache.move_to_end(filename)
+                self.hits += 1
+                return columns
+        except KeyError:
+            pass
+        self.misses += 1
+        columns = decode(filename)
+        self._cache[filename] = (stamp, columns)
+        while len(self._cache) > self.cache_months:
+            self._cache.popitem(last=False)
+        return columns
+
+    @staticmethod
+    def _decode_columns(filename):
+        with columnar.open_columns(filename) as c:
+            return _copy_table(c)
+
+    @staticmethod
+    def _decode_json(filename):
+        # Rollups written before there were .bin files
+        with open(filename, 'r') as f:
+            rows = json.load(f)["rows"]
+        return array.array('q', (isotime_ns(t) for t, _ in rows)), array.array('d', (v for _, v in rows))
+
+    @staticmethod
+    def _decode_aggregates(filename):
+        with pyramid.Aggregates(filename) as a:
+            return _copy_table(a)
+
+    def month_rows(self, measurement, year, month):
+        """(time_ns, values) arrays of one month, from the cache if it's
+        current. Don't modify them. The .bin beside the .json is used unless
+        it's older: a rewrite that couldn't replace it leaves it stale."""
+        json_filename = self._filename(measurement, year, month)
+        bin_filename = json_filename[:-len(".json")] + ".bin"
+        if _newer_or_alone(bin_filename, json_filename):
+            columns = self._cached(bin_filename, self._decode_columns)
+            if columns is not None:
+                return columns
+        return self._cached(json_filename, self._decode_json)
+
+    def rows(self, measurement, since=None, until=None):
+        """(time_ns, values) arrays of measurement's rows in [since, until)."""
+        times, values = array.array('q'), array.array('d')
+        for year, month in self.months(measurement, since, until):
+            columns = self.month_rows(measurement, year, month)
+            if columns is None:
+                continue
+            _clip_into((times, values), columns, since, until)
+        return times, values
+
+    def aggregates(self, measurement, tier, since=None, until=None):
+        """(start_ns, count, min, max, mean) arrays of measurement's buckets at
+        tier ("5m", "1h" or "1d") starting in [since, until)."""
+        result = tuple(array.array(typecode) for _, typecode in pyramid.Aggregates.fields)
+        for year, month in self.months(measurement, since, until):
+            filename = pyramid.tier_filename(self._filename(measurement, year, month), tier)
+            columns = self._cached(filename, self._decode_aggregates)
+            if columns is None:
+                continue
+            _clip_into(result, columns, since, until)
+        return result
+
+def _copy_table(table):
+    """Arrays copied from an open columnar.Table's columns, each in one
+    go rather than element by element."""
+    columns = list()
+    for name, typecode in table.fields:
+        column = array.array(typecode)
+        with getattr(table, name).cast('B') as raw:
+            column.frombytes(raw)
+        columns.append(column)
+    return tuple(columns)
+
+def _newer_or_alone(filename, other):
+    """Whether filename exists and was modified no earlier than other, or
+    other doesn't exist."""
+    try:
+        mtime_ns = os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    try:
+        return mtime_ns >= os.stat(other).st_mtime_ns
+    except FileNotFoundError:
+        return True
+
+def _clip_into(result, columns, since, until):
+    """Extend the result arrays with the rows of columns (sorted by their
+    first column) whose time is in [since, until)."""
+    times = columns[0]
+    lo = 0 if since is None else bisect.bisect_left(times, since)
+    hi = len(times) if until is None else bisect.bisect_left(times, until)
+    for into, column in zip(result, columns):
+        into.extend(column[lo:hi])
@@ -4,16 +4,38 @@ Maintain rollup files, monthly collections of data from raw observations,
 processed for raw data weirdnesses into rows of (time, value) tuples.
 
 Filename is year-month-measurement.json, where measurement is the name from raw
-observation metadata.
+observation metadata. The file is a JSON object:
+
+    {"metadata": [[isotime, metadata id], ...], "rows": [[isotime, value], ...]}
+
+A month holds at most one row per time: a row is identified by its time
+alone, not by the event id of the recording it came from, so a scan that
+reaches the receiving API twice (a retried post gets a new event id) or a
+raw file read twice makes one row, the last one read.
+
+Each metadata entry gives the earliest row time the metadata applied to. The
+metadata itself lives once per rollup location under METADATA/<id>.json
+(see metadata.py). Older rollups carry the metadata dicts inline; they're
+read as such and rewritten by id.
+
+Each rewrite also leaves year-month-measurement.data for gnuplot,
+year-month-measurement.bin, the same rows as fixed-width binary columns
+(see columnar.py), and year-month-measurement.<tier>.bin, the rows bucketed
+by 5 minutes, an hour and a day (see pyramid.py).
 
 """
 
-import re, os, datetime, json, sys
+import re, os, datetime, json, sys, collections, array
+import concurrent.futures
 import dateutil
 
-from .observations import Observations, Observation
-from .w1datapoint_linux_w1therm import W1Datapoint_Linux_w1therm
-from .common import location_is_s3, datetime_isoformat
+from .observations import Observations
+from . import w1datapoint_linux_w1therm  # registers the 28/w1_slave handler
+from .common import replacing, location_is_s3, datetime_isoformat, datetime_ns, ns_datetime, ns_isoformat, isotime_ns
+from .journal import IngestJournal
+from .metadata import MetadataStore, intern_metadata
+from . import columnar, pyramid, segments
+from .catalog import Catalog, month_key, month_entry, scan_entry
 
 import logging
 logger = logging.getLogger(__name__)
@@ -50,6 +72,10 @@ class RollupMonthly:
     Excludes any directory component - basename only. Our actual absolute
     filename is os.path.join(rollup_location, measurement_name, self.filename).
 
+    self.metadata_series: {metadata id: earliest epoch ns it applies to}.
+    Metadata first seen this run is kept in self._metadata until it's saved
+    to self.metadata_store.
+
     """
 
     # Add this to a datetime to make it the first possible of the month
@@ -73,15 +99,19 @@ class RollupMonthly:
         """datetime for earliest rollup file entry from a datetime object"""
         return datetime_isoformat(dt + self.dbegin)
 
-    def __init__(self, rollup_location, dt_start, measurement_name):
+    def __init__(self, rollup_location, dt_start, measurement_name, metadata_store=None):
         self.rollup_location = rollup_location
+        self.metadata_store = metadata_store or MetadataStore(rollup_location)
         self.dt_start = dt_start
         self.dt_end = dt_start + self.dend
         self.measurement_name = measurement_name
         self.filename = self.filename_format.format(dt_start.year, dt_start.month, measurement_name)
-        self.metadata_series = []  # (earliest, dict), ...
+        self.metadata_series = dict()
+        self._metadata = dict()  # id: Metadata, not yet stored
         self._changed = False
-        self._content = None
+        self._rows = None
+        self._content = dict()
+        self.catalog_entry = None  # for the files last written
 
     def __delete__(self):
         self.flush()
@@ -90,154 +120,470 @@ class RollupMonthly:
         if self._changed:
             self.rewrite()
 
+    # Rough in-memory cost of a row added but not yet merged: dict entry,
+    # key tuple, int and float objects
+    pending_row_bytes = 200
+
+    @property
+    def resident(self):
+        return self._rows is not None
+
+    def resident_bytes(self):
+        """Approximate memory held by this month's rows."""
+        if self._rows is None:
+            return 0
+        return 16 * len(self._rows[0]) + self.pending_row_bytes * len(self._content)
+
+    def file_rows(self):
+        """(time_ns, values) arrays of the rows in our rollup file, without
+        keeping them loaded."""
+        if self._rows is not None:
+            return self._rows
+        self.read_lazy()
+        rows = self._rows
+        self.discard()
+        return rows
+
+    def unload(self):
+        """Flush, then drop rows and metadata from memory; the next add_row
+        reads them back."""
+        self.flush()
+        self.discard()
+
+    def discard(self):
+        """Drop rows and metadata from memory, flushed or not."""
+        self._changed = False
+        self._metadata = dict()
+        self._rows = None
+        self._content = dict()
+        self.metadata_series = dict()
+
     def read_lazy(self):
-        if self._content is None:
-            filename = os.path.join(self.rollup_location, self.filename)
+        """Load rows and metadata already in our rollup file, if any, into
+        self._rows: arrays of times and values, sorted by time. Rows added
+        since go in self._content, keyed by time, until rewrite() merges
+        them in."""
+        if self._rows is None:
+            filename = os.path.join(self.rollup_location, self.measurement_name, self.filename)
+            self._rows = (array.array('q'), array.array('d'))
             try:
                 with open(filename, 'r') as f:
                     try:
-                        self._content = json.load(f)
+                        blob = json.load(f)
                     except json.decoder.JSONDecodeError as e:
                         logger.error("Bad json in {}: {}".format(filename, sys.exc_info()[1]))
                         sys.exit(65)  # EX_DATAERR
-                    except IOError:
-                        logger.error("Couldn't read file {}: {}".format(filename, sys.exc_info()[1]))
             except IOError:
-                self._content = {}
+                return
+            rows = blob["rows"]
+            times = array.array('q', (isotime_ns(t) for t, _ in rows))
+            values = array.array('d', (v for _, v in rows))
+            if any(times[i] > times[i + 1] for i in range(len(times) - 1)):
+                order = sorted(range(len(times)), key=times.__getitem__)
+                times = array.array('q', (times[i] for i in order))
+                values = array.array('d', (values[i] for i in order))
+            self._rows = (times, values)
+            for t, m in blob["metadata"]:
+                if isinstance(m, dict):
+                    self.save_metadata(isotime_ns(t), intern_metadata(m))
+                    self._changed = True  # rewrite by id
+                else:
+                    self._save_metadata_id(isotime_ns(t), m)
+
+    def merged_rows(self):
+        """(times, values) arrays of the file's rows with the ones added
+        since merged in, in one linear pass over both sorted sequences. An
+        added row replaces any file rows at the same time."""
+        old_times, old_values = self._rows
+        times = array.array('q')
+        values = array.array('d')
+        i, n = 0, len(old_times)
+        for t, v in sorted(self._content.items()):
+            while i < n and old_times[i] < t:
+                times.append(old_times[i])
+                values.append(old_values[i])
+                i += 1
+            while i < n and old_times[i] == t:
+                i += 1  # same row, read back from file
+            times.append(t)
+            values.append(v)
+        times.extend(old_times[i:])
+        values.extend(old_values[i:])
+        return times, values
 
     def rewrite(self):
-        if self._content is not None and self._changed:
+        """Merge added rows into the month and replace its files. Each file
+        is written beside the old one and renamed over it, so readers see a
+        whole old or a whole new rollup, and a failed write leaves the old
+        one in place."""
+        if self._rows is not None and self._changed:
             dirname = os.path.join(self.rollup_location, self.measurement_name)
             try:
                 os.makedirs(dirname)
             except FileExistsError:
                 pass
-            # [0]: key: (datetime, uuid).
-            # [1]: value: w1datapoint instance.
-            # [2]: metadata[2] from METADATA.json parent U child
-            content = sorted(map(
-                lambda x: [datetime_isoformat(x[0][0]),x[1].value],
-                self._content.items()))
-
-            # [0]: earliest datetime at which associated metadata applies
-            # [1]: metadata for all items past [0]
-            meta = sorted(map(
-                lambda x: [datetime_isoformat(x[0]),x[1]],
-                self.metadata_series))
-
-            # Rollup files: JSON blobs summarizing raw data
+            times, values = self.merged_rows()
+
+            # [0]: earliest epoch ns at which associated metadata applies
+            # [1]: id of the metadata for all items past [0]
+            for metadata in self._metadata.values():
+                self.metadata_store.save(metadata)
+            self._metadata = dict()
+            meta = [[ns_isoformat(t), metadata_id] for t, metadata_id in
+                    sorted((t, metadata_id) for metadata_id, t in self.metadata_series.items())]
+
+            # Rollup files: JSON blobs summarizing raw data, rows written as
+            # they're formatted rather than built up as one big list
             filename = os.path.join(dirname, self.filename)
             try:
-                with open(filename, 'w') as f:
-                    try:
-                        json.dump({
-                            "metadata": meta,
-                            "rows": content
-                        }, f)
-                    except:
-                        logger.exception("Couldn't write {}: {}:{}".format(filename, sys.exc_info()[0], sys.exc_info()[1]))
-                        raise
+                with replacing(filename) as f:
+                    f.write('{{"metadata": {}, "rows": ['.format(json.dumps(meta)))
+                    separator = ''
+                    for t, v in zip(times, values):
+                        f.write(separator + json.dumps([ns_isoformat(t), v]))
+                        separator = ', '
+                    f.write(']}')
             except:
-                os.unlink(filename)
+                logger.exception("Couldn't write {}".format(filename))
                 raise
 
             # GNUPlot data files with column headers
             plotfilename = filename.replace(".json", ".data")
             logger.debug("plotfilename: {}".format(plotfilename))
             try:
-                with open(plotfilename, 'w') as pf:
+                with replacing(plotfilename) as pf:
                     pf.write('time "{}"\n'.format(self.measurement_name.replace("_", " ")))
-                    for row in content:
-                        pf.write("{} {}\n".format(dateutil.parser.isoparse(row[0]).timestamp(), row[1]))
+                    for t, v in zip(times, values):
+                        pf.write("{} {}\n".format(t / 1e9, v))
             except:
-                logger.warning("Couldn't write {}: {}:{}".format(filename, sys.exc_info()[0], sys.exc_info()[1]))
+                logger.warning("Couldn't write {}: {}:{}".format(plotfilename, sys.exc_info()[0], sys.exc_info()[1]))
+
+            # Binary columns for memory-mapped reading
+            try:
+                columnar.write_columns(self.columns_filename, times, values)
+            except:
+                logger.warning("Couldn't write {}: {}:{}".format(
+                    self.columns_filename, sys.exc_info()[0], sys.exc_info()[1]))
+
+            # Downsampled tiers for long-range reading
+            try:
+                pyramid.write_month(filename, times, values)
+            except:
+                logger.warning("Couldn't write aggregates for {}: {}:{}".format(
+                    filename, sys.exc_info()[0], sys.exc_info()[1]))
+
+            try:
+                self.catalog_entry = month_entry(self.dt_start.year, self.dt_start.month,
+                                                 self.measurement_name, filename, times, values)
+            except:
+                logger.warning("Couldn't catalog {}: {}:{}".format(filename, sys.exc_info()[0], sys.exc_info()[1]))
+
+            self._rows = (times, values)
+            self._content = dict()
+            self._changed = False
+
+    @property
+    def columns_filename(self):
+        return os.path.join(self.rollup_location, self.measurement_name,
+                            self.filename[:-len(".json")] + ".bin")
+
+    def open_columns(self):
+        """This month's rows as memory-mapped arrays; see columnar.Columns."""
+        return columnar.open_columns(self.columns_filename)
+
+    def open_aggregates(self, tier):
+        """This month's buckets at tier ("5m", "1h" or "1d"); see pyramid.py."""
+        return pyramid.open_month(os.path.join(self.rollup_location, self.measurement_name, self.filename), tier)
+
+    def _save_metadata_id(self, dt, metadata_id):
+        earliest = self.metadata_series.get(metadata_id)
+        if earliest is None or dt < earliest:
+            self.metadata_series[metadata_id] = dt
 
     def save_metadata(self, dt, metadata):
-        for (index, (earliest, m)) in enumerate(self.metadata_series):
-            # logger.debug("save_metadata. {} is {}, {}".format(index, earliest, m))
-            if m == metadata:
-                # logger.debug("save_metadata. equal")
-                if dt < earliest:
-                    # logger.debug("save_metadata. reassign as {}, {}".format(dt, m))
-                    self.metadata_series[index] = (dt, m)
-                return
-        self.metadata_series.append((dt, metadata))
-        self.metadata_series.sort()
+        """Note that interned metadata applies from dt (epoch ns) on."""
+        if metadata.id not in self.metadata_series and metadata.id not in self.metadata_store:
+            self._metadata[metadata.id] = metadata
+        self._save_metadata_id(dt, metadata.id)
 
     def add_row(self, row_time, row_uuid, row_value, metadata):
+        """row_time is integer ns since the epoch, row_value a float,
+        metadata interned (or a dict, which gets interned). A later row at
+        the same row_time replaces this one, whatever its row_uuid."""
         self._changed = True
-        if self._content is None:
+        if self._rows is None:
             self.read_lazy()
-        self.save_metadata(row_time, metadata)
-        self._content[(row_time, row_uuid)] = row_value
+        self.save_metadata(row_time, intern_metadata(metadata))
+        self._content[row_time] = row_value
 
 class RollupMonthlyCollection:
     """Maintain a collection of monthly rollups.
 
     .rollup_location/measurement_name/year-month-measurement_name.json
+
+    Months are added to .collection as rows arrive for them; an existing
+    month's file is read back then, so startup reads nothing. Only the ones
+    with rows loaded count against max_months and max_bytes (approximate, see
+    RollupMonthly.resident_bytes). Past either, the least recently used
+    months are flushed and unloaded after each batch, to be read back if
+    they're touched again. Each endpoint dir's raw files are read in time
+    order (see Observations._dir_entries), so months are mostly finished
+    with by the time they're evicted. A month that fails to write when
+    evicted stays loaded and changed, for flush() to try again, and flush()
+    reports the months eviction wrote as well as its own.
     """
 
-    def __init__(self, rollup_location):
+    def __init__(self, rollup_location, max_months=None, max_bytes=None, rescan=False):
         self._location = rollup_location
         self.collection = dict()
+        self.max_months = max_months
+        self.max_bytes = max_bytes
+        self.resident = collections.OrderedDict()  # ymm: RollupMonthly, least recently used first
+        self.evictions = 0
+        self.evicted = dict()  # ymm: whether evict() last wrote it, since the last flush()
+        self.metadata_store = MetadataStore(rollup_location)
+        self.catalog = Catalog(rollup_location)
         if location_is_s3(rollup_location):
             raise RuntimeError("not yet implemented")
-        for measurement_entry in os.scandir(rollup_location):
-            if measurement_entry.is_dir():
-                measurement_dir = os.path.join(rollup_location, measurement_entry.name)
+        if rescan or not self.catalog.exists():
+            self.rescan()
+
+    def rescan(self):
+        """Find the months in the rollup tree, and catalog them afresh."""
+        self.catalog.updates = dict()
+        for measurement_entry in os.scandir(self._location):
+            if measurement_entry.is_dir() and measurement_entry.name != MetadataStore.dirname:
+                measurement_dir = os.path.join(self._location, measurement_entry.name)
                 for entry in os.scandir(measurement_dir):
                     if entry.is_file():
                         mo = RollupMonthly.name_re.match(entry.name)
                         if mo:
                             dtb = datetime.datetime(year=int(mo.group('year')), month=int(mo.group('month')), day=1)
-                            self.collection[(dtb.utctimetuple(), measurement_entry.name)] = RollupMonthly(rollup_location, dtb, measurement_entry.name)
+                            monthly = self.get_monthly((dtb.year, dtb.month, measurement_entry.name))
+                            self.catalog.update(month_key(measurement_entry.name, monthly.filename), scan_entry(
+                                dtb.year, dtb.month, measurement_entry.name,
+                                os.path.join(measurement_dir, entry.name), monthly.file_rows))
                         else:
                             logger.debug('RMC init skipped file {}'.format(entry.name))
                     else:
                         logger.debug('RMC init skipped non-file {}'.format(entry.name))
             else:
                 logger.debug('RMC init skipped non-dir {}'.format(measurement_entry.name))
+        self.catalog.replace = bool(self.catalog.updates)  # an empty location stays empty
+
+    def _catalog(self, monthly):
+        """Note the files monthly last wrote in the catalog."""
+        if monthly.catalog_entry is not None:
+            self.catalog.update(month_key(monthly.measurement_name, monthly.filename), monthly.catalog_entry)
+            monthly.catalog_entry = None
+
+    def flush(self, jobs=1):
+        """Rewrite every changed month, across jobs processes if more than
+        one. A month that fails is logged and the rest carry on. Returns
+        (flushed, failed): lists of the year-month-measurement keys of the
+        months written, here or by evict() since the last flush, and of the
+        ones that couldn't be, here or there, and haven't been since.
+        """
+        dirty = sorted((ymm, monthly) for ymm, monthly in self.collection.items() if monthly._changed)
+        flushed, failed = list(), list()
+        if jobs > 1 and len(dirty) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = [(ymm, monthly, executor.submit(_flush_monthly, monthly)) for ymm, monthly in dirty]
+                for ymm, monthly, future in futures:
+                    try:
+                        monthly_entry = future.result()
+                    except Exception:
+                        logger.error("Couldn't flush {}: {}".format(ymm, sys.exc_info()[1]))
+                        failed.append(ymm)
+                        continue
+                    # The worker wrote our rows; drop our stale copy of them
+                    monthly.discard()
+                    monthly.catalog_entry = monthly_entry
+                    self._catalog(monthly)
+                    self.resident.pop(ymm, None)
+                    flushed.append(ymm)
+        else:
+            for ymm, monthly in dirty:
+                try:
+                    monthly.flush()
+                except Exception:
+                    logger.error("Couldn't flush {}: {}".format(ymm, sys.exc_info()[1]))
+                    failed.append(ymm)
+                    continue
+                self._catalog(monthly)
+                flushed.append(ymm)
+        # Whichever write of a month came last says how it went
+        outcomes = dict(self.evicted)
+        outcomes.update((ymm, True) for ymm in flushed)
+        outcomes.update((ymm, False) for ymm in failed)
+        flushed = sorted(ymm for ymm, ok in outcomes.items() if ok)
+        failed = sorted(ymm for ymm, ok in outcomes.items() if not ok)
+        self.evicted = dict()
+        self.catalog.save()
+        logger.info("Flushed {} months: {}".format(len(flushed), format_ymms(flushed)))
+        if failed:
+            logger.warning("{} months failed to flush: {}".format(len(failed), format_ymms(failed)))
+        return flushed, failed
+
+    def touch(self, ymm, monthly):
+        """Note monthly as most recently used."""
+        self.resident[ymm] = monthly
+        self.resident.move_to_end(ymm)
+
+    def evict(self):
+        """Flush and unload least recently used months until within limits."""
+        while self.resident:
+            over_months = self.max_months is not None and len(self.resident) > self.max_months
+            over_bytes = self.max_bytes is not None and len(self.resident) > 1 and \
+                sum(m.resident_bytes() for m in self.resident.values()) > self.max_bytes
+            if not (over_months or over_bytes):
+                break
+            ymm, monthly = self.resident.popitem(last=False)
+            logger.debug("evicting {}".format(ymm))
+            try:
+                monthly.unload()
+            except Exception:
+                # Still changed, so flush() tries it again
+                logger.error("Couldn't flush {}: {}".format(ymm, sys.exc_info()[1]))
+                self.evicted[ymm] = False
+                continue
+            self._catalog(monthly)
+            self.evicted[ymm] = True
+            self.evictions += 1
+
+    def get_monthly(self, ymm):
         try:
-            # logger.debug("first key: {}".format(list(self.collection.keys())[0]))
-            self.most_recent_ymm_init = sorted(self.collection.keys())[-1]
-        except IndexError:
-            self.most_recent_ymm_init = None
-        self.all_ymms_init = set(self.collection.keys())
-
-    def flush(self):
-        for _, collection in self.collection.items():
-            collection.flush()
-
-    def add_observation(self, observation, ymm):
-        try:
-            c = self.collection[ymm]
+            return self.collection[ymm]
         except KeyError:
             dt = datetime.datetime(year=ymm[0], month=ymm[1], day=1, hour=0, minute=0, second=0)
             measurement = ymm[2]
-            c = self.collection[ymm] = RollupMonthly(self._location, dt + RollupMonthly.dbegin, measurement)
-        c.add_row(observation.datetime, observation.uuid, observation.datapoint, observation.metadata)
-
-    def save_quick(self, observation):
-        """Store this observation into an appropriate new or existing rollup, taking a
-        shortcut: if rollup exists and isn't the most recent, assume the
-        observation is already in it.
+            c = self.collection[ymm] = RollupMonthly(self._location, dt + RollupMonthly.dbegin, measurement,
+                                                      self.metadata_store)
+            return c
+
+    def save_batch(self, batch):
+        """Add every row of an ObservationBatch to its month's rollup, working
+        straight from the arrays. Rows whose value didn't decode (NaN) or whose
+        scratchpad failed its CRC are dropped.
         """
-        okey = observation.key
-        ymm = observation.year_month_measurement()
-        # logger.debug("ymm:{}".format(ymm))
-        if ymm == self.most_recent_ymm_init:
-            self.add_observation(observation, ymm)
-        else:
-            if ymm not in self.all_ymms_init:
-                self.add_observation(observation, ymm)
-            else:
-                logger.debug("skipped okey:{} tuple:{}".format(okey, ymm))
-
-def do_rollup(rollup_location, raw_location):
-    logger.debug("do_rollup(rollup_location:{}, raw_location:{})".format(rollup_location, raw_location))
-    rollup_collection = RollupMonthlyCollection(rollup_location)
-    observations = Observations(raw_location)
-    for observation in observations.generate_all():
-        logger.debug("obs:{}".format(observation))
-        rollup_collection.save_quick(observation)
-    rollup_collection.flush()
+        measurements = batch.sensor_measurements()
+        month_begin = month_end = None
+        ymm = monthly = None
+        for t, sensor_id, value, crc_ok, event_id in zip(batch.time_ns, batch.sensor_ids, batch.values,
+                                                         batch.crc_ok, batch.event_ids):
+            if value != value or not crc_ok:
+                continue
+            if month_begin is None or not month_begin <= t < month_end:
+                year, month, month_begin, month_end = month_bounds_ns(t)
+            if ymm is None or ymm[:2] != (year, month) or ymm[2] != measurements[sensor_id]:
+                ymm = (year, month, measurements[sensor_id])
+                monthly = self.get_monthly(ymm)
+                self.touch(ymm, monthly)
+            monthly.add_row(t, batch.events[event_id], value, batch.metadata)
+        self.evict()
+
+def _flush_monthly(monthly):
+    """Process pool worker: rewrite one month's files. Returns the month's
+    catalog entry."""
+    monthly.flush()
+    return monthly.catalog_entry
+
+def month_bounds_ns(t):
+    """(year, month, first ns of month, first ns of next month) for epoch ns t."""
+    dt = ns_datetime(t)
+    begin = dt + RollupMonthly.dbegin
+    return dt.year, dt.month, datetime_ns(begin), datetime_ns(begin + RollupMonthly.dend)
+
+def _chunk_batches(raw_location, store, metadata, filenames, segment_starts):
+    """Process pool worker: parse and decode one chunk of raw files, reading
+    segments from segment_starts ({name: offset}). Returns the batches and
+    the names of the files read through. Lives here rather than in
+    observations so that importing it in a fresh worker process also
+    registers the w1therm datapoint handler.
+    """
+    read = list()
+    observations = Observations(raw_location, store=store, file_read=read.append,
+                                segment_start=segment_starts.get)
+    return list(observations.generate_files_batches(filenames, metadata)), read
+
+def generate_batches_parallel(observations, jobs, since=None, until=None):
+    """ObservationBatch instances for all of observations' raw files, parsed by
+    a pool of jobs processes a file chunk at a time. Batches come back in the
+    serial order, with at most 2 * jobs chunks in flight. observations'
+    file_read callback is made for the workers' files as their chunks come
+    back.
+    """
+    def results(future):
+        batches, read = future.result()
+        if observations.file_read is not None:
+            for filename in read:
+                observations.file_read(filename)
+        return batches
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        in_flight = collections.deque()
+        for metadata, filenames in observations.file_chunks(since=since, until=until):
+            segment_starts = dict()
+            if observations.segment_start is not None:
+                segment_starts = {f: observations.segment_start(f) for f in filenames if segments.is_segment(f)}
+            in_flight.append(executor.submit(_chunk_batches, observations.raw_location, observations.store,
+                                             metadata, filenames, segment_starts))
+            if len(in_flight) >= 2 * jobs:
+                yield from results(in_flight.popleft())
+        while in_flight:
+            yield from results(in_flight.popleft())
+
+def format_ymms(ymms):
+    """Year-month-measurement keys as "2020-02-office_temperature, ..."."""
+    return ", ".join("{}-{:02}-{}".format(*ymm) for ymm in ymms)
+
+def do_rollup(rollup_location, raw_location, jobs=1, since=None, until=None,
+              slack_ns=Observations.default_slack_ns, store=None, max_months=None, max_bytes=None,
+              rescan=False, report=None):
+    """Bring rollups up to date with the raw observations. Only raw files the
+    ingest journal hasn't seen are parsed, and only the months their rows
+    fall in are read back, merged and rewritten, however old those are.
+
+    since and/or until (epoch ns) re-roll a time range instead: raw files
+    are picked by the time in their names alone (with slack_ns extra after
+    until for late uploads) and ingested whether or not the journal has
+    seen them.
+
+    store overrides the object store used for an s3:// raw_location.
+
+    max_months and max_bytes bound the months held in memory at once; see
+    RollupMonthlyCollection. jobs processes also share the final flush.
+
+    rescan rebuilds the rollup catalog (see catalog.py) from the tree
+    rather than trusting it.
+
+    report, a text stream, gets a line listing the months written and one
+    listing any that failed.
+
+    Returns None, or 74 (EX_IOERR) if some months couldn't be written. The
+    journal isn't committed then, so their raw files are read again next
+    time.
+    """
+    logger.debug("do_rollup(rollup_location:{}, raw_location:{}, jobs:{}, since:{}, until:{})".format(
+        rollup_location, raw_location, jobs, since, until))
+    rollup_collection = RollupMonthlyCollection(rollup_location, max_months, max_bytes, rescan)
+    journal = IngestJournal(rollup_location, raw_location)
+    ranged = since is not None or until is not None
+    observations = Observations(raw_location, file_filter=journal.record if ranged else journal.is_new,
+                                slack_ns=slack_ns, store=store, file_read=journal.ingested,
+                                segment_start=None if ranged else journal.segment_start)
+    if jobs > 1:
+        batches = generate_batches_parallel(observations, jobs, since, until)
+    else:
+        batches = observations.generate_all_batches(since=since, until=until)
+    for batch in batches:
+        logger.debug("batch of {} observations".format(len(batch)))
+        rollup_collection.save_batch(batch)
+    flushed, failed = rollup_collection.flush(jobs)
+    if report is not None:
+        report.write("Flushed {} months: {}\n".format(len(flushed), format_ymms(flushed)))
+        if failed:
+            report.write("Failed to flush {} months: {}\n".format(len(failed), format_ymms(failed)))
+    if failed:
+        return 74  # EX_IOERR
+    journal.commit()
@@ -0,0 +1,192 @@
+"""segments.py
+
+Packed raw observation segments: many small raw files from one endpoint
+directory, concatenated into one append-only file per day or month.
+
+A segment is SEGMENT-<period>.jsonl (or .jsonl.gz), where period is
+YYYY-MM-DD or YYYY-MM of the upload times in the packed filenames. Each line
+is {"file": <original raw filename>, "blob": <its parsed content>}, so event
+ids and upload times carried in filenames survive. A gzipped segment is a
+series of gzip members, one per append, which gzip reads as one stream.
+
+Next to each segment, <segment>.idx is a JSON object:
+
+    {"stored_size": bytes of the segment file that are committed,
+     "size": the same, uncompressed,
+     "files": {original filename: [offset, length] in the uncompressed stream}}
+
+The index is replaced atomically after each append is fsynced, and readers
+only read the first stored_size bytes, so an append that dies part way is
+invisible and gets truncated away by the next compaction. Loose files are
+unlinked only after the index that covers them is committed; if that's
+interrupted the leftovers are packed again, and rollup's row keys make the
+repeat harmless. For the same reason a segment is journaled (see journal.py)
+by its index's size and mtime, not the segment file's: the data of an
+append lands before the index that commits it.
+
+The journal also keeps the uncompressed size a segment had when it was
+ingested, and read_segment() can start there: the index's offsets say
+where each packed file starts, so a segment that's been appended to since
+costs a read of what was appended, not of the whole period again.
+"""
+
+import os, re, json, gzip, io, datetime
+
+from .common import replacing
+
+import logging
+logger = logging.getLogger(__name__)
+
+segment_re = re.compile(r'^SEGMENT- (?P<period> \d{4}-\d{2}(-\d{2})?) [.]jsonl (?P<gz> [.]gz)? $', re.X)
+index_suffix = ".idx"
+
+def is_segment(filename):
+    return segment_re.match(os.path.basename(filename)) is not None
+
+def segment_period(filename):
+    """(begin, end) datetimes of the upload times a segment holds."""
+    period = segment_re.match(os.path.basename(filename)).group('period')
+    if len(period) == 7:
+        begin = datetime.datetime.strptime(period, "%Y-%m").replace(tzinfo=datetime.timezone.utc)
+        end = (begin + datetime.timedelta(days=32)).replace(day=1)
+    else:
+        begin = datetime.datetime.strptime(period, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
+        end = begin + datetime.timedelta(days=1)
+    return begin, end
+
+def read_index(segment_filename):
+    try:
+        with open(segment_filename + index_suffix, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"stored_size": 0, "size": 0, "files": {}}
+
+def segment_stamp(segment_filename):
+    """[size, mtime_ns] of a segment's index, which changes exactly when
+    more of the segment is committed, then the uncompressed size committed;
+    [0, 0, 0] before there's an index. Appends only grow the index, so the
+    size is never more than what a read_segment() started after this sees."""
+    try:
+        st = os.stat(segment_filename + index_suffix)
+    except FileNotFoundError:
+        return [0, 0, 0]
+    return [st.st_size, st.st_mtime_ns, read_index(segment_filename)["size"]]
+
+class _Committed(io.RawIOBase):
+    """The first size bytes of file f."""
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.f.readinto(memoryview(b)[:min(len(b), self.remaining)])
+        self.remaining -= n
+        return n
+
+def read_segment(segment_filename, start=0):
+    """Yield (original filename, parsed content) for each file packed in a
+    segment, in one sequential read of its committed part. Lines are read
+    and decoded one at a time, so memory holds one packed file at most.
+
+    start, an uncompressed offset, skips the files packed before it. It must
+    be where a packed file starts, or the committed size (say, from an
+    earlier segment_stamp()); otherwise the whole segment is read. A plain
+    segment is read from there; a gzipped one is still decompressed from
+    the beginning, but the files before start aren't parsed."""
+    index = read_index(segment_filename)
+    if start and start != index["size"] and start not in set(o for o, _ in index["files"].values()):
+        logger.warning("{} has no packed file at {}, reading all of it".format(segment_filename, start))
+        start = 0
+    gz = segment_filename.endswith('.gz')
+    with open(segment_filename, 'rb') as f:
+        if not gz:
+            f.seek(start)
+        stream = io.BufferedReader(_Committed(f, index["stored_size"] - (0 if gz else start)))
+        if gz:
+            stream = gzip.GzipFile(fileobj=stream, mode='rb')
+            stream.seek(start)
+        for line in stream:
+            if not line.strip():
+                continue
+            packed = json.loads(line)
+            yield packed["file"], packed["blob"]
+
+def _write_index(segment_filename, index):
+    with replacing(segment_filename + index_suffix) as f:
+        json.dump(index, f)
+
+def append_segment(segment_filename, filenames):
+    """Pack the raw files filenames (absolute) onto the end of a segment.
+    Returns the filenames packed; unreadable ones are left alone."""
+    index = read_index(segment_filename)
+    lines = list()
+    packed = list()
+    offset = index["size"]
+    for filename in filenames:
+        name = os.path.basename(filename)
+        try:
+            with open(filename, 'r') as f:
+                blob = json.load(f)
+        except (IOError, ValueError):
+            logger.exception("Not packing {}".format(filename))
+            continue
+        line = (json.dumps({"file": name, "blob": blob}, separators=(',', ':')) + "\n").encode()
+        index["files"][name] = [offset, len(line)]
+        offset += len(line)
+        lines.append(line)
+        packed.append(filename)
+    if not lines:
+        return packed
+
+    data = b"".join(lines)
+    stored = gzip.compress(data) if segment_filename.endswith('.gz') else data
+    with open(segment_filename, 'ab') as f:
+        f.truncate(index["stored_size"])  # drop anything an interrupted append left
+        f.seek(index["stored_size"])
+        f.write(stored)
+        f.flush()
+        os.fsync(f.fileno())
+    index["stored_size"] += len(stored)
+    index["size"] = offset
+    _write_index(segment_filename, index)
+    return packed
+
+def compact_dir(dirname, period="month", compress=False, older_than=None, time_from_filename=None):
+    """Pack the loose raw files in an endpoint dir into per-day or per-month
+    segments, then unlink them. Only files whose filename time is before
+    older_than (an aware datetime) are packed, so ones still arriving for the
+    current period can wait for a later run. time_from_filename maps a
+    filename to epoch ns, by default Observations.time_from_filename.
+    Returns the number of files packed.
+    """
+    if time_from_filename is None:
+        from .observations import Observations  # it imports this module
+        time_from_filename = Observations.time_from_filename
+    fmt = "%Y-%m" if period == "month" else "%Y-%m-%d"
+    suffix = ".jsonl.gz" if compress else ".jsonl"
+    groups = dict()
+    with os.scandir(dirname) as s:
+        for entry in s:
+            if not entry.is_file() or not entry.name.endswith('.json') or entry.name == 'METADATA.json':
+                continue
+            t = time_from_filename(entry.name)
+            if t is None:
+                continue
+            dt = datetime.datetime.fromtimestamp(t / 1e9, datetime.timezone.utc)
+            if older_than is not None and dt >= older_than:
+                continue
+            segment = os.path.join(dirname, "SEGMENT-{}{}".format(dt.strftime(fmt), suffix))
+            groups.setdefault(segment, []).append(os.path.join(dirname, entry.name))
+
+    count = 0
+    for segment, filenames in sorted(groups.items()):
+        filenames.sort()
+        packed = append_segment(segment, filenames)
+        for filename in packed:
+            os.unlink(filename)
+        logger.debug("Packed {} files into {}".format(len(packed), segment))
+        count += len(packed)
+    return count
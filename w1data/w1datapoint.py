@@ -4,6 +4,9 @@ logger = logging.getLogger(__name__)
 class W1Datapoint:
     class ItAintMe(ValueError):
         pass
+
+    __slots__ = ()
+
     def __init__(self):
         pass
 
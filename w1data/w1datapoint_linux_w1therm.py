@@ -1,15 +1,39 @@
-import re
+import re, struct, array
+from math import nan
 from .w1datapoint import W1Datapoint
 from .observations import Observation
 
 import logging
 logger = logging.getLogger(__name__.split('_',1)[0])  # lump with parent class
 
+def _crc8_table():
+    table = bytearray(256)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8c if crc & 1 else crc >> 1
+        table[i] = crc
+    return bytes(table)
+
+crc8_table = _crc8_table()
+
+def crc8(data):
+    """Dallas/Maxim 1-Wire CRC8. Over a scratchpad including its CRC byte,
+    this is zero when the scratchpad is intact."""
+    crc = 0
+    for byte in data:
+        crc = crc8_table[crc ^ byte]
+    return crc
+
+# Temperature register masks for 9, 10, 11 and 12 bit resolution
+resolution_masks = (~7, ~3, ~1, ~0)
+
 class W1Datapoint_Linux_w1therm(W1Datapoint):
     """
-    String from type-28 (therm sensor) w1slave pseudofile, parsed. If the
-    w1therm Linux kernel module is loaded the result includes that line parsed;
-    else we calculate the temperature from the raw sensor data (TBD).
+    String from type-28 (therm sensor) w1slave pseudofile, parsed. The
+    temperature comes from the raw scratchpad bytes, whether or not the
+    w1therm kernel module added its own "t=" reading, and the CRC is checked
+    here rather than trusting the kernel's YES/NO.
 
     This is from the perspective of the sensor alone: no notion here of semantics.
     """
@@ -22,31 +46,71 @@ class W1Datapoint_Linux_w1therm(W1Datapoint):
         w1_slave
     ''', re.X)
 
-    value_re = re.compile(r'''
-    ^
-    (?P<raw> ([0-9a-fA-F]{2} \s){9})
-    \s* : \s*
-    crc=(?P<crc_value> [0-9a-fA-F]{2}) \s*
-    (?P<crc_ok> NO|YES)
-    \s* \n
-    (?P<w1therm_driver_result>
-      (?P<raw2> ([0-9a-fA-F]{2} \s*){9})
-      t = (?P<temp> \d+) \s*
-    )?
-    ''', re.X | re.M)
+    # w1_slave text starts "41 01 4b 46 7f ff 0c 10 ff : crc=ff YES\n": the 9
+    # scratchpad bytes as hex. The kernel's YES/NO and second line (with
+    # "t=" if w1_therm did the math) are ignored in favor of those bytes.
+    scratchpad_chars = 26
+    scratchpad_struct = struct.Struct('<hxxBxxxx')  # temperature, config
+
+    __slots__ = ('temp', 'consistent')
 
     def __init__(self, w1_string):
-        mo = self.value_re.match(w1_string)
-        if not mo:
-            raise W1Datapoint.ItAintMe("regex match failure")
+        temp, consistent = self.decode(w1_string)
+        if temp is None:
+            raise W1Datapoint.ItAintMe("no scratchpad in {!r}".format(w1_string[:40]))
         super().__init__()
-        self.w1therm_string = w1_string
-        self.consistent = mo.group('crc_ok') == 'YES'
-        if mo.group('temp'):
-            self.temp = float(mo.group('temp')) / 1000
-        else:
-            # calculate temp from raw data. TBD
-            raise RuntimeError("temp calc from raw sensor data is not yet implemented")
+        self.temp = temp
+        self.consistent = consistent
+
+    @classmethod
+    def decode_scratchpad(cls, scratchpad):
+        """(celsius, crc_ok) from 9 scratchpad bytes. Bits below the configured
+        resolution (config register bits 5-6) are undefined and get masked.
+        """
+        raw, config = cls.scratchpad_struct.unpack(scratchpad)
+        raw &= resolution_masks[(config >> 5) & 3]
+        return raw / 16.0, crc8(scratchpad) == 0
+
+    @classmethod
+    def decode(cls, w1_string):
+        """(celsius, crc_ok) from one w1_slave string, or (None, False) if it
+        doesn't start with a scratchpad.
+        """
+        try:
+            scratchpad = bytes.fromhex(w1_string[:cls.scratchpad_chars])
+        except (ValueError, TypeError):
+            return None, False
+        if len(scratchpad) != 9:
+            return None, False
+        return cls.decode_scratchpad(scratchpad)
+
+    @classmethod
+    def decode_batch(cls, w1_strings):
+        """Decode many w1_slave strings at once. Returns parallel arrays:
+        temperatures (array('d'), NaN where a string didn't parse) and CRC
+        flags (array('b'), 1 where the scratchpad CRC checks out).
+
+        The common case is one fromhex over all the scratchpads joined
+        together and a struct.iter_unpack over the result; if anything in the
+        batch is malformed we fall back to decoding strings one by one.
+        """
+        temps = array.array('d')
+        crc_ok = array.array('b')
+        n = cls.scratchpad_chars
+        try:
+            scratchpads = bytes.fromhex(" ".join([s[:n] for s in w1_strings]))
+        except (ValueError, TypeError):
+            scratchpads = None
+        if scratchpads is not None and len(scratchpads) == 9 * len(w1_strings):
+            for i, (raw, config) in enumerate(cls.scratchpad_struct.iter_unpack(scratchpads)):
+                temps.append((raw & resolution_masks[(config >> 5) & 3]) / 16.0)
+                crc_ok.append(crc8(scratchpads[9 * i:9 * i + 9]) == 0)
+            return temps, crc_ok
+        for s in w1_strings:
+            temp, ok = cls.decode(s)
+            temps.append(nan if temp is None else temp)
+            crc_ok.append(ok)
+        return temps, crc_ok
 
     @property
     def value(self):
@@ -0,0 +1,209 @@
+"""watch.py
+
+w1rollup --watch: keep rollups current as raw files arrive, rather than
+re-walking the raw tree from cron.
+
+RollupWatcher catches up once, as a plain w1rollup run would, then waits on
+inotify (through ctypes; Linux only) for raw files closed after writing or
+renamed into the endpoint dirs of a local raw location, and for new
+endpoint dirs. Events are gathered for a short debounce window after the
+first one, so a burst of uploads is ingested together, and a stream of
+them is ingested every debounce seconds. Only those files are
+read, and only the months their rows fall in are flushed. The ingest
+journal is committed after every flush that succeeds, as in do_rollup.
+A file that can't be rolled up (an unknown sensor, say) is logged and left
+out of the journal, rather than stopping the watcher.
+Between events the watcher sleeps in select(), so it costs nothing idle.
+
+If the kernel's event queue overflows, the next ingest re-lists every
+endpoint dir and lets the journal pick out what's new.
+
+A watcher runs for months, so unless max_bytes bounds it, it holds at most
+default_max_months months' rows in memory; see RollupMonthlyCollection.
+
+run() can be stopped with stop(), from a signal handler too. close() frees
+the pipe stop() writes to, so call it after the handlers are gone.
+"""
+
+import os, sys, ctypes, ctypes.util, struct, select, time, errno
+
+from .observations import Observations
+from .rollup import RollupMonthlyCollection
+from .journal import IngestJournal
+
+import logging
+logger = logging.getLogger(__name__)
+
+# <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+event_header = struct.Struct('iIII')  # wd, mask, cookie, name length
+
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self._init1 = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify isn't available here")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self._init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.watches = dict()  # wd: dirname
+
+    def add_watch(self, dirname, mask):
+        wd = self._add_watch(self.fd, os.fsencode(dirname), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), dirname)
+        self.watches[wd] = dirname
+
+    def read(self):
+        """Yield (dirname, name, mask) for each queued event, until none are
+        left. dirname is None for a queue overflow."""
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = event_header.unpack_from(data, offset)
+                offset += event_header.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                yield self.watches.get(wd), name, mask
+
+    def close(self):
+        os.close(self.fd)
+
+class RollupWatcher:
+    raw_mask = IN_CREATE | IN_MOVED_TO | IN_ONLYDIR
+    endpoint_mask = IN_CLOSE_WRITE | IN_MOVED_TO
+    default_max_months = 12
+
+    def __init__(self, rollup_location, raw_location, debounce=2.0, jobs=1,
+                 max_months=None, max_bytes=None):
+        if max_months is None and max_bytes is None:
+            max_months = self.default_max_months
+        self.raw_location = raw_location
+        self.debounce = debounce
+        self.jobs = jobs
+        self.collection = RollupMonthlyCollection(rollup_location, max_months, max_bytes)
+        self.journal = IngestJournal(rollup_location, raw_location)
+        self.observations = Observations(raw_location, file_filter=self.journal.is_new,
+                                         file_read=self.journal.ingested,
+                                         segment_start=self.journal.segment_start)
+        self.pending = dict()  # endpoint dir: set of names, or None to list it all
+        self.ingests = 0
+        self._stop_r, self._stop_w = os.pipe()
+
+    def stop(self):
+        """Make run() ingest what's pending and return. Safe from a signal
+        handler or another thread."""
+        os.write(self._stop_w, b'x')
+
+    def close(self):
+        """Free the stop pipe. stop() mustn't be called after this."""
+        os.close(self._stop_r)
+        os.close(self._stop_w)
+
+    def _note(self, dirname, name, mask):
+        if dirname is None:
+            logger.warning("inotify queue overflowed, relisting raw files")
+            for endpoint in self.observations.endpoint_dirs():
+                self.pending[endpoint] = None
+        elif dirname == self.raw_location:
+            if mask & IN_ISDIR:
+                endpoint = os.path.join(dirname, name)
+                self.inotify.add_watch(endpoint, self.endpoint_mask)
+                self.pending[endpoint] = None  # files may have landed before the watch
+        elif name.endswith('.json') and not name.startswith('.') and name != 'METADATA.json':
+            names = self.pending.setdefault(dirname, set())
+            if names is not None:
+                names.add(name)
+
+    def _save_files(self, filenames, metadata):
+        for batch in self.observations.generate_files_batches(filenames, metadata):
+            self.collection.save_batch(batch)
+
+    def ingest(self):
+        """Roll up the pending raw files and flush the months they touched.
+        An endpoint dir that can't be listed is skipped; files that can't be
+        rolled up are found one by one and left unjournaled."""
+        pending, self.pending = self.pending, dict()
+        metadata_base = self.observations.metadata(self.raw_location)
+        for dirname, names in sorted(pending.items()):
+            try:
+                if names is None:
+                    filenames = self.observations.dir_files(dirname)
+                else:
+                    filenames = [os.path.join(dirname, name) for name in sorted(names)]
+                    filenames = [f for f in filenames if self.journal.is_new(f)]
+                if not filenames:
+                    continue
+                metadata = self.observations.dir_metadata(dirname, metadata_base)
+            except Exception:
+                logger.exception("Couldn't list {}".format(dirname))
+                continue
+            try:
+                self._save_files(filenames, metadata)
+            except Exception:
+                logger.warning("Couldn't roll up {} files from {}, trying them one at a time: {}".format(
+                    len(filenames), dirname, sys.exc_info()[1]))
+                # Rows are identified by time, so saving a file's again is harmless
+                for filename in filenames:
+                    try:
+                        self._save_files([filename], metadata)
+                    except Exception:
+                        logger.exception("Couldn't roll up {}".format(filename))
+                        self.journal.forget(filename)
+        flushed, failed = self.collection.flush(self.jobs)
+        if not failed:
+            self.journal.commit()
+        self.ingests += 1
+        logger.debug("ingest {}: {} months flushed".format(self.ingests, len(flushed)))
+
+    def run(self):
+        self.inotify = Inotify()
+        try:
+            self.inotify.add_watch(self.raw_location, self.raw_mask)
+            for endpoint in self.observations.endpoint_dirs():
+                self.inotify.add_watch(endpoint, self.endpoint_mask)
+                self.pending[endpoint] = None  # catch up, now nothing new can be missed
+            self.ingest()
+
+            deadline = None
+            while True:
+                timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                ready, _, _ = select.select([self.inotify.fd, self._stop_r], [], [], timeout)
+                if self._stop_r in ready:
+                    break
+                if ready:
+                    for dirname, name, mask in self.inotify.read():
+                        self._note(dirname, name, mask)
+                    if self.pending and deadline is None:
+                        deadline = time.monotonic() + self.debounce
+                # Due even if events are still arriving, so a steady stream
+                # of them can't put it off
+                if deadline is not None and time.monotonic() >= deadline:
+                    deadline = None
+                    self.ingest()
+            for dirname, name, mask in self.inotify.read():
+                self._note(dirname, name, mask)
+            if self.pending:
+                self.ingest()
+        finally:
+            self.inotify.close()
@@ -1,5 +1,10 @@
-import sys, os, os.path, argparse, json, datetime, subprocess
+import sys, os, os.path, argparse, json, datetime, subprocess, threading, time, sched, signal
 import requests
+from .outbox import Outbox
+from . import sysstatus
+
+import logging
+logger = logging.getLogger(__name__)
 
 def isotime(timespec='seconds'):
     return datetime.datetime.utcnow().replace(
@@ -9,50 +14,266 @@ def isotime(timespec='seconds'):
 class W1Logger:
     def __init__(self, config):
         self.config = config
+        self.outbox = Outbox(config.spool_dir, config.batch_size)
+        self.devices_link_dir = os.path.join(config.sysfs_root, self.devices_link_path)
+        self.bus_masters_dir = os.path.join(config.sysfs_root, self.bus_masters_path)
+        self.session = None
+        self.flush_on_post = True
+        self.readers = dict()  # key: reader thread still stuck from an earlier scan
+
+    def post_batch(self, batch):
+        poster = requests if self.session is None else self.session
+        r = poster.post(self.config.endpoint, json=batch, timeout=30)
+        r.raise_for_status()
+
+    def Post(self, msg):
+        """Spool msg, then (unless the daemon's flush timer is doing it) try to
+        send everything spooled so far."""
+        self.outbox.append(msg)
+        if self.flush_on_post:
+            self.Flush()
+
+    def Flush(self):
+        sent = self.outbox.drain(self.post_batch)
+        if sent is not None:
+            logger.debug("Sent {} spooled messages".format(sent))
+        return sent
 
     def LogStartup(self):
         msg = {
             "isotime": isotime(),
-            "uptime": subprocess.check_output("uptime").decode('utf-8')
+            "uptime": sysstatus.uptime(),
         }
-        requests.post(self.config.endpoint, json=msg, timeout=30)
+        if self.config.status_raw:
+            msg["raw"] = {
+                "uptime": subprocess.check_output("uptime").decode('utf-8'),
+            }
+        self.Post(msg)
 
     def LogStatus(self):
-        msg = {
-            "isotime": isotime(),
-            "uptime": subprocess.check_output("uptime", shell=True).decode('utf-8'),
-            "free": subprocess.check_output("free", shell=True).decode('utf-8'),
-            "df": subprocess.check_output("df", shell=True).decode('utf-8'),
-            "netstat-an": subprocess.check_output("netstat -an", shell=True).decode('utf-8'),
+        msg = {"isotime": isotime()}
+        msg.update(sysstatus.status())
+        if self.config.status_raw:
+            msg["raw"] = {
+                "uptime": subprocess.check_output("uptime", shell=True).decode('utf-8'),
+                "free": subprocess.check_output("free", shell=True).decode('utf-8'),
+                "df": subprocess.check_output("df", shell=True).decode('utf-8'),
+                "netstat-an": subprocess.check_output("netstat -an", shell=True).decode('utf-8'),
+            }
+        self.Post(msg)
+
+    # Relative to config.sysfs_root
+    devices_link_path = "bus/w1/drivers/w1_slave_driver"
+    bus_masters_path = "bus/w1/devices"
+
+    def W1Datapoints(self):
+        """(key, pseudofile) for every device on the w1 busses, sorted by key."""
+        datapoints = dict()
+        with os.scandir(self.devices_link_dir) as d:
+            for entry in d:
+                if entry.is_symlink():
+                    datapoints[os.path.join(entry.name, "w1_slave")] = os.path.join(
+                        self.devices_link_dir, entry.name, "w1_slave")
+        return sorted(datapoints.items())
+
+    @staticmethod
+    def ReadDatapoint(key, pseudofile):
+        with open(pseudofile, "r") as point:
+            value = point.read()
+        return {
+            "isotime": isotime('milliseconds'),
+            "key": key,
+            "value": value
         }
-        requests.post(self.config.endpoint, json=msg, timeout=30)
+
+    def ReadDatapoints(self, datapoints):
+        """Read each (key, pseudofile) in datapoints. Each read blocks for the
+        sensor's conversion time, so with ReadConcurrency > 1 (or a
+        ReadTimeout) reads run in their own threads, at most ReadConcurrency
+        at a time. A read that takes longer than ReadTimeout seconds is
+        abandoned and left out of the result, and its slot goes to the next
+        device; the stuck thread is a daemon and can't hold up exit. A device
+        whose abandoned read still hasn't returned is skipped in later scans
+        rather than given another thread.
+        """
+        limit = max(1, self.config.read_concurrency)
+        timeout = self.config.read_timeout
+        if limit == 1 and timeout is None:
+            return [self.ReadDatapoint(key, pseudofile) for key, pseudofile in datapoints]
+
+        results = dict()
+        cv = threading.Condition()
+
+        def read(key, pseudofile):
+            datapoint = None
+            try:
+                datapoint = self.ReadDatapoint(key, pseudofile)
+            except Exception:
+                logger.warning("Couldn't read {}".format(pseudofile), exc_info=True)
+            finally:
+                with cv:
+                    results[key] = datapoint
+                    cv.notify()
+
+        for key, thread in list(self.readers.items()):
+            if not thread.is_alive():
+                del self.readers[key]
+        waiting = list(reversed(datapoints))
+        running = dict()  # key: deadline
+        abandoned = set()
+        with cv:
+            while waiting or running:
+                while waiting and len(running) < limit:
+                    key, pseudofile = waiting.pop()
+                    if key in self.readers:
+                        logger.warning("Skipping {}: its last read is still stuck".format(key))
+                        abandoned.add(key)
+                        continue
+                    running[key] = None if timeout is None else time.monotonic() + timeout
+                    thread = threading.Thread(target=read, args=(key, pseudofile), daemon=True)
+                    thread.start()
+                    self.readers[key] = thread
+                now = time.monotonic()
+                for key, deadline in list(running.items()):
+                    if key in results:
+                        del running[key]
+                        del self.readers[key]
+                    elif deadline is not None and deadline <= now:
+                        logger.warning("Read of {} timed out after {}s".format(key, timeout))
+                        abandoned.add(key)
+                        del running[key]
+                if running and not (waiting and len(running) < limit):
+                    deadlines = [d for d in running.values() if d is not None]
+                    cv.wait(min(deadlines) - now if deadlines else None)
+
+        return [results[key] for key, _ in datapoints
+                if key not in abandoned and results.get(key) is not None]
+
+    def SetResolution(self, bits):
+        """Set every therm device that has a resolution attribute to bits (9-12).
+        Conversion time halves with each bit dropped, from 750ms at 12."""
+        with os.scandir(self.devices_link_dir) as d:
+            for entry in d:
+                attr = os.path.join(self.devices_link_dir, entry.name, "resolution")
+                try:
+                    with open(attr, "r") as f:
+                        if int(f.read().strip() or 0) == bits:
+                            continue
+                    with open(attr, "w") as f:
+                        f.write("{}\n".format(bits))
+                except (OSError, ValueError):
+                    logger.debug("Can't set resolution of {}".format(entry.name), exc_info=True)
+
+    def BulkConvert(self):
+        """Have every bus master that offers therm_bulk_read start a temperature
+        conversion on all of its devices at once, and wait for them to finish.
+        Reading a device's w1_slave afterwards returns that result without
+        another conversion, so the whole bus costs one conversion time and the
+        scan keeps the same datapoints format. Devices on masters without
+        therm_bulk_read (older kernels) just convert on read, as before.
+        Returns the number of bus masters triggered.
+        """
+        triggers = list()
+        with os.scandir(self.bus_masters_dir) as d:
+            for entry in d:
+                if entry.name.startswith("w1_bus_master"):
+                    trigger = os.path.join(self.bus_masters_dir, entry.name, "therm_bulk_read")
+                    if os.path.exists(trigger):
+                        triggers.append(trigger)
+
+        for trigger in list(triggers):
+            try:
+                with open(trigger, "w") as f:
+                    f.write("trigger\n")
+            except OSError:
+                logger.warning("Couldn't trigger {}".format(trigger), exc_info=True)
+                triggers.remove(trigger)
+
+        # therm_bulk_read reads -1 while any device on the bus is converting,
+        # then 1 until every result has been read, 0 once they all have
+        deadline = time.monotonic() + (self.config.read_timeout or 2.0)
+        converting = list(triggers)
+        while converting and time.monotonic() < deadline:
+            time.sleep(0.05)
+            still = list()
+            for trigger in converting:
+                try:
+                    with open(trigger, "r") as f:
+                        if f.read().strip() == "-1":
+                            still.append(trigger)
+                except OSError:
+                    pass
+            converting = still
+        if converting:
+            logger.warning("Bulk conversion still running on {}".format(converting))
+        return len(triggers)
 
     def LogW1(self):
         msg = dict()
         msg["scan_start"] = isotime('milliseconds')
+        if self.config.bulk_read:
+            if self.config.resolution:
+                self.SetResolution(self.config.resolution)
+            self.BulkConvert()
+        msg['datapoints'] = self.ReadDatapoints(self.W1Datapoints())
+        msg["scan_end"] = isotime('milliseconds')
+        self.Post(msg)
 
-        devices_links = list()
-        devices_link_dir = "/sys/bus/w1/drivers/w1_slave_driver"
-        with os.scandir(devices_link_dir) as d:
-            for entry in d:
-                if entry.is_symlink():
-                    devices_links.append(entry.name)
+    def Run(self):
+        """Daemon mode: stay resident and log on a schedule rather than once per
+        cron-launched process. The config is read once, and posts go through
+        one keep-alive Session so each flush reuses the endpoint connection.
+        LogStartup runs once, first. See Schedule for the rest.
+        """
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
-        for link in devices_links:
-            datapoints = dict()
-            datapoints[os.path.join(link, "w1_slave")] = os.path.join(devices_link_dir, link, "w1_slave")
+        def stop(signum, frame):
+            sys.exit(0)
+        signal.signal(signal.SIGTERM, stop)
 
-        msg['datapoints'] = datapoint_list = list()
-        for datapoint in sorted(datapoints.keys()):
-            with open(os.path.join(devices_link_dir, datapoints[datapoint]), "r") as point:
-                datapoint_list.append({
-                    "isotime": isotime('milliseconds'),
-                    "key": datapoint,
-                    "value": point.read()
-                })
+        try:
+            self.LogStartup()
+        except Exception:
+            logger.exception("LogStartup failed")
+        scheduler = sched.scheduler(time.monotonic, time.sleep)
+        self.Schedule(scheduler)
+        try:
+            scheduler.run()
+        finally:
+            self.session.close()
+            self.session = None
 
-        msg["scan_end"] = isotime('milliseconds')
-        requests.post(self.config.endpoint, json=msg, timeout=30)
+    def Schedule(self, scheduler):
+        """Put the daemon's events on a sched.scheduler. Intervals are in
+        seconds; a zero interval turns that event off. Scans are spooled, and
+        the spool drains every FlushInterval so a slow or dead uplink can't
+        hold up scanning; a zero FlushInterval sends after every post instead.
+        Events run at a fixed rate from their first run. One that's still
+        running when its next tick (or several) comes round runs once more as
+        soon as it can, then carries on at the next tick after that.
+        """
+        self.flush_on_post = not self.config.flush_interval
+
+        def every(interval, action):
+            def run(due):
+                now = scheduler.timefunc()
+                due += interval
+                if due <= now:
+                    due += ((now - due) // interval + 1) * interval
+                scheduler.enterabs(due, 0, run, (due,))
+                try:
+                    action()
+                except Exception:
+                    logger.exception("{} failed".format(action.__name__))
+            if interval:
+                scheduler.enter(0, 0, run, (scheduler.timefunc(),))
+
+        every(self.config.w1_interval, self.LogW1)
+        every(self.config.status_interval, self.LogStatus)
+        every(self.config.flush_interval, self.Flush)
 
 class Config:
     def __init__(self, config_filename):
@@ -77,15 +298,68 @@ class Config:
     def endpoint(self):
         return self.config['Post']
 
+    @property
+    def spool_dir(self):
+        return os.path.expanduser(self.config.get('Spool', "~/.w1datalogger/spool"))
+
+    @property
+    def sysfs_root(self):
+        return self.config.get('SysfsRoot', "/sys")
+
+    @property
+    def batch_size(self):
+        return self.config.get('BatchSize', 100)
+
+    @property
+    def read_concurrency(self):
+        return self.config.get('ReadConcurrency', 1)
+
+    @property
+    def read_timeout(self):
+        return self.config.get('ReadTimeout', None)
+
+    @property
+    def bulk_read(self):
+        return self.config.get('BulkRead', False)
+
+    @property
+    def resolution(self):
+        return self.config.get('Resolution', None)
+
+    @property
+    def status_raw(self):
+        return self.config.get('StatusRaw', False)
+
+    @property
+    def w1_interval(self):
+        return self.config.get('W1Interval', 60)
+
+    @property
+    def status_interval(self):
+        return self.config.get('StatusInterval', 3600)
+
+    @property
+    def flush_interval(self):
+        return self.config.get('FlushInterval', self.w1_interval)
+
 def main():
     p = argparse.ArgumentParser()
     p.add_argument('--status', action='store_true', default=False)
     p.add_argument('--startup', action='store_true', default=False)
-    p.add_argument('--config', nargs=1, default=os.path.join(os.path.dirname(__file__), "datalogger.json"))
+    p.add_argument('--flush', action='store_true', default=False,
+                   help="only send what's waiting in the spool")
+    p.add_argument('--daemon', action='store_true', default=False,
+                   help="stay running, logging every W1Interval/StatusInterval seconds")
+    p.add_argument('--config', default=os.path.join(os.path.dirname(__file__), "datalogger.json"))
     a = p.parse_args()
 
     w1logger = W1Logger(Config(a.config))
-    if a.status:
+    if a.daemon:
+        logging.basicConfig(format="%(asctime)s:%(levelname)s:%(message)s")
+        w1logger.Run()
+    elif a.flush:
+        w1logger.Flush()
+    elif a.status:
         w1logger.LogStatus()
     elif a.startup:
         w1logger.LogStartup()
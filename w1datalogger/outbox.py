@@ -0,0 +1,101 @@
+"""outbox.py
+
+Durable on-disk spool for messages bound for the datalogger endpoint.
+
+Every message is first written to the spool directory as its own file, named
+for the UTC isotime of the scan plus a uuid so concurrent loggers never
+collide. The file is written under a dot-prefixed temporary name and renamed
+into place, so a reader sees either the whole message or nothing.
+
+Draining takes an exclusive flock on the spool's lock file. A logger that
+can't get the lock leaves draining to whoever holds it; its own freshly
+spooled messages get picked up by that drain or by the next run. Spooled
+messages are POSTed oldest first as a JSON list of up to batch_size messages,
+which the receiver stores as one raw observation file, and are unlinked only
+after the endpoint accepts the batch.
+"""
+
+import os, json, uuid, fcntl
+
+import logging
+logger = logging.getLogger(__name__)
+
+class Outbox:
+    lock_filename = ".lock"
+    suffix = ".json"
+
+    def __init__(self, spool_dir, batch_size=100):
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+    def append(self, msg):
+        """Atomically add one message to the spool. Returns its filename."""
+        stamp = msg.get("scan_start", msg.get("isotime", ""))
+        name = "{};{}{}".format(stamp, uuid.uuid4(), self.suffix)
+        tmp_filename = os.path.join(self.spool_dir, "." + name)
+        with open(tmp_filename, "w") as f:
+            json.dump(msg, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_filename, os.path.join(self.spool_dir, name))
+        return name
+
+    def pending(self):
+        """Spooled filenames, oldest first."""
+        names = list()
+        with os.scandir(self.spool_dir) as d:
+            for entry in d:
+                if entry.name[0] == '.' or not entry.name.endswith(self.suffix):
+                    continue
+                names.append(entry.name)
+        return sorted(names)
+
+    def _load(self, names):
+        batch = list()
+        loaded = list()
+        for name in names:
+            filename = os.path.join(self.spool_dir, name)
+            try:
+                with open(filename, "r") as f:
+                    batch.append(json.load(f))
+                loaded.append(name)
+            except FileNotFoundError:
+                pass  # someone else drained it
+            except json.decoder.JSONDecodeError:
+                logger.error("Dropping unreadable spool file {}".format(filename))
+                os.unlink(filename)
+        return batch, loaded
+
+    def drain(self, post):
+        """POST everything in the spool, batch_size messages at a time, by calling
+        post(list_of_messages). post raises on failure, which stops the drain
+        with the unsent messages left in place. Returns the number of messages
+        sent, or None if another process is already draining.
+        """
+        sent = 0
+        with open(os.path.join(self.spool_dir, self.lock_filename), "a") as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.debug("Spool {} is being drained elsewhere".format(self.spool_dir))
+                return None
+            try:
+                while True:
+                    names = self.pending()[:self.batch_size]
+                    if not names:
+                        break
+                    batch, loaded = self._load(names)
+                    if batch:
+                        try:
+                            post(batch)
+                        except Exception:
+                            logger.warning("Post of {} spooled messages failed, keeping them".format(len(batch)),
+                                           exc_info=True)
+                            break
+                    for name in loaded:
+                        os.unlink(os.path.join(self.spool_dir, name))
+                    sent += len(batch)
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+        return sent
@@ -0,0 +1,297 @@
+#! /usr/bin/env python3
+
+"""simulator.py
+
+Stand-ins for a w1 bus and for the datalogger endpoint, so W1Logger can be
+exercised and timed off-device.
+
+SimulatedBus builds a sysfs-shaped tree (point W1Logger at it with the
+SysfsRoot config setting) whose w1_slave pseudofiles are named pipes. A
+thread per device answers each read like the kernel does: it blocks for the
+conversion latency, then writes a DS18B20 scratchpad line pair. Some
+fraction of reads can come back with a bad CRC, and hung devices never
+answer at all. With bulk_read, the bus master also has a therm_bulk_read
+attribute: writing "trigger" to it converts every device at once, and
+reading it gives -1 while that runs, 1 until each result has been read
+and 0 after, as the kernel's does.
+
+RecordingEndpoint is a local HTTP server that accepts and records POSTs.
+
+main() (the w1sim command) puts the two together and reports scan latency
+and upload throughput for a given bus size and logger configuration.
+"""
+
+import sys, os, os.path, argparse, json, random, tempfile, threading, time, errno
+import http.server
+
+import logging
+logger = logging.getLogger(__name__)
+
+def crc8(data):
+    """Dallas/Maxim 1-Wire CRC8, polynomial x^8 + x^5 + x^4 + 1."""
+    crc = 0
+    for byte in data:
+        for _ in range(8):
+            mix = (crc ^ byte) & 1
+            crc >>= 1
+            if mix:
+                crc ^= 0x8c
+            byte >>= 1
+    return crc
+
+def w1_slave_text(celsius, corrupt=False):
+    """Kernel w1_therm output for a DS18B20 at 12-bit resolution reading
+    celsius. Like the kernel's, both lines show the bytes as read, crc= is
+    computed from them and t= is decoded from them, so a corrupt read has a
+    CRC that doesn't match its ninth byte and a t= that may be off."""
+    raw = int(round(celsius * 16)) & 0xffff
+    scratchpad = bytes([raw & 0xff, raw >> 8, 0x4b, 0x46, 0x7f, 0xff, 0x0c, 0x10])
+    crc = crc8(scratchpad)
+    if corrupt:
+        scratchpad = bytes([scratchpad[0] ^ 0x04]) + scratchpad[1:]
+    read_crc = crc8(scratchpad)
+    raw = scratchpad[0] | scratchpad[1] << 8
+    if raw & 0x8000:
+        raw -= 0x10000
+    millicelsius = int(raw * 1000 / 16)  # C division, truncating toward zero
+    hexbytes = " ".join("{:02x}".format(b) for b in scratchpad + bytes([crc]))
+    return "{} : crc={:02x} {}\n{} t={}\n".format(
+        hexbytes, read_crc, "YES" if read_crc == crc else "NO", hexbytes, millicelsius)
+
+class SimulatedDevice(threading.Thread):
+    def __init__(self, bus, name, hung=False):
+        super().__init__(daemon=True)
+        self.bus = bus
+        self.name = name
+        self.hung = hung
+        self.pseudofile = os.path.join(bus.devices_dir, name, "w1_slave")
+        self.celsius = bus.random.uniform(15.0, 25.0)
+        self.reads = 0
+        os.makedirs(os.path.dirname(self.pseudofile))
+        os.mkfifo(self.pseudofile)
+
+    def _reader_gone(self):
+        # Opening the write end without blocking fails with ENXIO once no
+        # reader holds the pipe, so we don't answer the same open() twice.
+        try:
+            fd = os.open(self.pseudofile, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            return e.errno == errno.ENXIO
+        os.close(fd)
+        return False
+
+    def run(self):
+        if self.hung:
+            return  # nobody ever opens the write end; readers block in open()
+        while not self.bus.stopping:
+            fd = os.open(self.pseudofile, os.O_WRONLY)  # waits for a reader
+            try:
+                if self.bus.stopping:
+                    break
+                time.sleep(self.bus.conversion_wait(self.name))
+                self.celsius += self.bus.random.uniform(-0.1, 0.1)
+                corrupt = self.bus.random.random() < self.bus.crc_fail_rate
+                os.write(fd, w1_slave_text(self.celsius, corrupt).encode())
+                self.reads += 1
+            except BrokenPipeError:
+                pass  # reader gave up
+            finally:
+                os.close(fd)
+            while not self.bus.stopping and not self._reader_gone():
+                time.sleep(0.001)
+
+class SimulatedBus:
+    """A fake /sys with devices DS18B20s on one bus master, under root."""
+
+    def __init__(self, root, devices=4, latency=0.75, crc_fail_rate=0.0, hung=0, seed=None,
+                 bulk_read=False):
+        self.root = root
+        self.latency = latency
+        self.crc_fail_rate = crc_fail_rate
+        self.random = random.Random(seed)
+        self.stopping = False
+        self.devices_dir = os.path.join(root, "bus/w1/devices")
+        self.drivers_dir = os.path.join(root, "bus/w1/drivers/w1_slave_driver")
+        os.makedirs(os.path.join(self.devices_dir, "w1_bus_master1"))
+        os.makedirs(self.drivers_dir)
+        self.devices = list()
+        for n in range(devices):
+            name = "28-{:012x}".format(0x011912580000 + n)
+            self.devices.append(SimulatedDevice(self, name, hung=n >= devices - hung))
+            os.symlink(os.path.join(self.devices_dir, name), os.path.join(self.drivers_dir, name))
+
+        # Bulk conversion state, kept in step with the therm_bulk_read file
+        self.lock = threading.Lock()
+        self.bulk_done = None  # monotonic time the last bulk conversion finishes
+        self.bulk_unread = set()  # devices yet to give their bulk result
+        self.bulk_thread = None
+        self.bulk_conversions = 0
+        if bulk_read:
+            self.bulk_read_file = os.path.join(self.devices_dir, "w1_bus_master1", "therm_bulk_read")
+            self._set_bulk_state("0")
+            self.bulk_thread = threading.Thread(target=self._serve_bulk_read, daemon=True)
+
+    def _set_bulk_state(self, state):
+        # Replaced whole, so the logger never reads it half written
+        temp = self.bulk_read_file + ".new"
+        with open(temp, "w") as f:
+            f.write(state + "\n")
+        os.replace(temp, self.bulk_read_file)
+
+    def _serve_bulk_read(self):
+        # A plain file can't see its writes, so watch for the logger's
+        # "trigger" closely enough that its first poll sees -1
+        state = "0"
+        while not self.stopping:
+            time.sleep(0.001)
+            try:
+                with open(self.bulk_read_file) as f:
+                    written = f.read().strip()
+            except FileNotFoundError:
+                continue
+            with self.lock:
+                if written == "trigger":
+                    self.bulk_done = time.monotonic() + self.latency
+                    self.bulk_unread = set(device.name for device in self.devices)
+                    self.bulk_conversions += 1
+                    state = None
+                if self.bulk_done is None:
+                    continue
+                if time.monotonic() < self.bulk_done:
+                    now = "-1"
+                else:
+                    now = "1" if self.bulk_unread else "0"
+            if now != state:
+                self._set_bulk_state(now)
+                state = now
+
+    def conversion_wait(self, name):
+        """Seconds device name takes to answer a read: what's left of a bulk
+        conversion it hasn't yet given the result of, or else its own
+        conversion time."""
+        with self.lock:
+            if name in self.bulk_unread:
+                self.bulk_unread.discard(name)
+                return max(0.0, self.bulk_done - time.monotonic())
+        return self.latency
+
+    def start(self):
+        for device in self.devices:
+            device.start()
+        if self.bulk_thread is not None:
+            self.bulk_thread.start()
+        return self
+
+    def stop(self):
+        self.stopping = True
+        if self.bulk_thread is not None:
+            self.bulk_thread.join()
+        for device in self.devices:
+            if device.hung:
+                continue
+            # Release a writer blocked waiting for a reader
+            try:
+                os.close(os.open(device.pseudofile, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            device.join(timeout=self.latency + 1)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+class RecordingEndpoint(http.server.ThreadingHTTPServer):
+    """Local stand-in for the datalogger API. Each accepted POST body is
+    appended to .posts, decoded; fail_rate of them get a 503 instead."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            server = self.server
+            if server.random.random() < server.fail_rate:
+                self.send_response(503)
+            else:
+                with server.lock:
+                    server.posts.append(json.loads(body))
+                self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    def __init__(self, fail_rate=0.0, seed=None):
+        super().__init__(('127.0.0.1', 0), self.Handler)
+        self.posts = list()
+        self.lock = threading.Lock()
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://{}:{}/".format(*self.server_address)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def main():
+    from .logger import W1Logger, Config
+
+    p = argparse.ArgumentParser(description="Time W1Logger scans against a simulated bus")
+    p.add_argument('--devices', type=int, default=20)
+    p.add_argument('--latency', type=float, default=0.75, help="conversion seconds per read")
+    p.add_argument('--crc-fail-rate', type=float, default=0.0)
+    p.add_argument('--hung', type=int, default=0, help="devices that never answer")
+    p.add_argument('--bulk-read', action='store_true',
+                   help="offer therm_bulk_read on the bus master (set BulkRead in --config to use it)")
+    p.add_argument('--post-fail-rate', type=float, default=0.0)
+    p.add_argument('--scans', type=int, default=3)
+    p.add_argument('--config', default='{}',
+                   help="JSON logger settings, e.g. '{\"ReadConcurrency\": 8, \"ReadTimeout\": 2}'")
+    a = p.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp, \
+         SimulatedBus(os.path.join(tmp, "sys"), a.devices, a.latency, a.crc_fail_rate, a.hung,
+                      bulk_read=a.bulk_read), \
+         RecordingEndpoint(a.post_fail_rate) as endpoint:
+        config = {"SysfsRoot": os.path.join(tmp, "sys"), "Spool": os.path.join(tmp, "spool")}
+        config.update(json.loads(a.config))
+        config["Post"] = endpoint.url
+        config_filename = os.path.join(tmp, "datalogger.json")
+        with open(config_filename, "w") as f:
+            json.dump(config, f)
+        w1logger = W1Logger(Config(config_filename))
+
+        scan_times = list()
+        started = time.monotonic()
+        for _ in range(a.scans):
+            t = time.monotonic()
+            w1logger.LogW1()
+            scan_times.append(time.monotonic() - t)
+        elapsed = time.monotonic() - started
+
+        scans_received = sum(len(batch) for batch in endpoint.posts)
+        datapoints = sum(len(scan['datapoints']) for batch in endpoint.posts for scan in batch)
+        print("scan seconds: min {:.3f} mean {:.3f} max {:.3f}".format(
+            min(scan_times), sum(scan_times) / len(scan_times), max(scan_times)))
+        print("posts: {} scans received: {} datapoints: {} spooled: {}".format(
+            len(endpoint.posts), scans_received, datapoints, len(w1logger.outbox.pending())))
+        print("throughput: {:.1f} datapoints/s".format(datapoints / elapsed))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
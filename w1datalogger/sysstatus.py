@@ -0,0 +1,114 @@
+"""sysstatus.py
+
+Logger host health, read straight from /proc and statvfs rather than by
+shelling out to uptime, free, df and netstat. Everything comes back as
+numbers; byte counts are bytes.
+"""
+
+import os, os.path, re
+
+import logging
+logger = logging.getLogger(__name__)
+
+tcp_states = {
+    "01": "ESTABLISHED", "02": "SYN_SENT", "03": "SYN_RECV", "04": "FIN_WAIT1",
+    "05": "FIN_WAIT2", "06": "TIME_WAIT", "07": "CLOSE", "08": "CLOSE_WAIT",
+    "09": "LAST_ACK", "0A": "LISTEN", "0B": "CLOSING",
+}
+
+octal_escape_re = re.compile(r'\\([0-7]{3})')
+
+meminfo_keys = ("MemTotal", "MemFree", "MemAvailable", "Buffers", "Cached",
+                "SwapTotal", "SwapFree")
+
+def _read(proc_root, name):
+    with open(os.path.join(proc_root, name), "r") as f:
+        return f.read()
+
+def uptime(proc_root="/proc"):
+    """Seconds since boot."""
+    return float(_read(proc_root, "uptime").split()[0])
+
+def loadavg(proc_root="/proc"):
+    fields = _read(proc_root, "loadavg").split()
+    running, threads = fields[3].split('/')
+    return {
+        "1m": float(fields[0]),
+        "5m": float(fields[1]),
+        "15m": float(fields[2]),
+        "running": int(running),
+        "threads": int(threads),
+    }
+
+def meminfo(proc_root="/proc"):
+    result = dict()
+    for line in _read(proc_root, "meminfo").splitlines():
+        key, _, rest = line.partition(':')
+        if key in meminfo_keys:
+            fields = rest.split()
+            result[key] = int(fields[0]) * (1024 if fields[1:] == ['kB'] else 1)
+    return result
+
+def filesystems(proc_root="/proc"):
+    """{mountpoint: {size, free, avail}} for each mounted filesystem that has
+    blocks, which (like df) leaves out proc, sysfs and friends.
+    """
+    result = dict()
+    for line in _read(proc_root, "mounts").splitlines():
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        mountpoint = octal_escape_re.sub(lambda mo: chr(int(mo.group(1), 8)), fields[1])
+        if mountpoint in result:
+            continue
+        try:
+            st = os.statvfs(mountpoint)
+        except OSError:
+            continue
+        if st.f_blocks == 0:
+            continue
+        result[mountpoint] = {
+            "size": st.f_blocks * st.f_frsize,
+            "free": st.f_bfree * st.f_frsize,
+            "avail": st.f_bavail * st.f_frsize,
+        }
+    return result
+
+def interfaces(proc_root="/proc"):
+    """{interface: {rx_bytes, rx_packets, rx_errs, tx_bytes, tx_packets, tx_errs}}"""
+    result = dict()
+    for line in _read(proc_root, "net/dev").splitlines()[2:]:
+        name, _, counters = line.partition(':')
+        c = [int(n) for n in counters.split()]
+        result[name.strip()] = {
+            "rx_bytes": c[0], "rx_packets": c[1], "rx_errs": c[2],
+            "tx_bytes": c[8], "tx_packets": c[9], "tx_errs": c[10],
+        }
+    return result
+
+def sockets(proc_root="/proc"):
+    """{"tcp": {state: count}, "udp": count}, IPv4 and IPv6 together."""
+    tcp = dict()
+    udp = 0
+    for name in ("net/tcp", "net/tcp6", "net/udp", "net/udp6"):
+        try:
+            lines = _read(proc_root, name).splitlines()[1:]
+        except OSError:
+            continue  # no IPv6, say
+        if name.startswith("net/udp"):
+            udp += len(lines)
+            continue
+        for line in lines:
+            state = tcp_states.get(line.split()[3], "UNKNOWN")
+            tcp[state] = tcp.get(state, 0) + 1
+    return {"tcp": tcp, "udp": udp}
+
+def status(proc_root="/proc"):
+    return {
+        "uptime": uptime(proc_root),
+        "loadavg": loadavg(proc_root),
+        "meminfo": meminfo(proc_root),
+        "filesystems": filesystems(proc_root),
+        "interfaces": interfaces(proc_root),
+        "sockets": sockets(proc_root),
+    }